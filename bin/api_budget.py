@@ -0,0 +1,86 @@
+import fcntl
+import json
+import os
+import time
+from os.path import join as joinpath
+
+# Host-wide budget for Buildkite API requests. Every process using the org
+# token on this host (cron polls, the poll daemon, the webhook receiver,
+# poll_bench record, ...) takes a token from one bucket kept in BUDGET_FILE,
+# under an exclusive flock. The bucket refills at BUDGET_PER_MINUTE and holds
+# at most BUDGET_BURST tokens, so one poller's burst of concurrent page
+# fetches can't use up the org limit the others also draw from.
+BUILDKITE_PATH = os.environ['BUILDKITE_PATH']
+BUDGET_FILE = joinpath(BUILDKITE_PATH, '.api_budget')
+
+# Buildkite allows 200 REST requests per minute per organization; leave some
+# headroom for tools that don't go through this bucket
+BUDGET_PER_MINUTE = float(os.environ.get('BUILDKITE_API_BUDGET', 150))
+BUDGET_BURST = 20
+# Once the API reports this few requests left in the current window, every
+# process on the host pauses until the window resets
+RATE_LIMIT_RESERVE = 5
+
+class _SharedBucket:
+    """The bucket state in BUDGET_FILE, read and written under the lock."""
+    def __enter__(self):
+        self.file = open(BUDGET_FILE, 'a+')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        self.file.seek(0)
+        try:
+            state = json.loads(self.file.read())
+            self.state = {key: float(state[key]) for key in ('tokens', 'updated', 'paused_until')}
+        except (ValueError, KeyError, TypeError):
+            self.state = {'tokens': BUDGET_BURST, 'updated': time.time(), 'paused_until': 0.0}
+        return self.state
+
+    def __exit__(self, *exc):
+        try:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(json.dumps(self.state))
+            self.file.flush()
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+
+def _refill(state, now):
+    rate = BUDGET_PER_MINUTE / 60
+    elapsed = max(0.0, now - state['updated'])
+    state['tokens'] = min(BUDGET_BURST, state['tokens'] + elapsed * rate)
+    state['updated'] = now
+
+def take():
+    """Block until a request may be sent, then take one token. Returns the
+    seconds spent waiting."""
+    waited = 0.0
+    while True:
+        with _SharedBucket() as state:
+            now = time.time()
+            _refill(state, now)
+            if state['paused_until'] > now:
+                wait = state['paused_until'] - now
+            elif state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return waited
+            else:
+                wait = (1 - state['tokens']) / (BUDGET_PER_MINUTE / 60)
+        # Sleep outside the lock, so other processes can check meanwhile
+        time.sleep(wait)
+        waited += wait
+
+def pause(seconds):
+    """Hold every request on this host for `seconds` (e.g. after a 429)."""
+    with _SharedBucket() as state:
+        state['paused_until'] = max(state['paused_until'], time.time() + seconds)
+
+def observe(remaining, reset):
+    """Pace by the limit the API advertised: `remaining` requests are left
+    in a window that resets in `reset` seconds."""
+    with _SharedBucket() as state:
+        now = time.time()
+        _refill(state, now)
+        if remaining <= RATE_LIMIT_RESERVE:
+            state['paused_until'] = max(state['paused_until'], now + reset)
+        # Don't let the bucket promise more than the API has left
+        state['tokens'] = min(state['tokens'], max(0.0, remaining - RATE_LIMIT_RESERVE))
@@ -0,0 +1,424 @@
+import calendar
+import heapq
+import json
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os.path import join as joinpath, isfile
+
+from buildkite import BUILDKITE_PATH, BUILDKITE_QUEUE, API_CONCURRENCY, STARTED_STATES
+from buildkite import Build, BuildkiteAPIError
+from buildkite import started_builds_since, pipeline_started_builds_since
+from buildkite import started_build_summaries_since, finished_builds_since, get_build
+from pipeline_index import PipelineIndex
+
+# On-disk cache of the active builds seen by the last poll, plus the cursor
+# (start time of the last successful poll). Each poll then only asks the API
+# for builds created or finished since the cursor, and conditionally
+# re-fetches some of the cached active builds, most of which answer 304 Not
+# Modified.
+# Builds are kept as `Build` records, and stored in their `as_dict` form.
+CACHE_FILE = joinpath(BUILDKITE_PATH, '.build_cache.json')
+
+# Re-download the whole window this often, to guard against drift (missed
+# builds, clock skew, a cache written by an older poller)
+FULL_RESYNC_SECONDS = 15 * 60
+# Re-query this far before the cursor, to catch builds created while the last
+# poll was paginating and small clock differences with the API
+CURSOR_OVERLAP = timedelta(minutes=2)
+# Cached builds that changed within HOT_SECONDS are due for a re-check on every
+# poll, since that is where new jobs appear (e.g. right after a pipeline
+# upload). Quieter builds are due at most every COLD_REFRESH_SECONDS. Each
+# re-check is one request, so they are spread out: a poll re-checks the due
+# builds that waited longest, hot ones first, up to REFRESHES_PER_MINUTE for
+# the time since the last poll (at most MAX_REFRESHES_PER_POLL). The rest wait
+# for the next poll.
+HOT_SECONDS = 10 * 60
+COLD_REFRESH_SECONDS = 50
+REFRESHES_PER_MINUTE = 40
+MAX_REFRESHES_PER_POLL = 40
+# Builds created before the cursor can become active again: a job retried in
+# a finished build, a blocked build unblocked. The window's active builds are
+# listed without their jobs this often to catch them.
+REACTIVATION_SECONDS = 60
+
+# Most pipelines never target a given cluster's queue. Builds of pipelines
+# the pipeline index knows don't target BUILDKITE_QUEUE are not cached (so
+# not refreshed either), and once it knows the ones that do, full resyncs
+# list just those pipelines -- as long as there are at most PER_PIPELINE_MAX
+# of them, beyond that one org-wide listing is cheaper. The org-wide listing
+# then only runs as a discovery sweep every DISCOVERY_SECONDS, which catches
+# known pipelines that start targeting this queue; pipelines never seen
+# before are cached from their first build on. Between resyncs, the listings
+# of new and finished builds and `_reactivated` stay org-wide: they cover a
+# poll's worth of builds, about a page each, where per-pipeline listings
+# would take a request per pipeline, and they see new pipelines right away.
+PER_PIPELINE_MAX = 10
+DISCOVERY_SECONDS = 30 * 60
+
+# Builds of our own HPC jobs that left the active set (finished, canceling,
+# or older than the window) are fetched one by one to find jobs to cancel.
+# A build in a terminal state won't change again, so it is reused for
+# TERMINAL_CACHE_SECONDS without asking the API.
+TERMINAL_STATES = ['passed', 'failed', 'canceled', 'skipped', 'not_run']
+TERMINAL_CACHE_SECONDS = 10 * 60
+
+# A cached build that isn't due for a re-check can still show one of our jobs
+# as 'scheduled' after its HPC job ended (the job ran, or it was canceled).
+# When one of our jobs leaves `current_jobs`, its build is re-checked first,
+# and its scheduled jobs aren't submitted again until then -- for at most
+# ENDED_RECHECK_SECONDS, after which a build that can't be read is trusted
+# as it is.
+ENDED_RECHECK_SECONDS = 10 * 60
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def _iso(dt):
+    return dt.strftime(ISO_FORMAT)
+
+def _parse_iso(value):
+    # Buildkite timestamps look like 2024-01-01T00:00:00.000Z
+    return datetime.strptime(value.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+
+def build_key(url):
+    """'<slug>/<number>' of the build a job or build web_url belongs to, e.g.
+    'https://buildkite.com/clima/climacoupler-ci/builds/9247#...' ->
+    'climacoupler-ci/9247', or None."""
+    match = re.search(r'buildkite\.com/[^/]+/([^/?#]+)/builds/(\d+)', url or '')
+    return f'{match.group(1)}/{match.group(2)}' if match else None
+
+class BuildCache:
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        self.cursor = None      # ISO timestamp of the last successful poll
+        self.full_sync = 0.0    # epoch seconds of the last full resync
+        self.reactivation_check = 0.0   # epoch seconds of the last listing of
+                                        # the active builds, see _reactivated
+        # build id -> {'build': Build, 'etag': str,
+        #              'checked': epoch of last refresh, 'changed': epoch of last change}
+        self.builds = {}
+        # '<slug>/<number>' -> {'build': Build, 'etag': str,
+        #                       'checked': epoch of last fetch}
+        # for builds outside the active set, see `inactive_builds`
+        self.inactive = {}
+        # hpc job id -> epoch when the poller first saw it orphaned, see
+        # poll.SubmitRound.reconcile
+        self.orphans = {}
+        # buildkite urls of our HPC jobs at the last poll, and the ones that
+        # left since -> epoch when they were first seen gone, see `track_jobs`
+        self.tracked = set()
+        self.ended = {}
+        self.index = PipelineIndex()
+        self.load()
+
+    def load(self):
+        if not isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            self.cursor = state['cursor']
+            self.full_sync = state['full_sync']
+            self.reactivation_check = state.get('reactivation_check', 0.0)
+            self.builds = state['builds']
+            self.inactive = state.get('inactive', {})
+            self.orphans = state.get('orphans', {})
+            self.tracked = set(state.get('tracked', []))
+            self.ended = state.get('ended', {})
+            for entry in self.builds.values():
+                entry['build'] = Build.from_dict(entry['build'])
+                entry.setdefault('checked', 0.0)
+                entry.setdefault('changed', 0.0)
+            for entry in self.inactive.values():
+                entry['build'] = Build.from_dict(entry['build'])
+        except (OSError, ValueError, KeyError, TypeError):
+            # A corrupt or old-format cache just forces a full resync
+            self.cursor, self.full_sync, self.builds, self.inactive = None, 0.0, {}, {}
+            self.orphans, self.tracked, self.ended = {}, set(), {}
+
+    def save(self):
+        def dump(entries):
+            return {
+                key: {**entry, 'build': entry['build'].as_dict()}
+                for key, entry in entries.items()
+            }
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'cursor': self.cursor,
+                'full_sync': self.full_sync,
+                'reactivation_check': self.reactivation_check,
+                'builds': dump(self.builds),
+                'inactive': dump(self.inactive),
+                'orphans': self.orphans,
+                'tracked': sorted(self.tracked),
+                'ended': self.ended,
+            }, f)
+        os.replace(tmp, self.path)
+        self.index.save()
+
+    def _needs_full_resync(self, nhours, now):
+        return (
+            self.cursor is None
+            or time.time() - self.full_sync > FULL_RESYNC_SECONDS
+            or _parse_iso(self.cursor) < now - timedelta(hours=nhours)
+        )
+
+    def _entry(self, build, etag=None):
+        now = time.time()
+        return {'build': build, 'etag': etag, 'checked': now, 'changed': now}
+
+    def _wanted(self, build):
+        """Learn the queues `build` targets. True if it should be cached: its
+        pipeline targets our queue, or was never seen before."""
+        known = self.index.known(build.pipeline_slug)
+        self.index.learn(build)
+        return not known or self.index.is_relevant(build.pipeline_slug, BUILDKITE_QUEUE)
+
+    def _full_resync(self, logger, since):
+        """Generate the window's wanted builds as they download, rebuilding
+        the cache."""
+        relevant = self.index.relevant(BUILDKITE_QUEUE)
+        discovery = (
+            time.time() - self.index.discovered > DISCOVERY_SECONDS
+            or not relevant or len(relevant) > PER_PIPELINE_MAX
+        )
+        if discovery:
+            logger.debug("Build cache: full resync, org-wide")
+            source = started_builds_since(since)
+        else:
+            logger.debug(f"Build cache: full resync of {len(relevant)} pipelines")
+            # Merged newest first, like the org-wide listing
+            source = heapq.merge(
+                *(pipeline_started_builds_since(slug, since) for slug in relevant),
+                key=lambda build: build.created_at or '',
+                reverse=True,
+            )
+
+        cold_start = not self.builds
+        builds = {}
+        for build in source:
+            if not self._wanted(build):
+                continue
+            entry = self._entry(build)
+            old = self.builds.get(build.id)
+            if old is not None and old['build'] == build:
+                # Unchanged: keep its ETag and change history
+                entry = old
+                entry['checked'] = time.time()
+            elif cold_start:
+                # We don't know when these last changed, so let them age like
+                # quiet builds instead of treating every one of them as hot
+                entry['changed'] = 0.0
+            # Also in the current cache, for `awaiting_recheck` while this runs
+            self.builds[build.id] = builds[build.id] = entry
+            yield build
+        self.builds = builds
+        self.full_sync = self.reactivation_check = time.time()
+        if discovery:
+            self.index.discovered = self.full_sync
+
+    def _incremental(self, logger, since):
+        cursor = _iso(_parse_iso(self.cursor) - CURSOR_OVERLAP)
+
+        # Drop builds that finished since the last poll
+        for build in finished_builds_since(cursor):
+            self.builds.pop(build.id, None)
+
+        # Drop builds that fell out of the window
+        for build_id, entry in list(self.builds.items()):
+            created_at = entry['build'].created_at
+            if created_at and _iso(_parse_iso(created_at)) < since:
+                del self.builds[build_id]
+
+        # Conditionally refresh builds already in the cache. A build that
+        # can't be read is kept as it is until it leaves the window.
+        def refresh(entry):
+            build = entry['build']
+            try:
+                return get_build(build.pipeline_slug, build.number, entry['etag'])
+            except BuildkiteAPIError as e:
+                logger.debug(f"Failed to refresh build {build.web_url}: {e}")
+                return None, entry['etag']
+
+        now = time.time()
+        ended = self._ended_by_build()
+        due = sorted(
+            (build_id not in ended, now - entry['changed'] >= HOT_SECONDS, entry['checked'],
+             build_id)
+            for build_id, entry in self.builds.items()
+            if build_id in ended
+            or now - entry['changed'] < HOT_SECONDS
+            or now - entry['checked'] >= COLD_REFRESH_SECONDS
+        )
+        elapsed = now - calendar.timegm(_parse_iso(self.cursor).timetuple())
+        allowance = min(MAX_REFRESHES_PER_POLL,
+                        max(1, math.ceil(REFRESHES_PER_MINUTE * elapsed / 60)))
+        stale = [(build_id, self.builds[build_id]) for *_, build_id in due[:allowance]]
+        with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+            refreshed = list(pool.map(lambda item: refresh(item[1]), stale))
+        changed = 0
+        for (build_id, entry), (build, etag) in zip(stale, refreshed):
+            entry['checked'] = now
+            if build is None:
+                continue
+            changed += 1
+            self.index.learn(build)
+            if build.state in STARTED_STATES:
+                self.builds[build_id] = self._entry(build, etag)
+            else:
+                del self.builds[build_id]
+
+        # Add builds created since the last poll
+        new = 0
+        for build in started_builds_since(cursor):
+            if self._wanted(build):
+                self.builds[build.id] = self._entry(build)
+                new += 1
+
+        reactivated = 0
+        if now - self.reactivation_check >= REACTIVATION_SECONDS:
+            reactivated = self._reactivated(logger, since)
+            self.reactivation_check = now
+
+        logger.debug(
+            f"Build cache: {new} new, {reactivated} active again, {changed}/{len(stale)} "
+            f"refreshed builds changed, {len(due) - len(stale)} due builds left for later"
+        )
+
+    def _reactivated(self, logger, since):
+        """Add the active builds of the window the cache doesn't have, e.g.
+        finished builds with a job retried. Returns how many were added."""
+        missing = [
+            build for build in started_build_summaries_since(since)
+            if build.id not in self.builds
+            and not (self.index.known(build.pipeline_slug)
+                     and not self.index.is_relevant(build.pipeline_slug, BUILDKITE_QUEUE))
+        ]
+
+        def fetch(summary):
+            try:
+                return get_build(summary.pipeline_slug, summary.number)
+            except BuildkiteAPIError as e:
+                logger.debug(f"Failed to fetch build {summary.web_url}: {e}")
+                return None, None
+
+        with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+            fetched = list(pool.map(fetch, missing))
+        added = 0
+        for build, etag in fetched:
+            if build is not None and build.state in STARTED_STATES and self._wanted(build):
+                self.builds[build.id] = self._entry(build, etag)
+                added += 1
+        return added
+
+    def track_jobs(self, current_jobs):
+        """Note which of our jobs (buildkite urls of `current_jobs`) left the
+        scheduler since the last poll."""
+        now = time.time()
+        for url in self.tracked - set(current_jobs):
+            self.ended.setdefault(url, now)
+        self.ended = {
+            url: ended for url, ended in self.ended.items()
+            if now - ended < ENDED_RECHECK_SECONDS and url not in current_jobs
+        }
+        self.tracked = set(current_jobs)
+
+    def _ended_by_build(self):
+        """build id -> the latest time one of our jobs in it ended, for the
+        cached builds last checked before that."""
+        keys = {}
+        for url, ended in self.ended.items():
+            key = build_key(url)
+            keys[key] = max(keys.get(key, 0.0), ended)
+        return {
+            build_id: keys[key] for build_id, key in (
+                (build_id, build_key(entry['build'].web_url))
+                for build_id, entry in self.builds.items()
+            )
+            if key in keys and self.builds[build_id]['checked'] < keys[key]
+        }
+
+    def awaiting_recheck(self, build, job):
+        """True if the HPC job of `job` ended after `build` was last checked:
+        its state in the cache may be stale."""
+        ended = self.ended.get(job.web_url)
+        entry = self.builds.get(build.id)
+        return ended is not None and entry is not None and entry['checked'] < ended
+
+    def started_builds(self, logger, nhours):
+        """Generate all 'scheduled', 'running', 'failing' builds created in the
+        last `nhours`, newest first, as `Build` records. On a full resync they
+        are generated while later pages still download. Updates the cache and,
+        once exhausted, its cursor; the caller persists them with `save` once
+        the poll succeeds."""
+        now = datetime.utcnow().replace(microsecond=0)
+        since = _iso(now - timedelta(hours=nhours))
+        if self._needs_full_resync(nhours, now):
+            yield from self._full_resync(logger, since)
+        else:
+            self._incremental(logger, since)
+            yield from sorted(
+                (entry['build'] for entry in self.builds.values()),
+                key=lambda build: build.created_at or '',
+                reverse=True,
+            )
+        self.cursor = _iso(now)
+
+    def inactive_builds(self, logger, job_urls):
+        """Return the `Build` records of the jobs at `job_urls` (e.g. our own
+        HPC jobs) that are not in the active set returned by the last
+        `started_builds`, one per build. Fetched concurrently and conditionally;
+        builds already seen in a terminal state are reused for a while."""
+        active = {build_key(entry['build'].web_url) for entry in self.builds.values()}
+        keys = {build_key(url) for url in job_urls} - active - {None}
+
+        # Forget builds none of our jobs belong to anymore
+        for key in list(self.inactive):
+            if key not in keys:
+                del self.inactive[key]
+        now = time.time()
+        due = [
+            key for key in keys
+            if key not in self.inactive
+            or self.inactive[key]['build'].state not in TERMINAL_STATES
+            or now - self.inactive[key]['checked'] > TERMINAL_CACHE_SECONDS
+        ]
+
+        def fetch(key):
+            slug, number = key.rsplit('/', 1)
+            etag = self.inactive.get(key, {}).get('etag')
+            try:
+                return get_build(slug, int(number), etag)
+            except BuildkiteAPIError as e:
+                logger.debug(f"Failed to fetch build {key}: {e}")
+                return False, None
+
+        with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+            fetched = list(pool.map(fetch, due))
+        for key, (build, etag) in zip(due, fetched):
+            if build is None:
+                self.inactive[key]['checked'] = now
+            elif build:
+                self.inactive[key] = {'build': build, 'etag': etag, 'checked': now}
+
+        logger.debug(
+            f"Inactive builds of current jobs: {len(keys)}, fetched {len(due)}"
+        )
+        return [self.inactive[key]['build'] for key in keys if key in self.inactive]
+
+    def job_states(self, job_urls):
+        """Map each of `job_urls` to the state of its job, as last seen in the
+        active builds or the ones fetched by `inactive_builds`. Jobs of builds
+        neither has are left out."""
+        wanted = set(job_urls)
+        states = {}
+        for entries in (self.builds, self.inactive):
+            for entry in entries.values():
+                for job in entry['build'].jobs:
+                    if job.web_url in wanted:
+                        states[job.web_url] = job.state
+        return states
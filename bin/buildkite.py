@@ -1,33 +1,153 @@
+import codecs
 import datetime
 from datetime import datetime, timedelta
+import json
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import os
+import random
 import re
+import time
 from os.path import join as joinpath, isfile
 
+import api_budget
+import metrics
+
 BUILDS_ENDPOINT = 'https://api.buildkite.com/v2/organizations/clima/builds'
+PIPELINES_ENDPOINT = 'https://api.buildkite.com/v2/organizations/clima/pipelines'
+
+# Build states the poller treats as active
+STARTED_STATES = ['scheduled', 'running', 'failing']
+# Build states in which the poller cancels the build's HPC jobs
+CANCELED_STATES = ['canceling', 'canceled']
 
 BUILDKITE_PATH = os.environ['BUILDKITE_PATH']
 BUILDKITE_QUEUE = os.environ['BUILDKITE_QUEUE']
 
-BUILDKITE_API_TOKEN = os.environ.get(
-'BUILDKITE_API_TOKEN',
-open(joinpath(BUILDKITE_PATH,'.buildkite_token'), 'r').read().rstrip()
-)
+BUILDKITE_API_TOKEN = os.environ.get('BUILDKITE_API_TOKEN') or \
+    open(joinpath(BUILDKITE_PATH,'.buildkite_token'), 'r').read().rstrip()
+
+EXCLUDE_NODES_PATH = joinpath(BUILDKITE_PATH, '.exclude_nodes')
+_exclude_nodes_cache = (None, '')  # (mtime, content) of EXCLUDE_NODES_PATH
+
+# Nodes to pass to every sbatch as --exclude. The BUILDKITE_EXCLUDE_NODES
+# environment variable takes precedence over the `.exclude_nodes` file. The
+# file is re-read whenever it changes, so a long-running poller picks up edits.
+def get_exclude_nodes():
+    global _exclude_nodes_cache
+    if 'BUILDKITE_EXCLUDE_NODES' in os.environ:
+        return os.environ['BUILDKITE_EXCLUDE_NODES']
+    if not isfile(EXCLUDE_NODES_PATH):
+        return ''
+    mtime = os.path.getmtime(EXCLUDE_NODES_PATH)
+    if _exclude_nodes_cache[0] != mtime:
+        with open(EXCLUDE_NODES_PATH, 'r') as f:
+            _exclude_nodes_cache = (mtime, f.read().rstrip())
+    return _exclude_nodes_cache[1]
+
+# Builds per API page (the Buildkite maximum)
+PER_PAGE = 100
+# Max number of API pages fetched concurrently once the page count is known
+API_CONCURRENCY = int(os.environ.get('BUILDKITE_API_CONCURRENCY', 4))
+
+# Response bodies are parsed as they stream in, this many bytes at a time
+PARSE_CHUNK = 64 * 1024
+
+# Throttled (429), failed (5xx) and dropped requests are retried this many
+# times, with full-jitter exponential backoff starting at RETRY_BASE seconds
+# and capped at RETRY_MAX. Every attempt takes a token from the host-wide
+# budget in api_budget.py.
+API_RETRIES = 4
+RETRY_BASE = 1
+RETRY_MAX = 30
+# (connect, read) timeouts, so a stalled connection is retried rather than
+# hanging the poll
+API_TIMEOUT = (10, 60)
+
+# One pooled session per process, so every page reuses an open TCP+TLS
+# connection instead of paying a new handshake per request
+SESSION = requests.Session()
+SESSION.headers['Authorization'] = f'Bearer {BUILDKITE_API_TOKEN}'
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=API_CONCURRENCY))
+
+class BuildkiteAPIError(Exception):
+    """A Buildkite API request failed for good: retries ran out, or the
+    status can't be fixed by retrying (e.g. 401, 404)."""
+
+class Job:
+    """The fields of a Buildkite job the poller reads. Everything else in the
+    API's job objects (env, command, agent, ...) is dropped while parsing."""
+    __slots__ = ('id', 'type', 'state', 'web_url', 'agent_query_rules', 'scheduled_at',
+                 'step_key', 'name')
+
+    def __init__(self, id, type, state=None, web_url=None, agent_query_rules=None,
+                 scheduled_at=None, step_key=None, name=None):
+        self.id = id
+        self.type = type
+        self.state = state
+        self.web_url = web_url
+        self.agent_query_rules = agent_query_rules or []
+        self.scheduled_at = scheduled_at
+        self.step_key = step_key
+        self.name = name
+
+    @classmethod
+    def from_dict(cls, job):
+        return cls(job['id'], job['type'], job.get('state'), job.get('web_url'),
+                   job.get('agent_query_rules'), job.get('scheduled_at'),
+                   job.get('step_key'), job.get('name'))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, Job) and self.as_dict() == other.as_dict()
+
+class Build:
+    """The fields of a Buildkite build the poller reads, with its jobs as
+    `Job` records. `as_dict` gives the trimmed form stored in the build cache
+    and the webhook spool, which `from_dict` reads back, like a full API
+    build object."""
+    __slots__ = ('id', 'number', 'state', 'created_at', 'web_url',
+                 'pipeline_name', 'pipeline_slug', 'jobs')
+
+    def __init__(self, id, number, state, created_at, web_url,
+                 pipeline_name, pipeline_slug, jobs):
+        self.id = id
+        self.number = number
+        self.state = state
+        self.created_at = created_at
+        self.web_url = web_url
+        self.pipeline_name = pipeline_name
+        self.pipeline_slug = pipeline_slug
+        self.jobs = jobs
+
+    @classmethod
+    def from_dict(cls, build):
+        return cls(
+            build['id'], build['number'], build['state'], build.get('created_at'),
+            build.get('web_url'), build['pipeline']['name'], build['pipeline']['slug'],
+            [Job.from_dict(job) for job in build.get('jobs') or []],
+        )
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'number': self.number,
+            'state': self.state,
+            'created_at': self.created_at,
+            'web_url': self.web_url,
+            'pipeline': {'name': self.pipeline_name, 'slug': self.pipeline_slug},
+            'jobs': [job.as_dict() for job in self.jobs],
+        }
 
-exclude_nodes_path = joinpath(BUILDKITE_PATH, '.exclude_nodes')
-# Check if the file exists and read its content, otherwise fallback to an empty string
-if isfile(exclude_nodes_path):
-    exclude_nodes_from_file = open(exclude_nodes_path, 'r').read().rstrip()
-else:
-    exclude_nodes_from_file = ''
-# Get the value from environment variable, or fallback to the file content or an empty string
-BUILDKITE_EXCLUDE_NODES = os.environ.get('BUILDKITE_EXCLUDE_NODES', exclude_nodes_from_file)
+    def __eq__(self, other):
+        return isinstance(other, Build) and self.as_dict() == other.as_dict()
 
 def get_buildkite_job_tags(job):
-    agent_query_rules = job.get('agent_query_rules', [])
     tag_dict = {}
-    for item in agent_query_rules:
+    for item in job.agent_query_rules:
         if '=' in item:
             key, value = item.split('=', 1)  # Split on first '=' only
             tag_dict[key] = value
@@ -39,6 +159,12 @@ def get_buildkite_job_tags(job):
 def sanitize_pipeline_name(name):
     return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
 
+def pipeline_slug_from_url(url):
+    """Extract the buildkite pipeline slug from a job/build web_url, e.g.
+    'https://buildkite.com/clima/climacoupler-ci/builds/9247#...' -> 'climacoupler-ci'."""
+    match = re.search(r'buildkite\.com/[^/]+/([^/?#]+)', url or '')
+    return match.group(1) if match else None
+
 def build_url(pipeline_name, build_num):
     return f"https://buildkite.com/clima/{sanitize_pipeline_name(pipeline_name)}/builds/{build_num}"
 
@@ -52,50 +178,229 @@ def hours_ago_utc(nhours):
 def day_ago_utc():
     return (datetime.utcnow() - timedelta(days=1)).replace(microsecond=0).isoformat() + 'Z'
 
-# Retrieve all 'scheduled', 'running', 'failing' builds in the last nhours
-def all_started_builds(nhours): 
-    since = hours_ago_utc(nhours=nhours)
-    npage, builds = 1, []
+# Yield the elements of the JSON array in the body of `resp` one at a time, as
+# the body streams in, so a whole page of full build objects is never in
+# memory at once
+def _iter_json_array(resp):
+    decoder = json.JSONDecoder()
+    chunks = resp.iter_content(chunk_size=PARSE_CHUNK)
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos = '', 0
+
+    def more():
+        nonlocal buf, pos
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buf, pos = buf[pos:] + utf8.decode(chunk), 0
+        return True
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or not more():
+                return
+
+    skip(' \t\r\n')
+    if buf[pos:pos + 1] != '[':
+        while more():
+            pass
+        raise ValueError(f"Expected a list of builds, got {resp.status_code}: {buf[pos:pos + 200]}")
+    pos += 1
     while True:
-        req = requests.get(
-            BUILDS_ENDPOINT,
-            params = {
-                'page' : npage,
-                'per_page' : 100,
-                'state[]' : ['scheduled', 'running', 'failing'],
-                'created_from' : since
-            },
-            headers = {
-                'Authorization': 'Bearer ' + BUILDKITE_API_TOKEN
-            }
+        skip(' \t\r\n,')
+        if pos == len(buf):
+            raise ValueError("Truncated list of builds")
+        if buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Element not complete yet: read until the pending text doubled,
+            # so a large element is not re-parsed once per chunk
+            pending = len(buf) - pos
+            grew = False
+            while len(buf) - pos < 2 * pending and more():
+                grew = True
+            if not grew:
+                raise
+            continue
+        # A number or literal is only complete once followed by a delimiter:
+        # '12' or '-7500.' may go on in the next chunk (objects, arrays and
+        # strings end with their own)
+        if buf[pos] not in '{["' and not re.match(r'[\s,\]]', buf[end:end + 1]) and more():
+            continue
+        pos = end
+        yield item
+
+def _backoff(attempt):
+    return random.uniform(0, min(RETRY_MAX, RETRY_BASE * 2 ** attempt))
+
+# Seconds until the API's rate limit window resets, from the `RateLimit-Reset`
+# (or `Retry-After`) header, or None
+def _reset_seconds(resp):
+    for header in ('RateLimit-Reset', 'Retry-After'):
+        value = resp.headers.get(header, '')
+        if value.isdigit():
+            return int(value)
+    return None
+
+# GET `url` through the shared session, within the host-wide request budget,
+# and return `read(resp)` for a successful (or 304) response. Throttled,
+# failed and dropped requests are retried; anything else raises
+# BuildkiteAPIError. `read` runs inside the retry loop, so a body that breaks
+# off while streaming is fetched again.
+def _request(url, detail, read, **kwargs):
+    for attempt in range(API_RETRIES + 1):
+        waited = api_budget.take()
+        if waited:
+            metrics.METRICS.observe('api_budget_wait', waited, detail)
+        try:
+            with SESSION.get(url, stream = True, timeout = API_TIMEOUT, **kwargs) as resp:
+                remaining = resp.headers.get('RateLimit-Remaining', '')
+                reset = _reset_seconds(resp)
+                if remaining.isdigit() and reset is not None:
+                    api_budget.observe(int(remaining), reset)
+                if resp.status_code < 400:
+                    return read(resp)
+                error = f"{resp.status_code} {resp.text[:200]}"
+                if resp.status_code == 429:
+                    delay = reset if reset is not None else _backoff(attempt)
+                    # Everyone on this host waits, not just this request
+                    api_budget.pause(delay)
+                elif resp.status_code >= 500:
+                    delay = _backoff(attempt)
+                else:
+                    raise BuildkiteAPIError(f"{detail}: {error}")
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            error, delay = repr(e), _backoff(attempt)
+        if attempt == API_RETRIES:
+            raise BuildkiteAPIError(f"{detail}: {error}, gave up after {attempt + 1} attempts")
+        with metrics.timer('api_backoff', f"{detail}: {error}"):
+            time.sleep(delay)
+
+# Fetch one page of builds from `endpoint` through the shared session, parsed
+# into `Build` records as it streams in. Returns (response, builds).
+def _get_page(endpoint, params, npage):
+    detail = f"{endpoint.split('/organizations/', 1)[-1]} {params} page {npage}"
+    with metrics.timer('api_page', detail):
+        return _request(
+            endpoint, detail,
+            lambda resp: (resp, [Build.from_dict(build) for build in _iter_json_array(resp)]),
+            params = {**params, 'page' : npage, 'per_page' : PER_PAGE},
         )
 
-        resp = req.json()
-        if not len(resp):
-            break
-        builds.extend(resp)
-        npage += 1
-    return builds
+# Number of the last page advertised in the `Link` header, or None if the
+# response carries no `rel="last"` link (single page, or no pagination info)
+def _last_page(resp):
+    last = resp.links.get('last')
+    if not last:
+        return None
+    match = re.search(r'[?&]page=(\d+)', last['url'])
+    return int(match.group(1)) if match else None
+
+# Generate every build matching `params` as a `Build` record, in page order.
+# The first page is fetched alone to learn the page count from the `Link`
+# header (without a `rel="last"` link, pages are followed one by one); the
+# remaining pages are then fetched concurrently (at most
+# API_CONCURRENCY at a time) over the pooled session. Builds are yielded as
+# soon as their page and all pages before it are in, so callers can start on
+# page 1 while later pages download.
+def _all_pages(endpoint, params):
+    # Builds created while we paginate shift later pages, so the same build
+    # can show up on two pages; keep the first occurrence.
+    seen = set()
+    def unseen(page):
+        for build in page:
+            if build.id not in seen:
+                seen.add(build.id)
+                yield build
+
+    resp, first = _get_page(endpoint, params, 1)
+    yield from unseen(first)
+    last = _last_page(resp)
+    if last is not None:
+        with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+            for _, page in pool.map(
+                lambda npage: _get_page(endpoint, params, npage),
+                range(2, last + 1),
+            ):
+                yield from unseen(page)
+    elif 'next' in resp.links or (not resp.links and len(first) == PER_PAGE):
+        # No page count: walk pages while there is a `rel="next"` link or,
+        # without pagination info at all, until an empty page
+        npage = 2
+        while True:
+            resp, page = _get_page(endpoint, params, npage)
+            if not len(page):
+                break
+            yield from unseen(page)
+            if resp.links and 'next' not in resp.links:
+                break
+            npage += 1
 
+# Generate all 'scheduled', 'running', 'failing' builds in the last nhours
+def all_started_builds(nhours):
+    return started_builds_since(hours_ago_utc(nhours=nhours))
+
+# Generate all 'scheduled', 'running', 'failing' builds created at or after
+# the ISO 8601 timestamp `since`
+def started_builds_since(since):
+    return _all_pages(BUILDS_ENDPOINT, {
+        'state[]' : STARTED_STATES,
+        'created_from' : since,
+    })
+
+# Generate all 'scheduled', 'running', 'failing' builds created at or after
+# `since` without their jobs, a much smaller download, to see which builds are
+# active
+def started_build_summaries_since(since):
+    return _all_pages(BUILDS_ENDPOINT, {
+        'state[]' : STARTED_STATES,
+        'created_from' : since,
+        'exclude_jobs' : 'true',
+    })
+
+# Generate the 'scheduled', 'running', 'failing' builds of one pipeline created
+# at or after `since`
+def pipeline_started_builds_since(pipeline_slug, since):
+    return _all_pages(f'{PIPELINES_ENDPOINT}/{pipeline_slug}/builds', {
+        'state[]' : STARTED_STATES,
+        'created_from' : since,
+    })
+
+# Generate all builds (in any state) that finished at or after `since`
+def finished_builds_since(since):
+    return _all_pages(BUILDS_ENDPOINT, {'finished_from' : since})
+
+# Conditionally fetch a single build. Returns (Build, etag); the build is None
+# when the server answers 304 Not Modified for the given `etag`. Raises
+# BuildkiteAPIError if the build can't be read (e.g. it was deleted).
+def get_build(pipeline_slug, number, etag=None):
+    def read(resp):
+        if resp.status_code == 304:
+            return None, etag
+        return Build.from_dict(resp.json()), resp.headers.get('ETag')
+
+    detail = f'{pipeline_slug}/builds/{number}'
+    with metrics.timer('api_build', detail):
+        return _request(
+            f'{PIPELINES_ENDPOINT}/{detail}', detail, read,
+            headers = {'If-None-Match': etag} if etag else {},
+        )
+
+# Fetch a single build as the API returns it, with every field of its jobs
+# (the `Build` records keep only what the poller reads)
+def get_build_json(pipeline_slug, number):
+    detail = f'{pipeline_slug}/builds/{number}'
+    with metrics.timer('api_build', detail):
+        return _request(f'{PIPELINES_ENDPOINT}/{detail}', detail, lambda resp: resp.json())
 
 def all_canceled_builds():
-    since = day_ago_utc()
-    npage, builds = 1, []
-    while True:
-        resp = requests.get(
-            BUILDS_ENDPOINT,
-            params = {
-                'page' : npage,
-                'per_page' : 100,
-                'state[]' : ['canceling', 'canceled'],
-                'finished_from' : since
-            },
-            headers = {
-                'Authorization': f'Bearer {BUILDKITE_API_TOKEN}'
-            }
-        ).json()
-        if not len(resp):
-            break
-        builds.extend(resp)
-        npage += 1
-    return builds
+    return _all_pages(BUILDS_ENDPOINT, {
+        'state[]' : CANCELED_STATES,
+        'finished_from' : day_ago_utc(),
+    })
@@ -51,4 +51,7 @@ cd $BUILDKITE_PATH
 DATE="$(date +\%Y-\%m-\%d)"
 mkdir -p "logs/$DATE"
 
-bin/poll.py &>> "logs/$DATE/cron"
+# `cron.sh --daemon` starts a long-running poller (see `bin/poll.py --daemon`).
+# Polls take a lock, so while the daemon runs this exits immediately, and cron
+# restarts the daemon within a minute if it ever stops.
+bin/poll.py "$@" &>> "logs/$DATE/cron"
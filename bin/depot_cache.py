@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+import argparse
+import errno
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import stat
+import sys
+import time
+import uuid
+from os.path import join as joinpath, isdir, isfile, islink
+
+# Shared cache of Julia depot content, so builds stop downloading, unpacking
+# and precompiling the same packages over and over. The store has a depot's
+# layout, one entry per immutable, content-addressed directory or file:
+#
+#   packages/<name>/<slug>      a package version (the slug encodes its uuid
+#                               and git tree hash)
+#   artifacts/<tree hash>       an artifact
+#   compiled/<julia>/<name>/<key>/<file>
+#                               a precompile cache file (.ji, .so), under the
+#                               key of the dependencies it was built against
+#
+# `populate` (hooks/pre-command) hard-links into a new build depot the
+# entries the checkout's manifests need: the packages, their artifacts and
+# the compiled caches built against the same dependencies. Hard links cost
+# no data and no file inodes, and a linked build keeps working if its
+# entries are evicted from the store meanwhile. Where linking isn't allowed,
+# files are reflinked or copied. Julia only ever replaces depot files by
+# renaming new ones over them, so a build can't write through a link into
+# the store.
+#
+# `publish` (hooks/post-command) adds the build depot's new entries. Each is
+# linked into a temporary directory in the store and renamed into place, so
+# other builds never see half an entry; when two builds publish the same
+# entry, the first rename wins. Julia derives package slugs from the uuid
+# and tree hash in the manifest; publish records which slugs each (uuid,
+# tree hash) pair of the checkout's manifests was installed as, and populate
+# looks them up there.
+#
+# A compiled cache is only valid for the versions of its package and of
+# everything the package depends on. Its file name also depends on the
+# project that built it, so every build writes new ones. Publish only adds
+# the compiled files a build wrote for its checkout's manifests, under a key
+# of the tree hashes of the package and its dependencies (see
+# `manifest_keys`). Populate links only the newest files under the key the
+# manifest asks for, so Julia has a single candidate per package to check.
+# The caches of dev'ed packages, and of packages depending on one, are not
+# shared.
+#
+# Every entry has a marker under .used with its size, touched whenever it is
+# published or populated. When the store grows over DEPOT_CACHE_MAX_GB,
+# publish evicts the least recently used entries (at most every
+# EVICT_INTERVAL, one evictor at a time under an flock). Evicted entries are
+# renamed out of the depot layout before they are deleted.
+
+# The store must be on the same filesystem as the build depots for hard links
+DEPOT_CACHE_PATH = os.environ.get('DEPOT_CACHE_PATH') or joinpath(
+    os.environ.get('BUILDKITE_BUILD_PATH', '.'), 'depot-cache'
+)
+DEPOT_CACHE_MAX_GB = float(os.environ.get('DEPOT_CACHE_MAX_GB', 200))
+EVICT_INTERVAL = 30 * 60
+
+# Manifests are searched this many directories below the checkout
+MANIFEST_DEPTH = 3
+
+SLUG = re.compile(r'^[A-Za-z0-9]{4,5}$')
+TREE_HASH = re.compile(r'^[0-9a-f]{40}$')
+COMPILED_SUFFIXES = ('.ji', '.so', '.dylib', '.dll')
+GIT_TREE_SHA1 = re.compile(r'^\s*git-tree-sha1\s*=\s*"([0-9a-f]{40})"', re.MULTILINE)
+
+# ioctl to share a file's extents (reflink) on Btrfs, XFS, ...
+FICLONE = 0x40049409
+
+def log(message):
+    print(f"depot_cache: {message}", file=sys.stderr)
+
+def read_manifest_graph(path):
+    """{name: [fields]} of the packages in a Manifest.toml, format 1 or 2,
+    with the names of each package's dependencies under 'deps'. A name is
+    listed more than once when the manifest has several packages of it."""
+    graph = {}
+    name = fields = section = None
+    def flush():
+        if name is not None:
+            graph.setdefault(name, []).append(fields)
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            header = re.match(r'^\[\[(?:deps\.)?("?)([^\]"]+)\1\]\]$', line)
+            if header:
+                flush()
+                name, fields, section = header.group(2), {'deps': []}, None
+            elif line.startswith('['):
+                # [deps.<name>.deps] lists the dependencies as name = "uuid"
+                if name is not None and re.match(
+                    r'^\[(?:deps\.)?"?%s"?\.deps\]$' % re.escape(name), line
+                ):
+                    section = 'table'
+                else:
+                    flush()
+                    name = None
+            elif name is None or not line:
+                continue
+            elif section == 'array':
+                fields['deps'].extend(re.findall(r'"([^"]+)"', line.partition(']')[0]))
+                if ']' in line:
+                    section = None
+            elif section == 'table':
+                match = re.match(r'^"?([^"=\s]+)"?\s*=', line)
+                if match:
+                    fields['deps'].append(match.group(1))
+            elif re.match(r'^deps\s*=\s*\[', line):
+                items = line.partition('[')[2]
+                fields['deps'].extend(re.findall(r'"([^"]+)"', items.partition(']')[0]))
+                if ']' not in items:
+                    section = 'array'
+            else:
+                match = re.match(r'^([\w-]+)\s*=\s*"([^"]*)"$', line)
+                if match:
+                    fields[match.group(1)] = match.group(2)
+    flush()
+    return graph
+
+def read_manifest(path):
+    """[(name, uuid, git tree hash)] of the registered packages in a
+    Manifest.toml, format 1 or 2. Stdlibs and dev'ed packages have no tree
+    hash and are skipped."""
+    return [
+        (name, fields['uuid'], fields['git-tree-sha1'])
+        for name, packages in read_manifest_graph(path).items() for fields in packages
+        if 'uuid' in fields and 'git-tree-sha1' in fields
+    ]
+
+def manifest_keys(path):
+    """{name: key} of the packages in a Manifest.toml whose compiled caches
+    can be shared. The key hashes the package's uuid and tree hash and the
+    keys of its dependencies, so it changes whenever anything the package
+    is compiled against does. Dev'ed packages, packages that depend on one
+    and packages whose name is ambiguous have no key."""
+    graph = read_manifest_graph(path)
+    keys = {}
+    def key(name):
+        if name in keys:
+            return keys[name]
+        # Also what a dependency cycle gets
+        keys[name] = None
+        packages = graph.get(name) or []
+        if len(packages) != 1 or 'uuid' not in packages[0] or 'path' in packages[0]:
+            return None
+        fields = packages[0]
+        # Stdlibs have no tree hash, the Julia version pins them
+        parts = [f"{name} {fields['uuid']} {fields.get('git-tree-sha1', 'stdlib')}"]
+        for dep in sorted(set(fields['deps'])):
+            if key(dep) is None:
+                return None
+            parts.append(keys[dep])
+        keys[name] = hashlib.sha1('\n'.join(parts).encode()).hexdigest()[:16]
+        return keys[name]
+    for name in graph:
+        key(name)
+    return {name: k for name, k in keys.items() if k is not None}
+
+def checkout_keys(manifests):
+    """{name: {key}} of the packages of the manifests that have a key."""
+    keys = {}
+    for manifest in manifests:
+        try:
+            for name, key in manifest_keys(manifest).items():
+                keys.setdefault(name, set()).add(key)
+        except (OSError, UnicodeDecodeError) as e:
+            log(f"skipping {manifest}: {e}")
+    return keys
+
+def find_manifests(checkout):
+    """Manifest files of the checkout."""
+    manifests = []
+    base = checkout.rstrip(os.sep).count(os.sep)
+    for root, dirs, files in os.walk(checkout):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if root.count(os.sep) - base >= MANIFEST_DEPTH:
+            dirs[:] = []
+        manifests.extend(
+            joinpath(root, name) for name in files
+            if re.match(r'^(Julia)?Manifest(-v[\d.]+)?\.toml$', name)
+        )
+    return manifests
+
+def remove_tree(path):
+    """Remove the file or directory `path`. Pkg makes package directories
+    read-only, so the directories of the tree are made writable as needed.
+    Its files are never chmod'ed: they are hard links shared with the store
+    and with other builds' depots."""
+    def make_writable(function, failed, _):
+        for directory in (os.path.dirname(failed), failed):
+            inside = directory == path or directory.startswith(path + os.sep)
+            if inside and isdir(directory) and not islink(directory):
+                os.chmod(directory, stat.S_IRWXU)
+        function(failed)
+    if isdir(path) and not islink(path):
+        shutil.rmtree(path, onerror=make_writable)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def link_file(src, dst):
+    """Hard-link `src` to `dst`, else reflink it, else copy it."""
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK):
+            raise
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def link_tree(src, dst):
+    """Recreate the file or directory `src` at `dst` out of links to its
+    files. Directories get their modes back at the end, as they may be
+    read-only."""
+    if not isdir(src) or islink(src):
+        link_file(src, dst)
+        return
+    modes = []
+    for root, dirs, files in os.walk(src):
+        target = dst if root == src else joinpath(dst, os.path.relpath(root, src))
+        os.mkdir(target)
+        modes.append((target, stat.S_IMODE(os.stat(root).st_mode)))
+        for name in files + [d for d in dirs if islink(joinpath(root, d))]:
+            path = joinpath(root, name)
+            if islink(path):
+                os.symlink(os.readlink(path), joinpath(target, name))
+            else:
+                link_file(path, joinpath(target, name))
+    for target, mode in reversed(modes):
+        os.chmod(target, mode)
+
+def tree_size(path):
+    if not isdir(path) or islink(path):
+        return os.lstat(path).st_size
+    return sum(
+        os.lstat(joinpath(root, name)).st_size
+        for root, _, files in os.walk(path) for name in files
+    )
+
+def depot_entries(depot):
+    """Relative paths of the cacheable entries of a depot."""
+    entries = []
+    packages = joinpath(depot, 'packages')
+    for name in sorted(os.listdir(packages)) if isdir(packages) else []:
+        for slug in sorted(os.listdir(joinpath(packages, name))):
+            if SLUG.match(slug):
+                entries.append(joinpath('packages', name, slug))
+    artifacts = joinpath(depot, 'artifacts')
+    for tree_hash in sorted(os.listdir(artifacts)) if isdir(artifacts) else []:
+        if TREE_HASH.match(tree_hash):
+            entries.append(joinpath('artifacts', tree_hash))
+    return entries
+
+def compiled_files(depot):
+    """[(julia version, package name, file name)] of the precompile cache
+    files of a depot."""
+    files = []
+    compiled = joinpath(depot, 'compiled')
+    for version in sorted(os.listdir(compiled)) if isdir(compiled) else []:
+        for name in sorted(os.listdir(joinpath(compiled, version))):
+            path = joinpath(compiled, version, name)
+            if isdir(path):
+                files.extend(
+                    (version, name, f) for f in sorted(os.listdir(path))
+                    if f.endswith(COMPILED_SUFFIXES)
+                )
+    return files
+
+class DepotCache:
+    def __init__(self, path=DEPOT_CACHE_PATH, max_bytes=DEPOT_CACHE_MAX_GB * 1e9):
+        self.path = path
+        self.max_bytes = max_bytes
+        for name in ('.tmp', '.trash', '.used', '.index'):
+            os.makedirs(joinpath(self.path, name), exist_ok=True)
+
+    def _marker(self, entry):
+        return joinpath(self.path, '.used', entry)
+
+    def touch(self, entry, size=None):
+        """Mark `entry` as used now, recording its size if given."""
+        marker = self._marker(entry)
+        if size is not None:
+            os.makedirs(os.path.dirname(marker), exist_ok=True)
+            with open(marker, 'w') as f:
+                f.write(str(size))
+        else:
+            try:
+                os.utime(marker)
+            except FileNotFoundError:
+                pass
+
+    def _place(self, src, dst):
+        """Link `src` into a temporary path in the store, then rename it to
+        `dst`, unless another build got there first. Returns True if `dst`
+        was created."""
+        tmp = joinpath(self.path, '.tmp', uuid.uuid4().hex)
+        try:
+            link_tree(src, tmp)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if isdir(tmp):
+                try:
+                    os.rename(tmp, dst)
+                except OSError as e:
+                    if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                        return False
+                    raise
+            else:
+                # rename would replace an existing file
+                try:
+                    os.link(tmp, dst)
+                except FileExistsError:
+                    return False
+            return True
+        finally:
+            if os.path.lexists(tmp):
+                remove_tree(tmp)
+
+    def _index(self, package_uuid):
+        return joinpath(self.path, '.index', package_uuid)
+
+    def slugs(self, package_uuid, tree_hash):
+        """Entries a package version was published as."""
+        try:
+            with open(self._index(package_uuid), 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return set()
+        return {entry for line in lines for t, _, entry in [line.partition(' ')] if t == tree_hash}
+
+    def newest_compiled(self, version, name, key):
+        """Entries of the newest compiled cache under `key`: its .ji and the
+        native code next to it."""
+        path = joinpath(self.path, 'compiled', version, name, key)
+        try:
+            files = [f for f in os.listdir(path) if f.endswith(COMPILED_SUFFIXES)]
+            stems = {
+                os.path.splitext(f)[0]: os.path.getmtime(joinpath(path, f))
+                for f in files if f.endswith('.ji')
+            }
+        except OSError:
+            # Missing, or evicted meanwhile
+            return []
+        if not stems:
+            return []
+        newest = max(stems, key=stems.get)
+        return [
+            joinpath('compiled', version, name, key, f) for f in sorted(files)
+            if os.path.splitext(f)[0] == newest
+        ]
+
+    def populate(self, depot, checkout):
+        """Link into `depot` what the manifests under `checkout` need."""
+        manifests = find_manifests(checkout)
+        wanted = []
+        for manifest in manifests:
+            try:
+                packages = read_manifest(manifest)
+            except (OSError, UnicodeDecodeError) as e:
+                log(f"skipping {manifest}: {e}")
+                continue
+            for _, package_uuid, tree_hash in packages:
+                wanted.extend(sorted(self.slugs(package_uuid, tree_hash)))
+        # Artifacts of those packages, for every platform; only the ones in
+        # the store are linked
+        for entry in list(wanted):
+            for toml in ('Artifacts.toml', 'JuliaArtifacts.toml'):
+                try:
+                    with open(joinpath(self.path, entry, toml), 'r') as f:
+                        hashes = GIT_TREE_SHA1.findall(f.read())
+                except OSError:
+                    continue
+                wanted.extend(joinpath('artifacts', h) for h in hashes)
+        # Entries are linked to the same path in the depot, except compiled
+        # caches, which leave their key behind
+        targets = {entry: entry for entry in wanted}
+        compiled = joinpath(self.path, 'compiled')
+        keys = checkout_keys(manifests) if isdir(compiled) else {}
+        for version in sorted(os.listdir(compiled)) if keys else []:
+            for name, key in sorted((n, k) for n, ks in keys.items() for k in ks):
+                for entry in self.newest_compiled(version, name, key):
+                    targets[entry] = joinpath('compiled', version, name, os.path.basename(entry))
+
+        linked = 0
+        for entry, target in targets.items():
+            src, dst = joinpath(self.path, entry), joinpath(depot, target)
+            if not os.path.lexists(src) or os.path.lexists(dst):
+                continue
+            try:
+                if self._place_in_depot(src, dst):
+                    linked += 1
+                    self.touch(entry)
+            except OSError as e:
+                # Evicted meanwhile, or a concurrent job of the build
+                log(f"could not link {entry}: {e}")
+        log(f"linked {linked} entries into {depot}")
+
+    def _place_in_depot(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f'{dst}.{uuid.uuid4().hex[:8]}.tmp'
+        try:
+            link_tree(src, tmp)
+            if os.path.lexists(dst):
+                return False
+            os.rename(tmp, dst)
+            return True
+        finally:
+            if os.path.lexists(tmp):
+                remove_tree(tmp)
+
+    def publish(self, depot, checkout=None):
+        """Add the entries of `depot` the store doesn't have yet, and index
+        the package versions of the manifests under `checkout`. Compiled
+        caches are only added with a checkout to key them by."""
+        published = 0
+        entries = [(joinpath(depot, entry), entry) for entry in depot_entries(depot)]
+        if checkout:
+            entries.extend(self._compiled(depot, checkout))
+        for src, entry in entries:
+            dst = joinpath(self.path, entry)
+            if os.path.lexists(dst):
+                self.touch(entry)
+                continue
+            try:
+                if self._place(src, dst):
+                    published += 1
+                    self.touch(entry, tree_size(dst))
+            except OSError as e:
+                log(f"could not publish {entry}: {e}")
+        if checkout:
+            self._index_manifests(depot, checkout)
+        log(f"published {published} entries from {depot}")
+
+    def _compiled(self, depot, checkout):
+        """[(path, entry)] of the compiled caches in `depot` of packages
+        with one key across the checkout's manifests. Files older than the
+        manifests were built for other dependencies, or linked from the
+        store."""
+        manifests = find_manifests(checkout)
+        keys = checkout_keys(manifests)
+        try:
+            since = max(os.path.getmtime(m) for m in manifests) if manifests else None
+        except OSError:
+            since = None
+        compiled = []
+        for version, name, f in compiled_files(depot) if since else []:
+            if len(keys.get(name, ())) != 1:
+                continue
+            path = joinpath(depot, 'compiled', version, name, f)
+            if os.path.getmtime(path) < since:
+                continue
+            [key] = keys[name]
+            compiled.append((path, joinpath('compiled', version, name, key, f)))
+        return compiled
+
+    def _index_manifests(self, depot, checkout):
+        manifests = find_manifests(checkout)
+        for manifest in manifests:
+            try:
+                packages = read_manifest(manifest)
+            except (OSError, UnicodeDecodeError):
+                continue
+            for name, package_uuid, tree_hash in packages:
+                # Every installed version of the name is a candidate; a wrong
+                # one is only an extra link Julia never looks at
+                path = joinpath(depot, 'packages', name)
+                slugs = [s for s in os.listdir(path) if SLUG.match(s)] if isdir(path) else []
+                known = self.slugs(package_uuid, tree_hash)
+                new = [
+                    joinpath('packages', name, s) for s in slugs
+                    if joinpath('packages', name, s) not in known
+                ]
+                if new:
+                    # Appends of a few lines are atomic; readers skip nothing
+                    with open(self._index(package_uuid), 'a') as f:
+                        f.write(''.join(f'{tree_hash} {entry}\n' for entry in new))
+
+    def evict(self, force=False):
+        """Remove the least recently used entries until the store fits in
+        its budget. At most every EVICT_INTERVAL unless forced, and skipped
+        if another build is already evicting."""
+        stamp = joinpath(self.path, '.evicted')
+        if not force and isfile(stamp) and time.time() - os.path.getmtime(stamp) < EVICT_INTERVAL:
+            return
+        with open(joinpath(self.path, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            with open(stamp, 'w'):
+                pass
+            used = []
+            markers = joinpath(self.path, '.used')
+            for root, _, files in os.walk(markers):
+                for name in files:
+                    marker = joinpath(root, name)
+                    try:
+                        with open(marker, 'r') as f:
+                            size = int(f.read() or 0)
+                        used.append((os.path.getmtime(marker), size, os.path.relpath(marker, markers)))
+                    except (OSError, ValueError):
+                        continue
+            total = sum(size for _, size, _ in used)
+            doomed = []
+            for _, size, entry in sorted(used):
+                if total <= self.max_bytes:
+                    break
+                trash = joinpath(self.path, '.trash', uuid.uuid4().hex)
+                try:
+                    os.rename(joinpath(self.path, entry), trash)
+                    doomed.append(trash)
+                except FileNotFoundError:
+                    pass
+                os.remove(self._marker(entry))
+                total -= size
+        # Outside the lock: deleting is slow, and nothing links from the trash
+        for trash in doomed + [
+            joinpath(self.path, '.trash', t) for t in os.listdir(joinpath(self.path, '.trash'))
+        ]:
+            if os.path.lexists(trash):
+                remove_tree(trash)
+        if doomed:
+            log(f"evicted {len(doomed)} entries, {total / 1e9:.1f} GB left")
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared Julia depot cache")
+    parser.add_argument('--store', default=DEPOT_CACHE_PATH, help="the shared store")
+    commands = parser.add_subparsers(dest='command')
+    populate = commands.add_parser('populate', help="link cached entries into a build depot")
+    populate.add_argument('depot')
+    populate.add_argument('checkout')
+    publish = commands.add_parser('publish', help="add a build depot's new entries to the store")
+    publish.add_argument('depot')
+    publish.add_argument('checkout', nargs='?')
+    commands.add_parser('evict', help="evict least recently used entries over the size budget")
+    args = parser.parse_args()
+
+    cache = DepotCache(args.store)
+    if args.command == 'populate':
+        cache.populate(args.depot, args.checkout)
+    elif args.command == 'publish':
+        cache.publish(args.depot, args.checkout)
+        cache.evict()
+    elif args.command == 'evict':
+        cache.evict(force=True)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import calendar
+import heapq
+import time
+
+from job_schedulers import Resources
+
+# Submission planning. A submission round first collects every eligible
+# scheduled job (see poll.SubmitRound), then `plan` orders them by weighted
+# fair share across pipelines and keeps only as many as the queue's in-flight
+# budget allows. The next job always comes from the pipeline with the fewest
+# in-flight (pending + running) HPC jobs relative to its weight, so when the
+# budget runs short every pipeline still gets its share of the backfill
+# window instead of the first pipelines the API happened to list. Within a
+# pipeline, jobs go oldest first. Budgets and caps are counted in jobs, GPUs,
+# nodes and reserved CPU-hours (see job_schedulers.Resources), so a job is
+# left out only if it doesn't fit in what is left; a smaller job after it may
+# still go. Jobs left out stay 'scheduled' in buildkite and are planned again
+# next round.
+
+# Relative share of the queue per buildkite pipeline slug. Pipelines not
+# listed here get the default.
+DEFAULT_PIPELINE_WEIGHT = 1.0
+PIPELINE_WEIGHTS = {}
+
+# A pipeline's weight grows by its own weight again for every AGING_SECONDS
+# its oldest job has been waiting, so a low-weight pipeline behind busy ones
+# still gets through eventually
+AGING_SECONDS = 30 * 60
+
+# Max in-flight resources of the service account per buildkite queue, across
+# all pipelines: resource name ('jobs', 'gpus', 'nodes', 'cpu_hours') -> max,
+# unlisted resources are unlimited. The scheduler's own per-user limits
+# (Slurm's backfill window bf_max_job_user and the association's
+# MaxSubmitJobs, see JobScheduler.user_job_limit) lower the job count
+# further; jobs beyond them would only sit in the queue without being
+# considered for backfill.
+DEFAULT_INFLIGHT_LIMITS = {}
+QUEUE_INFLIGHT_LIMITS = {
+    # e.g. "central": {"gpus": 48, "nodes": 40},
+}
+
+def pipeline_weight(slug):
+    return PIPELINE_WEIGHTS.get(slug, DEFAULT_PIPELINE_WEIGHT)
+
+def waiting_since(scheduled_at, now):
+    """Epoch seconds of an API timestamp such as '2024-05-01T12:00:00.000Z',
+    or `now` if it is missing."""
+    if not scheduled_at:
+        return now
+    parsed = time.strptime(scheduled_at.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+    return min(now, calendar.timegm(parsed))
+
+def plan(candidates, inflight, queue_limits, pipeline_limits, now=None):
+    """Order candidate jobs for submission.
+
+    `candidates` is a list of (pipeline slug, waiting since (epoch),
+    requested `Resources`, item), `inflight` maps pipeline slugs to the
+    `Resources` their HPC jobs already hold, `queue_limits` is the queue's
+    budget and `pipeline_limits(slug)` gives a pipeline's caps, both as
+    resource name -> max. Returns (items to submit in order, [(item, reason)]
+    left out), where the reason is 'cap' or 'budget'.
+    """
+    now = time.time() if now is None else now
+    by_pipeline = {}
+    for slug, since, requested, item in candidates:
+        by_pipeline.setdefault(slug, []).append((since, requested, item))
+    for jobs in by_pipeline.values():
+        jobs.sort(key=lambda job: job[0])
+
+    usage = dict(inflight)
+    total = sum(inflight.values(), Resources())
+    def entry(slug, nextjob):
+        since = by_pipeline[slug][nextjob][0]
+        weight = pipeline_weight(slug) * (1 + max(0.0, now - since) / AGING_SECONDS)
+        # Least served pipeline first, then the longest waiting job
+        held = usage.get(slug, Resources()).jobs
+        return ((held + 1) / weight, since, slug or "", nextjob, slug)
+
+    heap = [entry(slug, 0) for slug in by_pipeline]
+    heapq.heapify(heap)
+    planned, left_out = [], []
+    while heap:
+        _, _, _, nextjob, slug = heapq.heappop(heap)
+        _, requested, item = by_pipeline[slug][nextjob]
+        pipeline_usage = usage.get(slug, Resources()) + requested
+        if (total + requested).exceeds(queue_limits):
+            left_out.append((item, 'budget'))
+        elif pipeline_usage.exceeds(pipeline_limits(slug)):
+            left_out.append((item, 'cap'))
+        else:
+            planned.append(item)
+            usage[slug] = pipeline_usage
+            total += requested
+        if nextjob + 1 < len(by_pipeline[slug]):
+            heapq.heappush(heap, entry(slug, nextjob + 1))
+    return planned, left_out
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+import math
+import sqlite3
+import subprocess
+import threading
+import time
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH
+from sqlite_store import SqliteStore, sacct_time
+
+# How long our GPU jobs wait to start, learned from our own `buildkite` jobs.
+# When the poller submits a GPU job it records the partition, GPU type and
+# count, whether the job is short, and how many jobs were pending on that type
+# at the time; `sacct` fills in when each job started. Per (partition, type,
+# count, length) the wait is fit as a line in the pending depth, which
+# job_schedulers.pick_spill_gpu_type uses to compare the preferred GPU type
+# with its fallbacks by expected start time. Past jobs the poller didn't record
+# are imported from sacct without a depth; they give the typical wait until
+# enough recorded ones exist.
+#
+# `gpu_waits.py --report` shows what the predictor would pick right now, next
+# to the pending-threshold rule, without submitting anything.
+WAIT_HISTORY_FILE = joinpath(BUILDKITE_PATH, 'gpu_waits.sqlite')
+
+# Jobs older than this are forgotten
+HISTORY_DAYS = 14
+# sacct is asked for new starts at most this often
+HISTORY_REFRESH_SECONDS = 600
+# Fewer started jobs than this for a GPU type and the prediction is None, and
+# the spill decision falls back to the pending threshold
+MIN_SAMPLES = 20
+# Jobs with a time limit up to this many hours backfill much more easily, so
+# they are modeled apart from longer ones
+SHORT_JOB_HOURS = 2
+
+def is_short(hours):
+    """Whether a job with a time limit of `hours` (None if unlimited or
+    unknown) is modeled as short."""
+    return hours is not None and hours <= SHORT_JOB_HOURS
+
+def gpu_bucket(gpus):
+    """Jobs are grouped by GPU count as 1, 2-3 and 4 or more."""
+    return 1 if gpus <= 1 else 2 if gpus < 4 else 4
+
+class GpuWaitHistory(SqliteStore):
+    def __init__(self, path=WAIT_HISTORY_FILE):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.refreshed = 0.0
+        # (partition, gpu_type, bucket, short) -> (intercept, slope, samples),
+        # refit after each refresh; None until then
+        self._models = None
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS waits ('
+                ' job_id TEXT PRIMARY KEY,'
+                ' partition TEXT,'
+                ' gpu_type TEXT,'
+                ' gpus INTEGER,'
+                ' short INTEGER,'
+                ' depth INTEGER,'
+                ' submit REAL,'
+                ' start REAL)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+
+    def record_submit(self, job_id, partition, gpu_type, gpus, short, depth):
+        """Record a GPU job just submitted with `depth` jobs pending on its type."""
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO waits'
+                ' (job_id, partition, gpu_type, gpus, short, depth, submit)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (str(job_id), partition, gpu_type, gpus, int(short), depth, time.time()),
+            )
+
+    def refresh(self, logger, force=False):
+        """Read submit and start times of our recent jobs from sacct, at most
+        every HISTORY_REFRESH_SECONDS."""
+        with self.lock:
+            if not force and time.time() - self.refreshed < HISTORY_REFRESH_SECONDS:
+                return
+            self.refreshed = time.time()
+            try:
+                self._import_sacct()
+            except (OSError, subprocess.CalledProcessError, sqlite3.Error) as e:
+                logger.warning(f"Failed to update the GPU wait history: {e}")
+            self._models = None
+
+    def _import_sacct(self):
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone()
+        # Look back a day before the last import, to catch jobs that were
+        # still pending then
+        since = max(time.time() - HISTORY_DAYS * 86400, float(row[0]) - 86400 if row else 0)
+        now = time.time()
+        out = subprocess.run(
+            ['sacct', '-X', '--noheader', '--parsable2', '--name=buildkite',
+             '-S', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(since)), '-E', 'now',
+             '--format=JobIDRaw,Partition,AllocTRES,Timelimit,Submit,Start'],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+
+        # Local import, job_schedulers uses this module
+        from job_schedulers import time_limit_hours
+        rows = []
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) < 6:
+                continue
+            job_id, partition, tres, time_limit, submit, start = fields[:6]
+            gpus = {}
+            for item in tres.split(','):
+                name, _, value = item.partition('=')
+                if name.startswith('gres/gpu:') and value.isdigit():
+                    gpus[name.split(':', 1)[1]] = int(value)
+            submit, start = sacct_time(submit), sacct_time(start)
+            if not gpus or submit is None:
+                continue
+            # Pending jobs have no AllocTRES yet, so every row is a started job
+            gpu_type, count = max(gpus.items(), key=lambda item: item[1])
+            hours = time_limit_hours(time_limit)
+            rows.append((job_id, partition.split(',')[0], gpu_type, count,
+                         int(is_short(hours)), submit, start))
+
+        with self._transaction() as db:
+            # Recorded jobs keep their depth; the GPU type sacct reports is
+            # the one actually allocated
+            db.executemany(
+                'INSERT INTO waits (job_id, partition, gpu_type, gpus, short, submit, start)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT(job_id) DO UPDATE SET'
+                ' partition = excluded.partition, gpu_type = excluded.gpu_type,'
+                ' gpus = excluded.gpus, submit = excluded.submit, start = excluded.start',
+                rows,
+            )
+            db.execute('DELETE FROM waits WHERE submit < ?', (now - HISTORY_DAYS * 86400,))
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)", (str(now),)
+            )
+
+    def _samples(self):
+        """(partition, gpu_type, bucket, short) -> [(depth or None, wait seconds)]
+        for every started job."""
+        samples = {}
+        with self._transaction() as db:
+            for partition, gpu_type, gpus, short, depth, submit, start in db.execute(
+                'SELECT partition, gpu_type, gpus, short, depth, submit, start'
+                ' FROM waits WHERE start IS NOT NULL'
+            ):
+                key = (partition, gpu_type, gpu_bucket(gpus), bool(short))
+                samples.setdefault(key, []).append((depth, max(0.0, start - submit)))
+        return samples
+
+    @staticmethod
+    def _fit(samples):
+        """(intercept, slope) of wait against pending depth, by least squares
+        over the samples with a depth; a flat line at the median wait if there
+        are too few of them or the depth doesn't vary."""
+        waits = sorted(wait for _, wait in samples)
+        median = waits[len(waits) // 2]
+        points = [(depth, wait) for depth, wait in samples if depth is not None]
+        if len(points) < MIN_SAMPLES:
+            return median, 0.0
+        n = len(points)
+        mean_d = sum(d for d, _ in points) / n
+        mean_w = sum(w for _, w in points) / n
+        var = sum((d - mean_d) ** 2 for d, _ in points)
+        if var == 0:
+            return median, 0.0
+        # More jobs ahead never shortens the wait
+        slope = max(0.0, sum((d - mean_d) * (w - mean_w) for d, w in points) / var)
+        return max(0.0, mean_w - slope * mean_d), slope
+
+    def _model(self, partition, gpu_type, gpus, short):
+        if self._models is None:
+            samples = self._samples()
+            models = {}
+            # Pooled over GPU counts and lengths, for keys with few samples
+            pooled = {}
+            for (p, t, _, _), points in samples.items():
+                pooled.setdefault((p, t, None, None), []).extend(points)
+            for key, points in list(samples.items()) + list(pooled.items()):
+                if len(points) >= MIN_SAMPLES:
+                    models[key] = self._fit(points) + (len(points),)
+            self._models = models
+        return (self._models.get((partition, gpu_type, gpu_bucket(gpus), short))
+                or self._models.get((partition, gpu_type, None, None)))
+
+    def predict(self, partition, gpu_type, gpus, short, depth):
+        """Expected seconds until a job of `gpus` GPUs of `gpu_type` starts,
+        with `depth` jobs pending on the type. None without enough history."""
+        model = self._model(partition, gpu_type, gpus, short)
+        if model is None:
+            return None
+        intercept, slope, _ = model
+        return intercept + slope * depth
+
+def report(logger):
+    """Print, for each GPU count and job length, the spill decision of the
+    pending-threshold rule and of the predictor, against the current cluster
+    state. Nothing is claimed or submitted."""
+    import job_schedulers
+    from buildkite import BUILDKITE_QUEUE
+
+    queue = BUILDKITE_QUEUE
+    preferred = job_schedulers.DEFAULT_GPU_TYPES.get(queue)
+    partition = job_schedulers.DEFAULT_GPU_PARTITIONS.get(queue)
+    if preferred is None or not job_schedulers.GPU_SPILL_FALLBACK.get(queue):
+        print(f"`{queue}` has no default GPU type or no spill fallbacks, nothing to compare")
+        return
+    history = GpuWaitHistory()
+    history.refresh(logger, force=True)
+    snapshot = job_schedulers.ClusterSnapshot()
+    reservation = job_schedulers.DEFAULT_GPU_RESERVATIONS.get(queue)
+    # Read once, every decision below works on its own copy
+    free = snapshot.partition_free(partition)
+    if reservation:
+        snapshot.reservation_free(reservation)
+    pending = snapshot.pending(partition)
+
+    types = [preferred] + job_schedulers.GPU_SPILL_FALLBACK[queue]
+    print(f"Queue `{queue}`, partition {partition}, pending: "
+          + ", ".join(f"{t} {pending.get(t, 0)}" for t in types))
+    print(f"{'gpus':>4} {'length':<6} {'threshold':<12} {'predicted':<12} expected wait (min) per type")
+    for gpus in (1, 2, 4):
+        for short in (True, False):
+            hours = 1 if short else SHORT_JOB_HOURS * 4
+            # As if it were the only submission
+            by_rule = {}
+            for policy in ('threshold', 'predict'):
+                by_rule[policy] = job_schedulers.pick_spill_gpu_type(
+                    logger, queue, preferred, gpus, partition, snapshot.copy(),
+                    reservation if gpus < 3 else None, hours, history, policy,
+                ) or preferred
+            waits = []
+            for gpu_type in types:
+                if job_schedulers.ClusterSnapshot.fits(free, gpu_type, gpus):
+                    wait = 0.0
+                else:
+                    wait = history.predict(partition, gpu_type, gpus, short, pending.get(gpu_type, 0))
+                waits.append(f"{gpu_type} {'?' if wait is None else math.ceil(wait / 60)}")
+            print(f"{gpus:>4} {'short' if short else 'long':<6} {by_rule['threshold']:<12} "
+                  f"{by_rule['predict']:<12} {', '.join(waits)}")
+
+def main():
+    import argparse
+    import logging
+    logger = logging.Logger('gpu_waits')
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+    parser = argparse.ArgumentParser(
+        description="GPU queue wait history and spill predictions for this queue"
+    )
+    parser.add_argument(
+        '--report', action='store_true',
+        help="compare the predicted spill choices with the pending-threshold rule",
+    )
+    args = parser.parse_args()
+    if args.report:
+        report(logger)
+    else:
+        GpuWaitHistory().refresh(logger, force=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,29 @@
+import copy
+import getpass
+import json
 import subprocess
-import dbm
+import sqlite3
 import os
 from os.path import join as joinpath
 import re
 import shutil
-from buildkite import get_buildkite_job_tags, BUILDKITE_EXCLUDE_NODES
+import threading
+import time
+from buildkite import get_buildkite_job_tags, get_exclude_nodes
 from buildkite import BUILDKITE_PATH, BUILDKITE_QUEUE
+from job_store import JobStore
+from sqlite_store import sacct_time
+import gpu_waits
+import job_usage
+import metrics
+import node_health
+import pilots
+import remediation
+import runtimes
 
 DEFAULT_SCHEDULER = os.environ.get('JOB_SYSTEM', 'slurm')
+# Time limit of jobs whose tags don't set one, unless their step's runtime
+# history asks for less (see runtimes.py and JobScheduler.time_limit)
 DEFAULT_TIMELIMIT = '1:05:00'
 
 # Map from buildkite queue to slurm partition or PBS queue
@@ -77,6 +93,83 @@ def get_gpu_type(slurm_keys):
         return parts[1]
     return None
 
+# Hours in a Slurm time limit ('minutes', 'minutes:seconds',
+# 'hours:minutes:seconds', 'days-hours[:minutes[:seconds]]') or a PBS walltime
+# ('hours:minutes:seconds' or 'seconds'). None if unlimited or unparsable.
+def time_limit_hours(value, bare_unit_hours=1 / 60):
+    try:
+        days = 0
+        if '-' in value:
+            days, value = value.split('-', 1)
+            days = int(days)
+            parts = [int(p) for p in value.split(':')]
+            parts += [0] * (3 - len(parts))
+        else:
+            parts = [int(p) for p in value.split(':')]
+            if len(parts) == 1:
+                return parts[0] * bare_unit_hours
+            if len(parts) == 2:
+                parts = [0] + parts
+        hours, minutes, seconds = parts
+        return days * 24 + hours + minutes / 60 + seconds / 3600
+    except ValueError:
+        return None
+
+class Resources:
+    """What HPC jobs hold or request, summed over jobs: the unit of the
+    per-pipeline caps and queue budgets. CPU-hours are reserved CPU-hours,
+    CPUs times the time limit."""
+    __slots__ = ('jobs', 'gpus', 'nodes', 'cpu_hours')
+
+    def __init__(self, jobs=0, gpus=0, nodes=0, cpu_hours=0.0):
+        self.jobs = jobs
+        self.gpus = gpus
+        self.nodes = nodes
+        self.cpu_hours = cpu_hours
+
+    @classmethod
+    def from_dict(cls, resources):
+        return cls(**resources)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __add__(self, other):
+        return Resources(*(getattr(self, name) + getattr(other, name) for name in self.__slots__))
+
+    def exceeds(self, limits):
+        """True if any resource is over its limit in `limits` (resource name
+        -> max, missing ones are unlimited)."""
+        return any(getattr(self, name) > limit for name, limit in limits.items())
+
+    def __repr__(self):
+        return (f'Resources(jobs={self.jobs}, gpus={self.gpus}, nodes={self.nodes}, '
+                f'cpu_hours={self.cpu_hours:.1f})')
+
+class SchedulerJob:
+    """One of our jobs in the scheduler, with the `Resources` it holds (or
+    requests, while pending). `current_jobs` maps buildkite urls to lists of
+    these. `pending` is True while it waits in the scheduler's queue, False
+    once it started, None if unknown (e.g. just submitted). The scheduler's
+    own state, the reason a pending job waits, its submit time (epoch), its
+    TRES and its reservation are set when the scheduler reports them."""
+    __slots__ = ('id', 'resources', 'pending', 'state', 'reason', 'submit_time', 'tres',
+                 'reservation')
+
+    def __init__(self, id, resources=None, pending=None, state=None, reason=None,
+                 submit_time=None, tres=None, reservation=None):
+        self.id = id
+        self.resources = resources or Resources(jobs=1)
+        self.pending = pending
+        self.state = state
+        self.reason = reason
+        self.submit_time = submit_time
+        self.tres = tres
+        self.reservation = reservation
+
+    def __repr__(self):
+        return f'SchedulerJob({self.id!r}, {self.resources!r})'
+
 # The queue default GPU type (e.g. p100 on central) is the cheapest, so we
 # prefer it. But when it is congested we spill to a fallback type rather than
 # wait. This cluster's gpu partition requires a *typed* request
@@ -92,44 +185,80 @@ GPU_SPILL_FALLBACK = {
 # the very high default effectively disables spilling on unlisted queues.
 GPU_SPILL_PENDING_THRESHOLD = {"central": 10}
 GPU_SPILL_PENDING_THRESHOLD_DEFAULT = 10 ** 9
+# How a queue decides to spill, see `pick_spill_gpu_type`: 'threshold' (the
+# pending threshold above), 'predict' (earliest expected start, from the wait
+# history in gpu_waits.py) or 'shadow' (threshold, logging the prediction)
+GPU_SPILL_POLICY = {"central": "shadow"}
+# Under 'predict', each step down GPU_SPILL_FALLBACK must start the job at
+# least this many seconds earlier to be worth its higher billing weight
+GPU_SPILL_STEP_SECONDS = {"central": 10 * 60}
+GPU_SPILL_STEP_SECONDS_DEFAULT = 10 * 60
+
+# Whether a queue lowers overstated slurm_mem and slurm_cpus_per_task tags to
+# what their step used in its recent runs (see job_usage.py): 'apply', or
+# 'shadow' (only log the change). Queues not listed keep the tags as they are,
+# as does a job tagged `right_size: false`.
+RIGHT_SIZING_POLICY = {}
 
-def _max_free_by_type(partition):
-    """Map gpu_type -> most free GPUs of that type on any single schedulable node
-    in `partition`. Nodes that are down/drained/completing/reserved are excluded
+# Cluster state read for GPU spill decisions is reused for this many seconds
+CLUSTER_SNAPSHOT_TTL = 30
+
+# Per-user job limits change with the cluster configuration, not from one
+# poll to the next; re-read them this often
+USER_JOB_LIMIT_TTL = 3600
+
+# Slurm job states of jobs that haven't finished yet, for the runtime history
+SLURM_ACTIVE_STATES = {
+    'PENDING', 'RUNNING', 'REQUEUED', 'RESIZING', 'SUSPENDED', 'CONFIGURING', 'COMPLETING',
+}
+# PBS exit statuses of finished jobs as Slurm job states: -29 is the job
+# killed for exceeding its walltime, 271 (256 + SIGTERM) a qdel. Others are
+# failures.
+PBS_EXIT_STATES = {0: 'COMPLETED', -29: 'TIMEOUT', 271: 'CANCELLED'}
+# qstat states of jobs that haven't started: queued, held, waiting
+PBS_PENDING_STATES = {'Q', 'H', 'W'}
+
+def _free_by_node(partition):
+    """Map node -> {gpu_type: free GPUs} for every schedulable node in
+    `partition`. Nodes that are down/drained/completing/reserved are excluded
     since a new (non-reserved) job can't land on them -- reserved nodes are
-    handled separately via `_reservation_free_by_type`. One `sinfo` call, one
+    handled separately via `_reservation_free_by_node`. One `sinfo` call, one
     snapshot."""
     out = subprocess.run(
         ["sinfo", "-h", "-p", partition, "-N",
-         "-O", "StateCompact:|,Gres:|,GresUsed:"],
+         "-O", "NodeList:|,StateCompact:|,Gres:|,GresUsed:"],
         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
     ).stdout.decode("utf-8")
-    best = {}
+    free = {}
     for line in out.splitlines():
         fields = line.split("|")
-        if len(fields) < 3:
+        if len(fields) < 4:
             continue
-        state, gres, gres_used = fields[0], fields[1], fields[2]
+        node, state, gres, gres_used = (f.strip() for f in fields[:4])
         if re.search(r"down|drain|resv|comp|fail|\*", state):
             continue
         cfg = {t: int(n) for t, n in re.findall(r"gpu:(\w+):(\d+)", gres)}
         used = {t: int(n) for t, n in re.findall(r"gpu:(\w+):(\d+)", gres_used)}
-        for t, n in cfg.items():
-            best[t] = max(best.get(t, 0), n - used.get(t, 0))
-    return best
+        # With -N a node in several listed partitions shows up once per partition
+        free[node] = {t: n - used.get(t, 0) for t, n in cfg.items()}
+    return free
 
-def _pending_gpu_jobs(gpu_type, partition):
-    """Number of PENDING jobs in `partition` whose per-node GRES requests
-    `gpu_type`."""
+def _pending_gpu_jobs_by_type(partition):
+    """Map gpu_type -> number of PENDING jobs in `partition` whose per-node GRES
+    requests that type."""
     out = subprocess.run(
         ["squeue", "-h", "-p", partition, "-t", "PD", "-O", "tres-per-node:60"],
         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
     ).stdout.decode("utf-8")
-    return sum(1 for line in out.splitlines() if f"gpu:{gpu_type}" in line)
+    pending = {}
+    for line in out.splitlines():
+        for t in set(re.findall(r"gpu:([A-Za-z]\w*)", line)):
+            pending[t] = pending.get(t, 0) + 1
+    return pending
 
-def _reservation_free_by_type(reservation):
-    """Map gpu_type -> most free GPUs of that type on any single schedulable node
-    in `reservation`, via scontrol. sinfo misreports GPU usage on reserved nodes
+def _reservation_free_by_node(reservation):
+    """Map node -> {gpu_type: free GPUs} for every schedulable node in
+    `reservation`, via scontrol. sinfo misreports GPU usage on reserved nodes
     (shows a `resv` overlay with `GresUsed:0(IDX:N/A)`), so we read CfgTRES minus
     AllocTRES per node instead. Empty dict if the reservation has no nodes or
     can't be read."""
@@ -144,10 +273,11 @@ def _reservation_free_by_type(reservation):
         ["scontrol", "show", "node", m.group(1), "-o"],
         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
     ).stdout.decode("utf-8")
-    best = {}
+    free = {}
     for line in out.splitlines():
+        name = re.search(r"\bNodeName=(\S+)", line)
         state = re.search(r"\bState=(\S+)", line)
-        if state and re.search(r"DOWN|DRAIN|FAIL|COMP|MAINT|NOT_RESPOND", state.group(1)):
+        if not name or state and re.search(r"DOWN|DRAIN|FAIL|COMP|MAINT|NOT_RESPOND", state.group(1)):
             continue
         cfg_m = re.search(r"\bCfgTRES=(\S*)", line)
         alloc_m = re.search(r"\bAllocTRES=(\S*)", line)
@@ -155,47 +285,197 @@ def _reservation_free_by_type(reservation):
                re.findall(r"gres/gpu:(\w+)=(\d+)", cfg_m.group(1) if cfg_m else "")}
         used = {t: int(n) for t, n in
                 re.findall(r"gres/gpu:(\w+)=(\d+)", alloc_m.group(1) if alloc_m else "")}
-        for t, n in cfg.items():
-            best[t] = max(best.get(t, 0), n - used.get(t, 0))
-    return best
+        free[name.group(1)] = {t: n - used.get(t, 0) for t, n in cfg.items()}
+    return free
 
-def pick_spill_gpu_type(logger, queue, preferred, gpu_count, partition, reservation=None):
+class ClusterSnapshot:
+    """Cluster state shared by all GPU spill decisions within a poll: free GPUs
+    per type on each node of a partition or reservation, and pending jobs per
+    GPU type in a partition. Each part is read lazily, at most once per
+    snapshot. Decisions claim the GPUs they take (see `claim`), so later jobs in
+    the same poll see that capacity as used instead of all landing on the same
+    free node."""
+    def __init__(self):
+        self.created = time.time()
+        # Held for a whole spill decision, so concurrent submissions read and
+        # claim capacity one at a time
+        self.lock = threading.Lock()
+        self._partitions = {}    # partition -> {node: {gpu_type: free}}
+        self._reservations = {}  # reservation -> {node: {gpu_type: free}}
+        self._pending = {}       # partition -> {gpu_type: pending jobs}
+
+    def expired(self):
+        return time.time() - self.created > CLUSTER_SNAPSHOT_TTL
+
+    def partition_free(self, partition):
+        if partition not in self._partitions:
+            with metrics.timer('spill_check', f'sinfo -p {partition}'):
+                self._partitions[partition] = _free_by_node(partition)
+        return self._partitions[partition]
+
+    def reservation_free(self, reservation):
+        if reservation not in self._reservations:
+            with metrics.timer('spill_check', f'scontrol show reservation {reservation}'):
+                self._reservations[reservation] = _reservation_free_by_node(reservation)
+        return self._reservations[reservation]
+
+    def pending(self, partition):
+        if partition not in self._pending:
+            with metrics.timer('spill_check', f'squeue -p {partition} -t PD'):
+                self._pending[partition] = _pending_gpu_jobs_by_type(partition)
+        return self._pending[partition]
+
+    def copy(self):
+        """A snapshot with copies of the state read so far, for decisions
+        whose claims shouldn't count (see gpu_waits.report)."""
+        other = ClusterSnapshot()
+        other.created = self.created
+        other._partitions = copy.deepcopy(self._partitions)
+        other._reservations = copy.deepcopy(self._reservations)
+        other._pending = copy.deepcopy(self._pending)
+        return other
+
+    @staticmethod
+    def fits(nodes, gpu_type, gpu_count):
+        """True if a single node of `nodes` has `gpu_count` free GPUs of
+        `gpu_type`."""
+        return any(free.get(gpu_type, 0) >= gpu_count for free in nodes.values())
+
+    @staticmethod
+    def claim(nodes, gpu_type, gpu_count):
+        """Take `gpu_count` GPUs of `gpu_type` on a single node of `nodes` (as
+        returned by `partition_free`/`reservation_free`), picking the node that
+        fits most tightly. Returns False if no node has room."""
+        fits = [(free[gpu_type], node) for node, free in nodes.items()
+                if free.get(gpu_type, 0) >= gpu_count]
+        if not fits:
+            return False
+        _, node = min(fits)
+        nodes[node][gpu_type] -= gpu_count
+        return True
+
+def _predicted_spill(logger, queue, preferred, gpu_count, partition, free,
+                     pending, hours, history):
+    """The GPU type with the earliest expected start, each fallback step in
+    GPU_SPILL_FALLBACK costing GPU_SPILL_STEP_SECONDS on top. A type with room
+    on the partition starts now; otherwise its wait is predicted by `history`
+    from the jobs pending on it. `preferred` is known not to start now.
+    Returns (type, {type: expected wait}), or None if there is no prediction
+    for `preferred`."""
+    short = gpu_waits.is_short(hours)
+    waits = {preferred: history.predict(
+        partition, preferred, gpu_count, short, pending.get(preferred, 0)
+    )}
+    if waits[preferred] is None:
+        return None
+    step = GPU_SPILL_STEP_SECONDS.get(queue, GPU_SPILL_STEP_SECONDS_DEFAULT)
+    best, best_score = preferred, waits[preferred]
+    for rank, alt in enumerate(GPU_SPILL_FALLBACK.get(queue, []), 1):
+        if ClusterSnapshot.fits(free, alt, gpu_count):
+            waits[alt] = 0.0
+        else:
+            waits[alt] = history.predict(partition, alt, gpu_count, short, pending.get(alt, 0))
+        if waits[alt] is not None and waits[alt] + rank * step < best_score:
+            best, best_score = alt, waits[alt] + rank * step
+    return best, waits
+
+def pick_spill_gpu_type(logger, queue, preferred, gpu_count, partition,
+                        snapshot, reservation=None, hours=None, history=None,
+                        policy=None, decision=None):
     """Submit-time decision. Return a fallback GPU type to spill to, or None to
-    keep `preferred`. Spill only when `preferred` can't start now on the open
-    partition or the job's `reservation`, more than the queue threshold are
-    pending on it, and a cheaper-first fallback can start now on the partition.
-    Otherwise keep `preferred`. On any Slurm query error, return None."""
+    keep `preferred`. Never spill when `preferred` can start now on the open
+    partition or the job's `reservation`. Otherwise, under the queue's
+    GPU_SPILL_POLICY (or `policy`):
+      'threshold': spill only when more than the queue threshold are pending
+        on `preferred` and a cheaper-first fallback can start now on the
+        partition.
+      'predict': pick the type with the earliest expected start for a job of
+        `hours`, as predicted by `history` (see `_predicted_spill`); use the
+        threshold rule while there is no prediction for `preferred`.
+      'shadow': the threshold rule, logging what 'predict' would have chosen.
+    Capacity comes from `snapshot` and the chosen GPUs (or the pending slot)
+    are claimed in it. If the job has to queue, `decision['depth']` is set to
+    the number of jobs pending ahead of it on the chosen type. On any Slurm
+    query error, return None."""
+    def queue_behind(gpu_type):
+        depth = pending.get(gpu_type, 0)
+        if decision is not None:
+            decision['depth'] = depth
+        pending[gpu_type] = depth + 1
+
     threshold = GPU_SPILL_PENDING_THRESHOLD.get(
         queue, GPU_SPILL_PENDING_THRESHOLD_DEFAULT
     )
+    policy = policy or GPU_SPILL_POLICY.get(queue, 'threshold')
     try:
-        free = _max_free_by_type(partition)
-        preferred_free = free.get(preferred, 0)
-        if preferred_free < gpu_count and reservation:
-            resv_free = _reservation_free_by_type(reservation)
-            preferred_free = max(preferred_free, resv_free.get(preferred, 0))
-        if preferred_free >= gpu_count:
-            return None
-        pending = _pending_gpu_jobs(preferred, partition)
-        if pending <= threshold:
-            return None
-        for alt in GPU_SPILL_FALLBACK.get(queue, []):
-            if free.get(alt, 0) >= gpu_count:
-                logger.info(
-                    f"{preferred} congested ({pending} pending > {threshold}, "
-                    f"< {gpu_count} free/node); spilling to {alt}"
+        # Before taking the snapshot lock: a refresh reads days of sacct,
+        # and the lock serializes every GPU submission
+        if policy in ('predict', 'shadow') and history is not None:
+            with metrics.timer('spill_check', 'sacct'):
+                history.refresh(logger)
+        with snapshot.lock:
+            free = snapshot.partition_free(partition)
+            if snapshot.claim(free, preferred, gpu_count):
+                return None
+            if reservation and snapshot.claim(
+                snapshot.reservation_free(reservation), preferred, gpu_count
+            ):
+                return None
+            pending = snapshot.pending(partition)
+            npending = pending.get(preferred, 0)
+
+            predicted = None
+            if policy in ('predict', 'shadow') and history is not None:
+                predicted = _predicted_spill(
+                    logger, queue, preferred, gpu_count, partition, free, pending,
+                    hours, history,
                 )
-                return alt
-        logger.info(
-            f"{preferred} congested ({pending} pending) but no fallback type has "
-            f"{gpu_count} free/node; keeping {preferred}"
-        )
-        return None
+            if predicted is not None:
+                choice, waits = predicted
+                expected = ', '.join(
+                    f"{t} {'?' if w is None else f'{w / 60:.0f}'} min" for t, w in waits.items()
+                )
+                if policy == 'shadow':
+                    logger.info(f"Predicted spill choice for {gpu_count} GPUs: {choice} ({expected})")
+                else:
+                    if choice == preferred:
+                        queue_behind(preferred)
+                        return None
+                    if not snapshot.claim(free, choice, gpu_count):
+                        queue_behind(choice)
+                    logger.info(
+                        f"{preferred} congested ({npending} pending, < {gpu_count} free/node); "
+                        f"spilling to {choice}, expected start: {expected}"
+                    )
+                    metrics.count('spilled')
+                    return choice
+
+            if npending <= threshold:
+                queue_behind(preferred)
+                return None
+            for alt in GPU_SPILL_FALLBACK.get(queue, []):
+                if snapshot.claim(free, alt, gpu_count):
+                    logger.info(
+                        f"{preferred} congested ({npending} pending > {threshold}, "
+                        f"< {gpu_count} free/node); spilling to {alt}"
+                    )
+                    metrics.count('spilled')
+                    return alt
+            logger.info(
+                f"{preferred} congested ({npending} pending) but no fallback type has "
+                f"{gpu_count} free/node; keeping {preferred}"
+            )
+            queue_behind(preferred)
+            return None
     except Exception as e:
         logger.warning(f"GPU spill check failed ({e}); keeping {preferred}")
         return None
 
 class JobScheduler:
+    def __init__(self):
+        self._runtimes = None
+        self._runtimes_lock = threading.Lock()
+
     def submit_job(self, logger, build_log_dir, job):
         raise NotImplementedError("Subclass must implement submit_job")
 
@@ -205,12 +485,215 @@ class JobScheduler:
     def current_jobs(self, logger):
         raise NotImplementedError("Subclass must implement current_jobs")
 
+    def user_job_limit(self, logger):
+        """Max jobs of the service account the scheduler works with, or None
+        if it sets no limit."""
+        return None
+
+    def stuck_jobs(self, logger, current_jobs):
+        """(buildkite url, SchedulerJob) of the pending jobs in `current_jobs`
+        to cancel and submit again differently, see remediation.py."""
+        return []
+
+    def requested_resources(self, logger, job):
+        """The `Resources` a buildkite job asks for through its tags."""
+        raise NotImplementedError("Subclass must implement requested_resources")
+
+    def finished_runtimes(self, logger, job_ids):
+        """{job id: (final state, elapsed seconds)} for those of `job_ids`
+        that finished, from the scheduler's accounting."""
+        raise NotImplementedError("Subclass must implement finished_runtimes")
+
+    def job_accounting(self, logger, job_ids):
+        """{job id: (partition, GPU type or None, submit, start, end, state)}
+        for those of `job_ids` the scheduler's accounting knows, with epoch
+        times (None until they happen) and Slurm state names."""
+        raise NotImplementedError("Subclass must implement job_accounting")
+
+    def runtime_history(self, logger):
+        """The step runtime history, opened on first use."""
+        with self._runtimes_lock:
+            if self._runtimes is None:
+                self._runtimes = runtimes.RuntimeHistory()
+            return self._runtimes
+
+    def refresh_histories(self, logger):
+        """Update the histories the submit path reads, once per poll before
+        its round starts, so no submission waits on days of accounting. Each
+        history is only re-read every REFRESH_SECONDS of its module."""
+        try:
+            history = self.runtime_history(logger)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to open the runtime history: {e}")
+            return
+        with metrics.timer('runtime_history'):
+            history.refresh(logger, self.finished_runtimes)
+
+    def time_limit(self, logger, job):
+        """The time limit of `job` when its tags don't set one: the limit
+        learned from its step's past runtimes when that is shorter than
+        DEFAULT_TIMELIMIT, else DEFAULT_TIMELIMIT."""
+        step = runtimes.job_step(job)
+        if step is None:
+            return DEFAULT_TIMELIMIT
+        try:
+            limit = self.runtime_history(logger).limit_seconds(*step)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to open the runtime history: {e}")
+            return DEFAULT_TIMELIMIT
+        if limit is None or limit >= time_limit_hours(DEFAULT_TIMELIMIT) * 3600:
+            return DEFAULT_TIMELIMIT
+        return runtimes.format_time_limit(limit)
+
+    def record_runtime(self, logger, hpc_job_id, job):
+        """Record a submission in the step runtime history."""
+        step = runtimes.job_step(job)
+        if step is None:
+            return
+        try:
+            self.runtime_history(logger).record_submit(hpc_job_id, *step)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to record the submission in the runtime history: {e}")
+
 class SlurmJobScheduler(JobScheduler):
+    def __init__(self):
+        super().__init__()
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._user_job_limit = (None, 0.0)
+        self._wait_history = None
+        self._remediations = None
+        self._node_health = None
+        self._usage_history = None
+        self.pilots = pilots.PilotPool() if BUILDKITE_QUEUE in pilots.PILOT_QUEUES else None
+
+    def wait_history(self):
+        """The GPU wait history, opened on first use."""
+        with self._snapshot_lock:
+            if self._wait_history is None:
+                self._wait_history = gpu_waits.GpuWaitHistory()
+            return self._wait_history
+
+    def remediations(self):
+        """The remediation store, opened on first use."""
+        with self._snapshot_lock:
+            if self._remediations is None:
+                self._remediations = remediation.RemediationStore()
+            return self._remediations
+
+    def health_tracker(self, logger):
+        """The node health tracker, opened on first use. None if it can't be
+        opened."""
+        with self._snapshot_lock:
+            if self._node_health is None:
+                try:
+                    self._node_health = node_health.NodeHealth()
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to open the node health: {e}")
+                    return None
+            return self._node_health
+
+    def exclude_nodes(self, logger):
+        """The manual exclude list plus the nodes the node health tracker
+        quarantined as of its last refresh."""
+        health = self.health_tracker(logger)
+        quarantined = health.quarantined if health is not None else []
+        return node_health.merge_exclude(get_exclude_nodes(), quarantined)
+
+    def usage_history(self, logger):
+        """The usage history of our jobs, opened on first use. None if it
+        can't be opened."""
+        with self._snapshot_lock:
+            if self._usage_history is None:
+                try:
+                    self._usage_history = job_usage.UsageHistory()
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to open the usage history: {e}")
+                    return None
+            return self._usage_history
+
+    def refresh_histories(self, logger):
+        super().refresh_histories(logger)
+        health = self.health_tracker(logger)
+        if health is not None:
+            with metrics.timer('node_health'):
+                health.refresh(logger)
+        history = self.usage_history(logger)
+        if history is not None:
+            with metrics.timer('usage_history'):
+                history.refresh(logger)
+
+    def right_size(self, logger, job, queue, tags, slurm_keys):
+        """Lower the slurm_mem and slurm_cpus_per_task of `slurm_keys` to
+        what the job's step needs, by its past usage, when they ask for more
+        (see RIGHT_SIZING_POLICY). Never raises a request, and never sets one
+        the tags don't."""
+        policy = RIGHT_SIZING_POLICY.get(queue, 'off')
+        if policy == 'off' or tags.get('right_size', 'true') == 'false':
+            return
+        step = runtimes.job_step(job)
+        history = self.usage_history(logger) if step is not None else None
+        if history is None:
+            return
+        recommendation = history.recommendation(*step)
+        changes = {}
+        requested_mem = job_usage.parse_mem_mb(slurm_keys.get('slurm_mem'))
+        if requested_mem and recommendation.get('mem_mb', requested_mem) < requested_mem:
+            changes['slurm_mem'] = job_usage.format_mem(recommendation['mem_mb'])
+        try:
+            requested_cpus = int(slurm_keys.get('slurm_cpus_per_task', 0))
+        except ValueError:
+            requested_cpus = 0
+        if recommendation.get('cpus_per_task', requested_cpus) < requested_cpus:
+            changes['slurm_cpus_per_task'] = str(recommendation['cpus_per_task'])
+        if not changes:
+            return
+        summary = ', '.join(f"{key} {slurm_keys[key]} -> {value}" for key, value in changes.items())
+        if policy == 'shadow':
+            logger.info(f"Right-sizing would change {job.web_url}: {summary}")
+            return
+        logger.info(f"Right-sizing {job.web_url}: {summary}")
+        metrics.count('right_sized')
+        slurm_keys.update(changes)
+
+    def cluster_snapshot(self):
+        """The current ClusterSnapshot, replaced once it is older than
+        CLUSTER_SNAPSHOT_TTL."""
+        with self._snapshot_lock:
+            if self._snapshot is None or self._snapshot.expired():
+                self._snapshot = ClusterSnapshot()
+            return self._snapshot
+
     def submit_job(self, logger, build_log_dir, job):
-        job_id = job['id']
-        buildkite_url = job['web_url']
+        # Earlier submissions of the job that got stuck pending
+        try:
+            remediations = self.remediations().remediations(job.web_url)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to read the remediations of {job.web_url}: {e}")
+            remediations = []
+        actions = [action for action, _, _ in remediations]
+
+        if self.pilots is not None and not actions:
+            pilot_job_id = self.submit_to_pilot(logger, build_log_dir, job)
+            if pilot_job_id is not None:
+                return pilot_job_id
+
+        job_id = job.id
+        buildkite_url = job.web_url
         tags = get_buildkite_job_tags(job)
         queue = tags['queue']
+        if remediation.FAIL in actions:
+            _, stuck_job_id, reason = remediations[-1]
+            self.submit_error(
+                logger, build_log_dir, job, queue,
+                f"Slurm job {stuck_job_id} was stuck pending ({reason}) "
+                f"after {len(actions) - 1} resubmissions",
+            )
+            return None
+        remediated_gpu_type = next((
+            action[len(remediation.GPU_TYPE_PREFIX):] for action in reversed(actions)
+            if action.startswith(remediation.GPU_TYPE_PREFIX)
+        ), None)
         cmd = [
             'sbatch',
             '--parsable',
@@ -219,18 +702,25 @@ class SlurmJobScheduler(JobScheduler):
             f"--output={joinpath(build_log_dir, 'slurm-%j.log')}",
         ]
         slurm_keys = {k: v for k, v in tags.items() if k.startswith('slurm_')}
+        self.right_size(logger, job, queue, tags, slurm_keys)
         default_gpu_type = DEFAULT_GPU_TYPES.get(queue)
+        time_limit = slurm_keys.get('slurm_time') or self.time_limit(logger, job)
 
         # No reservation, add default if job has < 3 GPUs. Larger jobs can
         # run outside the reservation. Don't attach the GPU reservation to a job
         # that explicitly requests a different GPU type (e.g. L40S): it can never
         # run on the reservation's nodes, and would otherwise sit at the head of
-        # the queue holding a reservation it can't use.
+        # the queue holding a reservation it can't use. The same goes for a
+        # job rerouted to another GPU type, and a job that got stuck pending
+        # under the reservation is submitted without it (see remediation.py).
         added_gpu_reservation = False
-        if 'slurm_reservation' not in slurm_keys and queue not in NO_RESERVATION_QUEUES:
+        if ('slurm_reservation' not in slurm_keys and queue not in NO_RESERVATION_QUEUES
+                and remediation.NO_RESERVATION not in actions):
             if gpu_is_requested(slurm_keys) and get_gpu_count(slurm_keys) < 3:
                 gpu_type = get_gpu_type(slurm_keys)
-                if default_gpu_type is None or gpu_type is None or gpu_type == default_gpu_type:
+                if remediated_gpu_type is None and (
+                    default_gpu_type is None or gpu_type is None or gpu_type == default_gpu_type
+                ):
                     slurm_keys['slurm_reservation'] = DEFAULT_GPU_RESERVATIONS[queue]
                     added_gpu_reservation = True
             elif not gpu_is_requested(slurm_keys):
@@ -241,20 +731,33 @@ class SlurmJobScheduler(JobScheduler):
 
         # If the queue has a default GPU type, set --gres=gpu:type:N
         # Only add if user hasn't explicitly set gres
+        wait_sample = None
         if gpu_is_requested(slurm_keys) and default_gpu_type and 'slurm_gres' not in slurm_keys:
             gpu_count = get_gpu_count(slurm_keys)
             gpu_partition = DEFAULT_GPU_PARTITIONS.get(queue)
             # Only spill under the auto-added FLEX reservation or no reservation;
             # an explicit user reservation may not be FLEX, so don't override it.
             spill_type = None
-            if added_gpu_reservation or 'slurm_reservation' not in slurm_keys:
+            hours = time_limit_hours(slurm_keys.get('slurm_time', time_limit))
+            if remediated_gpu_type is not None:
+                spill_type = remediated_gpu_type
+            elif added_gpu_reservation or 'slurm_reservation' not in slurm_keys:
                 reservation = (
                     slurm_keys['slurm_reservation'] if added_gpu_reservation else None
                 )
+                spill_decision = {}
                 spill_type = pick_spill_gpu_type(
                     logger, queue, default_gpu_type, gpu_count, gpu_partition,
-                    reservation,
+                    self.cluster_snapshot(), reservation, hours, self.wait_history(),
+                    decision=spill_decision,
                 )
+                # A job that has to queue is a sample for the wait history
+                if 'depth' in spill_decision:
+                    wait_sample = (
+                        gpu_partition, spill_type or default_gpu_type, gpu_count,
+                        gpu_waits.is_short(hours),
+                        spill_decision['depth'],
+                    )
             gpu_type = spill_type or default_gpu_type
             slurm_keys['slurm_gres'] = f"gpu:{gpu_type}:{gpu_count}"
             # Remove slurm_gpus to avoid conflict with --gres (--gpus and --gres conflict)
@@ -278,11 +781,12 @@ class SlurmJobScheduler(JobScheduler):
         cmd.append(f"--partition={agent_partition}")
 
         use_exclude = tags.get('exclude', 'true')
-        if use_exclude == 'true' and BUILDKITE_EXCLUDE_NODES:
-            cmd.append(f"--exclude={BUILDKITE_EXCLUDE_NODES}")
+        exclude_nodes = self.exclude_nodes(logger) if use_exclude == 'true' else None
+        if exclude_nodes:
+            cmd.append(f"--exclude={exclude_nodes}")
 
         if "slurm_time" not in slurm_keys:
-            cmd.append(f"--time={DEFAULT_TIMELIMIT}")
+            cmd.append(f"--time={time_limit}")
 
         cmd.append(joinpath(BUILDKITE_PATH, 'bin/schedule_job.sh'))
         cmd.append(job_id)
@@ -303,45 +807,62 @@ class SlurmJobScheduler(JobScheduler):
             slurm_job_id = int(result.stdout)
             log_path = joinpath(build_log_dir, f'slurm-{slurm_job_id}.log')
             logger.info(f"Slurm job submitted, ID: {slurm_job_id}, log: {log_path}")
+            if wait_sample:
+                try:
+                    self.wait_history().record_submit(slurm_job_id, *wait_sample)
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to record GPU wait sample: {e}")
+            self.record_runtime(logger, slurm_job_id, job)
+            return slurm_job_id
 
         except subprocess.CalledProcessError as e:
-            # TODO: Run a minimal failing slurm job to return the error to buildkite
             logger.error(
                 f"Slurm error during job submission, retcode={e.returncode}:\n{e.stderr}"
             )
+            self.submit_error(logger, build_log_dir, job, queue, e.stderr)
+            return None
 
-            error_cmd = [
-                'sbatch',
-                '--parsable',
-                "--job-name=bk_error",
-                "--time=00:01:00",
-                "--ntasks=1",
-                f'--comment={buildkite_url}',
-                f"--output={joinpath(build_log_dir, 'slurm-%j.log')}",
-            ]
-            
-            default_reservation = DEFAULT_RESERVATIONS.get(queue, None)
-            if default_reservation:
-                error_cmd.append(f"--reservation={default_reservation}")
-            error_cmd.append(joinpath(BUILDKITE_PATH, 'bin/schedule_job.sh'))
-            error_cmd.append(job_id)
-            error_cmd.append("")
-            error_cmd.append(e.stderr)
-            try:
-                subprocess.run(
-                    error_cmd,
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    universal_newlines=True
-                )
-            except:
-                logger.error("Failed to submit error job to Slurm")
+    def submit_error(self, logger, build_log_dir, job, queue, error):
+        """Submit a minimal Slurm job that runs `job` only to fail it with
+        `error` (see hooks/environment), so the step fails in buildkite."""
+        error_cmd = [
+            'sbatch',
+            '--parsable',
+            "--job-name=bk_error",
+            "--time=00:01:00",
+            "--ntasks=1",
+            f'--comment={job.web_url}',
+            f"--output={joinpath(build_log_dir, 'slurm-%j.log')}",
+        ]
+
+        default_reservation = DEFAULT_RESERVATIONS.get(queue, None)
+        if default_reservation:
+            error_cmd.append(f"--reservation={default_reservation}")
+        error_cmd.append(joinpath(BUILDKITE_PATH, 'bin/schedule_job.sh'))
+        error_cmd.append(job.id)
+        error_cmd.append("")
+        error_cmd.append(error)
+        try:
+            subprocess.run(
+                error_cmd,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                universal_newlines=True
+            )
+        except:
+            logger.error("Failed to submit error job to Slurm")
 
     def cancel_jobs(self, logger, job_ids):
         cmd = ['scancel', '--name=buildkite']
-        # Flatten list of lists
-        cmd.extend([x for sublist in job_ids for x in sublist])
+        # Flatten list of lists of SchedulerJobs
+        job_ids = [x.id for sublist in job_ids for x in sublist]
+        if self.pilots is not None:
+            self.pilots.cancel(logger, [j for j in job_ids if pilots.is_pilot_id(j)])
+            job_ids = [j for j in job_ids if not pilots.is_pilot_id(j)]
+            if not job_ids:
+                return
+        cmd.extend(job_ids)
         try:
             logger.info(f"Canceling {len(job_ids)} Slurm jobs")
             logger.debug(cmd)
@@ -358,24 +879,296 @@ class SlurmJobScheduler(JobScheduler):
             logger.error(f"stderr: {e.stderr}")
 
     def current_jobs(self, logger):
+        # tres-alloc is what a running job holds, or what a pending one asks
+        # for. The comment (our buildkite url) goes last, it may contain '|'.
         squeue = subprocess.run(['squeue',
                             '--name=buildkite',
                             '--noheader',
-                            '--format=%k,%A'],
+                            '--Format=JobID:32|,TimeLimit:16|,tres-alloc:256|,StateCompact:8|,'
+                            'Reason:64|,SubmitTime:24|,Reservation:64|,Comment:1024'],
                         stdout=subprocess.PIPE)
 
         current_jobs = dict()
 
         for line in squeue.stdout.decode('utf-8').splitlines():
-            buildkite_url, slurm_job_id = line.split(',', 1)
-            current_jobs.setdefault(buildkite_url, []).append(slurm_job_id)
+            (slurm_job_id, time_limit, tres, state, reason, submit_time, reservation,
+             buildkite_url) = (field.strip() for field in line.split('|', 7))
+            try:
+                submit_time = time.mktime(time.strptime(submit_time, '%Y-%m-%dT%H:%M:%S'))
+            except ValueError:
+                submit_time = None
+            job = SchedulerJob(
+                slurm_job_id, self.tres_resources(tres, time_limit), state == 'PD',
+                state=state, reason=reason, submit_time=submit_time, tres=tres,
+                reservation=reservation if reservation not in ('', '(null)') else None,
+            )
+            current_jobs.setdefault(buildkite_url, []).append(job)
+
+        # Jobs queued in (or taken by) a pilot allocation
+        if self.pilots is not None:
+            for pilot_job_id, buildkite_url, resources in self.pilots.refresh(logger):
+                # Still in the inbox, rather than the pilot's current job
+                pending = not pilot_job_id.endswith('/current')
+                try:
+                    job = SchedulerJob(
+                        pilot_job_id, Resources.from_dict(json.loads(resources)), pending
+                    )
+                except (ValueError, TypeError, AttributeError):
+                    job = SchedulerJob(pilot_job_id, pending=pending)
+                current_jobs.setdefault(buildkite_url, []).append(job)
 
         for url in current_jobs.keys():
             if len(current_jobs[url]) > 1:
-                logger.warning(f"{url} has multiple slurmjobs: {current_jobs[url]})")
+                logger.warning(f"{url} has multiple slurmjobs: {[j.id for j in current_jobs[url]]})")
 
         return current_jobs
 
+    def stuck_jobs(self, logger, current_jobs):
+        stuck = {
+            job.id: (url, job, remediation.stuck_reason(job.reason))
+            for url, jobs in current_jobs.items() for job in jobs
+            if job.pending and remediation.stuck_reason(job.reason)
+        }
+        try:
+            store = self.remediations()
+            since = store.stuck_since(list(stuck))
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to update the stuck jobs: {e}")
+            return []
+
+        due = []
+        for job_id, (url, job, reason) in stuck.items():
+            if time.time() - since[job_id] < remediation.STUCK_SECONDS:
+                continue
+            try:
+                actions = [action for action, _, _ in store.remediations(url)]
+                action = self.remediation_action(BUILDKITE_QUEUE, job, actions)
+                store.record(url, action, job_id, reason)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to record the remediation of {url}: {e}")
+                continue
+            logger.warning(
+                f"Slurm job {job_id} stuck pending ({job.reason}) since "
+                f"{time.ctime(since[job_id])}, resubmitting {url} with {action}"
+            )
+            due.append((url, job))
+        return due
+
+    def remediation_action(self, queue, job, actions):
+        """How to submit `job`, stuck pending, again: without the reservation
+        we added, on the next GPU type of GPU_SPILL_FALLBACK, or as a failure
+        once those are used up or it had MAX_REMEDIATIONS already."""
+        if len(actions) >= remediation.MAX_REMEDIATIONS:
+            return remediation.FAIL
+        if (remediation.NO_RESERVATION not in actions and job.reservation is not None
+                and job.reservation in (DEFAULT_RESERVATIONS.get(queue),
+                                        DEFAULT_GPU_RESERVATIONS.get(queue))):
+            return remediation.NO_RESERVATION
+        gpu_type = re.search(r'gres/gpu:([^=,]+)=', job.tres or '')
+        if gpu_type:
+            for alt in GPU_SPILL_FALLBACK.get(queue, []):
+                action = remediation.GPU_TYPE_PREFIX + alt
+                if alt != gpu_type.group(1) and action not in actions:
+                    return action
+        return remediation.FAIL
+
+    def submit_to_pilot(self, logger, build_log_dir, job):
+        """Queue `job` in a pilot allocation of its shape if it is a short CPU
+        job (see pilots.py). Returns its hpc job id, or None to submit it on
+        its own."""
+        tags = get_buildkite_job_tags(job)
+        slurm_keys = {k: v for k, v in tags.items() if k.startswith('slurm_')}
+        pilot_tag = tags.get('pilot', '').lower()
+        if pilot_tag == 'false' or gpu_is_requested(slurm_keys):
+            return None
+        hours = time_limit_hours(slurm_keys.get('slurm_time') or self.time_limit(logger, job))
+        seconds = hours * 3600 if hours is not None else None
+        if pilot_tag != 'true' and (seconds is None or seconds > pilots.PILOT_MAX_JOB_SECONDS):
+            return None
+        seconds = min(seconds or pilots.PILOT_MAX_JOB_SECONDS, pilots.PILOT_MAX_JOB_SECONDS)
+
+        def start_pilot(logger, name, path):
+            return self.start_pilot(logger, tags, name, path)
+        try:
+            pilot_job_id = self.pilots.dispatch(
+                logger, pilots.job_shape(tags), start_pilot,
+                job.id, seconds, build_log_dir, tags.get('modules', ''), job.web_url,
+                json.dumps(self.requested_resources(logger, job).as_dict()),
+            )
+        except OSError as e:
+            logger.warning(f"Failed to queue {job.web_url} in a pilot: {e}")
+            return None
+        if pilot_job_id is not None:
+            logger.info(f"Queued in pilot {pilot_job_id}, log: {build_log_dir}")
+            metrics.count('piloted')
+        return pilot_job_id
+
+    def start_pilot(self, logger, tags, name, path):
+        """sbatch a pilot allocation for jobs with `tags` (see pilots.py).
+        Returns its Slurm job id, or None."""
+        queue = tags['queue']
+        cmd = [
+            'sbatch',
+            '--parsable',
+            f"--job-name={pilots.PILOT_JOB_NAME}",
+            f'--comment={name}',
+            f"--output={joinpath(path, 'slurm-%j.log')}",
+            f"--time={pilots.PILOT_TIMELIMIT}",
+        ]
+        slurm_keys = {
+            k: v for k, v in tags.items() if k.startswith('slurm_') and k != 'slurm_time'
+        }
+        if 'slurm_reservation' not in slurm_keys and queue not in NO_RESERVATION_QUEUES:
+            slurm_keys['slurm_reservation'] = DEFAULT_RESERVATIONS[queue]
+        elif slurm_keys.get("slurm_reservation", "").lower() == "false":
+            del slurm_keys['slurm_reservation']
+        for key, value in slurm_keys.items():
+            cmd.append(self.format_resource(key, value))
+        cmd.append(f"--partition={tags.get('partition', DEFAULT_PARTITIONS[queue])}")
+        exclude_nodes = self.exclude_nodes(logger) if tags.get('exclude', 'true') == 'true' else None
+        if exclude_nodes:
+            cmd.append(f"--exclude={exclude_nodes}")
+
+        # Stop taking jobs a minute before the allocation ends
+        limit = int(time_limit_hours(pilots.PILOT_TIMELIMIT) * 3600) - 60
+        cmd.extend([
+            joinpath(BUILDKITE_PATH, 'bin/pilot_job.sh'),
+            path, str(pilots.PILOT_IDLE_SECONDS), str(limit),
+        ])
+        logger.debug(f"Pilot command: {' '.join(cmd)}")
+        try:
+            result = subprocess.run(
+                cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True,
+            )
+            slurm_job_id = int(result.stdout)
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logger.error(f"Failed to start a pilot for {pilots.job_shape(tags) or 'default'} jobs: {e}")
+            return None
+        logger.info(f"Pilot {name} submitted, ID: {slurm_job_id}")
+        return slurm_job_id
+
+    def tres_resources(self, tres, time_limit):
+        """`Resources` from a TRES string such as
+        'cpu=4,mem=16G,node=1,billing=4,gres/gpu=2' and a time limit."""
+        counts = {}
+        for item in tres.split(','):
+            name, _, value = item.partition('=')
+            if value.isdigit():
+                counts[name] = int(value)
+        cpus = counts.get('cpu', 1)
+        hours = time_limit_hours(time_limit) or time_limit_hours(DEFAULT_TIMELIMIT)
+        return Resources(1, counts.get('gres/gpu', 0), counts.get('node', 1), cpus * hours)
+
+    def requested_resources(self, logger, job):
+        """The resources the sbatch command of `job` asks for, from its
+        slurm_* tags: GPUs as in `get_gpu_count` (or the count in slurm_gres,
+        per node), the minimum node count, tasks times CPUs per task, and
+        the time limit (see `time_limit`)."""
+        slurm_keys = {
+            k: v for k, v in get_buildkite_job_tags(job).items() if k.startswith('slurm_')
+        }
+        try:
+            nodes = int(slurm_keys.get('slurm_nodes', '1').split('-')[0])
+            if 'slurm_ntasks_per_node' in slurm_keys and 'slurm_ntasks' not in slurm_keys:
+                ntasks = nodes * int(slurm_keys['slurm_ntasks_per_node'])
+            else:
+                ntasks = int(slurm_keys.get('slurm_ntasks', 1))
+            cpus = ntasks * int(slurm_keys.get('slurm_cpus_per_task', 1))
+            gpus = 0
+            if gpu_is_requested(slurm_keys):
+                gres = slurm_keys.get('slurm_gres', '').split(':')
+                if gres[0] == 'gpu' and len(gres) > 1 and gres[-1].isdigit():
+                    gpus = int(gres[-1]) * nodes
+                else:
+                    gpus = get_gpu_count(slurm_keys)
+        except ValueError:
+            # sbatch will reject these tags; count the job on its own
+            return Resources(jobs=1)
+        hours = (time_limit_hours(slurm_keys.get('slurm_time') or self.time_limit(logger, job))
+                 or time_limit_hours(DEFAULT_TIMELIMIT))
+        return Resources(1, gpus, nodes, cpus * hours)
+
+    def finished_runtimes(self, logger, job_ids):
+        """Final state (the first word of sacct's, e.g. 'CANCELLED' of
+        'CANCELLED by 1234') and elapsed seconds of the finished `job_ids`."""
+        try:
+            out = subprocess.run(
+                ['sacct', '-X', '--noheader', '--parsable2', '-j', ','.join(job_ids),
+                 '--format=JobIDRaw,State,ElapsedRaw'],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Failed to read job runtimes from sacct: {e}")
+            return {}
+        finished = {}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) < 3 or not fields[2].isdigit():
+                continue
+            job_id, state, elapsed = fields[:3]
+            state = state.split()[0] if state else ''
+            if state and state not in SLURM_ACTIVE_STATES:
+                finished[job_id] = (state, int(elapsed))
+        return finished
+
+    def job_accounting(self, logger, job_ids):
+        job_ids = [j for j in job_ids if not pilots.is_pilot_id(j)]
+        if not job_ids:
+            return {}
+        try:
+            out = subprocess.run(
+                ['sacct', '-X', '--noheader', '--parsable2', '-j', ','.join(job_ids),
+                 '--format=JobIDRaw,Partition,AllocTRES,Submit,Start,End,State'],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Failed to read job accounting from sacct: {e}")
+            return {}
+
+        accounting = {}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) < 7:
+                continue
+            job_id, partition, tres, submit, start, end, state = fields[:7]
+            gpu_type = re.search(r'gres/gpu:([^=,]+)=', tres)
+            accounting[job_id] = (
+                partition, gpu_type.group(1) if gpu_type else None,
+                sacct_time(submit), sacct_time(start), sacct_time(end), state.split()[0] if state else None,
+            )
+        return accounting
+
+    def user_job_limit(self, logger):
+        """The lower of the backfill scheduler's per-user window
+        (bf_max_job_user in SchedulerParameters) and the MaxSubmitJobs of the
+        service account's associations."""
+        limit, checked = self._user_job_limit
+        if time.time() - checked < USER_JOB_LIMIT_TTL:
+            return limit
+
+        limits = []
+        try:
+            config = subprocess.run(
+                ['scontrol', 'show', 'config'],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True,
+            ).stdout
+            match = re.search(r'\bbf_max_job_user=(\d+)', config)
+            if match:
+                limits.append(int(match.group(1)))
+            assoc = subprocess.run(
+                ['sacctmgr', '--noheader', '--parsable2', 'show', 'assoc',
+                 f'user={getpass.getuser()}', 'format=MaxSubmitJobs'],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True,
+            ).stdout
+            limits.extend(int(line) for line in assoc.split() if line.isdigit())
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Failed to read the Slurm per-user job limits: {e}")
+
+        limit = min(limits) if limits else None
+        self._user_job_limit = (limit, time.time())
+        return limit
+
     def format_resource(self, key, value):
         key = key.split('slurm_', 1)[1].replace('_', '-')
         # If the value is 'true', we know this is a flag instead of an argument
@@ -384,12 +1177,16 @@ class SlurmJobScheduler(JobScheduler):
         else:
             return f"--{key}={value}"
 
-DATABASE_FILE = "jobs.db"  # Dict database, maps from pbs jobid to buildkite job url
-
 class PBSJobScheduler(JobScheduler):
+    # PBS has no field to carry the buildkite url (like Slurm's --comment), so
+    # we track which PBS job runs which buildkite job in the job store
+    def __init__(self):
+        super().__init__()
+        self.store = JobStore()
+
     def submit_job(self, logger, build_log_dir, job):
-        job_id = job['id']
-        buildkite_url = job['web_url']
+        job_id = job.id
+        buildkite_url = job.web_url
         tags = get_buildkite_job_tags(job)
         buildkite_queue = tags['queue']
         
@@ -412,15 +1209,16 @@ class PBSJobScheduler(JobScheduler):
         if "pbs_A" not in pbs_tags and default_reservation:
             cmd.extend(["-A", default_reservation])
 
-        if 'pbs_q' not in pbs_tags:
+        pbs_queue = pbs_tags.get('pbs_q')
+        if pbs_queue is None:
             if gpu_is_requested(pbs_tags):
-                default_pbs_queue = DEFAULT_GPU_PARTITIONS[buildkite_queue]
+                pbs_queue = DEFAULT_GPU_PARTITIONS[buildkite_queue]
             else:
-                default_pbs_queue = DEFAULT_PARTITIONS[buildkite_queue]
-            cmd.extend(["-q", default_pbs_queue])
+                pbs_queue = DEFAULT_PARTITIONS[buildkite_queue]
+            cmd.extend(["-q", pbs_queue])
 
         if 'pbs_l_walltime' not in pbs_tags:
-            cmd.extend(["-l", f"walltime={DEFAULT_TIMELIMIT}"])
+            cmd.extend(["-l", f"walltime={self.time_limit(logger, job)}"])
         cmd.extend(["--", joinpath(BUILDKITE_PATH, 'bin/schedule_job.sh'), job_id])
 
         modules = tags.get('modules', "")
@@ -441,25 +1239,34 @@ class PBSJobScheduler(JobScheduler):
         if pbs_job_id:
             logger.info(f"Submitted PBS job {pbs_job_id}, log {log_file}")
             try:
-                with dbm.open(DATABASE_FILE, 'w') as db:
-                    db[buildkite_url] = pbs_job_id
-            except dbm.error as e:
+                self.store.add(
+                    buildkite_url, pbs_job_id, queue=pbs_queue,
+                    resources=self.requested_resources(logger, job).as_dict(),
+                )
+            except sqlite3.Error as e:
                 logger.error(f"Failed to add job to database: {e}")
+            self.record_runtime(logger, pbs_job_id, job)
             return pbs_job_id
         else:
             logger.error(f"Failed to parse PBS job ID from output: {ret.stdout}")
             return None
 
-    # Returns all current jobs, removing those which don't have a running PBS job    
+    # Returns all current jobs, removing those which don't have a running PBS job.
+    # Their resources are the ones requested at submission, kept in the job store.
     def current_jobs(self, logger):
-        current_jobs = {}
         try:
-            with dbm.open(DATABASE_FILE, 'c') as db:
-                for k in db.keys():
-                    current_jobs[k.decode()] = db[k].decode()
-        except dbm.error as e:
+            current_jobs = self.store.current_jobs()
+            resources = self.store.job_resources()
+        except sqlite3.Error as e:
             logger.error(f"Failed to read from database: {e}")
             return {}
+        current_jobs = {
+            url: [
+                SchedulerJob(j, Resources.from_dict(resources[j]) if resources.get(j) else None)
+                for j in job_ids
+            ]
+            for url, job_ids in current_jobs.items()
+        }
 
         try:
             default_pbs_server = DEFAULT_PBS_SERVERS[BUILDKITE_QUEUE]
@@ -468,32 +1275,42 @@ class PBSJobScheduler(JobScheduler):
             logger.error(f"Failed to retrieve PBS job status: {e}")
             return current_jobs
 
-        # Get active PBS job table, strip away header and footer
+        # Get active PBS job table (job id -> state), strip away header and footer
         all_pbs_jobs = qstat_output.split('\n')[2:-1]
-        active_pbs_jobs = []
+        active_pbs_jobs = {}
         for job in all_pbs_jobs:
             [job_id, job_name, user, time, state, queue] = job.split()
             if job_name == "buildkite":
-                active_pbs_jobs.append(job_id.split('.')[0])
-        logger.debug(f"Active PBS jobs: {active_pbs_jobs}")
-        # Remove jobs that are no longer running on PBS
+                active_pbs_jobs[job_id.split('.')[0]] = state
+        logger.debug(f"Active PBS jobs: {list(active_pbs_jobs)}")
+
+        # Remove jobs that are no longer running on PBS, and record the state
+        # of the others
+        finished = []
+        for url, jobs in list(current_jobs.items()):
+            finished.extend(j.id for j in jobs if j.id not in active_pbs_jobs)
+            jobs = [j for j in jobs if j.id in active_pbs_jobs]
+            for j in jobs:
+                j.pending = active_pbs_jobs[j.id] in PBS_PENDING_STATES
+            if jobs:
+                current_jobs[url] = jobs
+            else:
+                del current_jobs[url]
         try:
-            with dbm.open(DATABASE_FILE, 'w') as db:
-                for job_id in list(current_jobs.values()):
-                    if job_id not in active_pbs_jobs:
-                        logger.debug(f"Removing completed job from database: {job_id}")
-                        for k in db.keys():
-                            if db[k].decode() == job_id:
-                                del current_jobs[k.decode()]
-                                del db[k]
-                                break
-
-        except dbm.error as e:
+            if finished:
+                logger.debug(f"Removing completed jobs from database: {finished}")
+                self.store.prune(finished)
+            self.store.update_states({
+                j.id: active_pbs_jobs[j.id] for jobs in current_jobs.values() for j in jobs
+            })
+        except sqlite3.Error as e:
             logger.error(f"Failed to remove completed jobs from database: {e}")
 
         return current_jobs
 
     def cancel_jobs(self, logger, job_ids):
+        # Flatten list of lists of SchedulerJobs
+        job_ids = [x.id for sublist in job_ids for x in sublist]
         logger.debug(f"Canceling PBS jobs: {', '.join(job_ids)}")
         cmd = ["qdel"] + job_ids
         
@@ -504,14 +1321,97 @@ class PBSJobScheduler(JobScheduler):
             logger.error(f"Return code: {e.returncode}")
             logger.error(f"stderr: {e.stderr}")
         try:
-            with dbm.open(DATABASE_FILE, 'w') as current_jobs:
-                for job_id in job_ids:
-                    if job_id in current_jobs:
-                        del current_jobs[job_id]
-                        logger.info(f"Removed job {job_id} from database")
-        except dbm.error as e:
+            removed = self.store.prune(job_ids)
+            logger.info(f"Removed {removed} canceled jobs from database")
+        except sqlite3.Error as e:
             logger.error(f"Failed to update database after canceling jobs: {e}")
 
+    def requested_resources(self, logger, job):
+        """The resources the qsub command of `job` asks for, from its
+        pbs_l_select chunks (count:ncpus=N:ngpus=M) and pbs_l_walltime (or
+        `time_limit`)."""
+        pbs_tags = {k: v for k, v in get_buildkite_job_tags(job).items() if k.startswith('pbs_')}
+        nodes, cpus, gpus = 1, 1, 0
+        try:
+            select = pbs_tags.get('pbs_l_select')
+            if select:
+                # Several chunk specs may be joined with '+'
+                nodes = cpus = gpus = 0
+                for chunk in select.split('+'):
+                    specs = chunk.split(':')
+                    count = int(specs.pop(0)) if specs[0].isdigit() else 1
+                    fields = dict(spec.split('=', 1) for spec in specs if '=' in spec)
+                    nodes += count
+                    cpus += count * int(fields.get('ncpus', 1))
+                    gpus += count * int(fields.get('ngpus', 0))
+            elif gpu_is_requested(pbs_tags):
+                gpus = 1
+        except ValueError:
+            return Resources(jobs=1)
+        walltime = pbs_tags.get('pbs_l_walltime') or self.time_limit(logger, job)
+        hours = time_limit_hours(walltime, 1 / 3600) or time_limit_hours(DEFAULT_TIMELIMIT)
+        return Resources(1, gpus, nodes, cpus * hours)
+
+    def job_history(self, logger, job_ids):
+        """The full status of `job_ids` from the job history (qstat -x -f -F
+        json), finished jobs included: PBS job id (without the server) -> its
+        attributes. Empty if qstat can't be read."""
+        server = DEFAULT_PBS_SERVERS[BUILDKITE_QUEUE]
+        # Without `check`: qstat fails for ids it no longer knows, but still
+        # prints the others
+        try:
+            out = subprocess.run(
+                ['qstat', '-x', '-f', '-F', 'json'] + [f'{j}@{server}' for j in job_ids],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+            ).stdout
+            jobs = json.loads(out).get('Jobs', {}) if out.strip() else {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read the job history from qstat: {e}")
+            return {}
+        return {pbs_id.split('.')[0]: info for pbs_id, info in jobs.items()}
+
+    @staticmethod
+    def final_state(info):
+        """Final state of a job in the job history, mapped from its exit
+        status onto Slurm's names, or None if it hasn't finished."""
+        if info.get('job_state') != 'F' or 'Exit_status' not in info:
+            return None
+        return PBS_EXIT_STATES.get(int(info['Exit_status']), 'FAILED')
+
+    def finished_runtimes(self, logger, job_ids):
+        """Final state and walltime of the finished `job_ids`, from the job
+        history."""
+        finished = {}
+        for pbs_id, info in self.job_history(logger, job_ids).items():
+            state = self.final_state(info)
+            walltime = info.get('resources_used', {}).get('walltime')
+            hours = time_limit_hours(walltime, 1 / 3600) if walltime else None
+            if state is None or hours is None:
+                continue
+            finished[pbs_id] = (state, hours * 3600)
+        return finished
+
+    def job_accounting(self, logger, job_ids):
+        def epoch(value):
+            try:
+                return time.mktime(time.strptime(value, '%a %b %d %H:%M:%S %Y'))
+            except (TypeError, ValueError):
+                return None
+        accounting = {}
+        for pbs_id, info in self.job_history(logger, job_ids).items():
+            select = info.get('Resource_List', {}).get('select', '')
+            gpu_type = re.search(r'gpu_type=([^:+]+)', select)
+            if gpu_type:
+                gpu_type = gpu_type.group(1)
+            elif re.search(r'ngpus=[1-9]', select):
+                gpu_type = 'gpu'
+            state = self.final_state(info)
+            accounting[pbs_id] = (
+                info.get('queue'), gpu_type, epoch(info.get('qtime')), epoch(info.get('stime')),
+                epoch(info.get('obittime')) if state else None, state,
+            )
+        return accounting
+
     def format_resource(self, key, value):
         if key.startswith('l_'):
             return ["-l", f"{key[2:]}={value}"]
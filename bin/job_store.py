@@ -0,0 +1,121 @@
+import dbm
+import json
+import time
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH
+from sqlite_store import SqliteStore, chunks
+
+# Tracks the scheduler jobs we submitted: one row per scheduler job id, with
+# the Buildkite job url it runs, the HPC queue, the last seen state, the
+# submit time and the resources it requested (JSON, see
+# job_schedulers.Resources). Indexed on both ids, so lookups either way are cheap. SQLite in
+# WAL mode lets other tools read it while a poller writes.
+JOB_STORE_FILE = joinpath(BUILDKITE_PATH, 'jobs.sqlite')
+# dbm job map used before the job store (Buildkite url -> PBS job id)
+LEGACY_DBM_FILE = joinpath(BUILDKITE_PATH, 'jobs.db')
+
+class JobStore(SqliteStore):
+    def __init__(self, path=JOB_STORE_FILE):
+        super().__init__(path)
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' job_id TEXT PRIMARY KEY,'
+                ' buildkite_url TEXT NOT NULL,'
+                ' queue TEXT,'
+                ' state TEXT,'
+                ' submit_time REAL,'
+                ' resources TEXT)'
+            )
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_buildkite_url ON jobs (buildkite_url)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+        self._import_legacy_dbm()
+
+    def _import_legacy_dbm(self):
+        """Carry over the jobs tracked in the old dbm file, once."""
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'dbm_imported'").fetchone():
+                return
+            if dbm.whichdb(LEGACY_DBM_FILE):
+                with dbm.open(LEGACY_DBM_FILE, 'r') as legacy:
+                    db.executemany(
+                        'INSERT OR IGNORE INTO jobs (job_id, buildkite_url) VALUES (?, ?)',
+                        [(legacy[k].decode(), k.decode()) for k in legacy.keys()],
+                    )
+            db.execute("INSERT INTO meta (key, value) VALUES ('dbm_imported', '1')")
+
+    def add(self, buildkite_url, job_id, queue=None, state='Q', resources=None):
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO jobs'
+                ' (job_id, buildkite_url, queue, state, submit_time, resources)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, buildkite_url, queue, state, time.time(),
+                 json.dumps(resources) if resources is not None else None),
+            )
+
+    def current_jobs(self):
+        """Map Buildkite url -> [scheduler job ids] for every tracked job."""
+        current_jobs = {}
+        with self._transaction() as db:
+            for url, job_id in db.execute('SELECT buildkite_url, job_id FROM jobs'):
+                current_jobs.setdefault(url, []).append(job_id)
+        return current_jobs
+
+    def job_resources(self):
+        """Map scheduler job id -> requested resources (dict, or None if not
+        recorded) for every tracked job."""
+        with self._transaction() as db:
+            return {
+                job_id: json.loads(resources) if resources else None
+                for job_id, resources in db.execute('SELECT job_id, resources FROM jobs')
+            }
+
+    def lookup_urls(self, urls):
+        """Map each of `urls` that is tracked -> [scheduler job ids]."""
+        found = {}
+        with self._transaction() as db:
+            for chunk in chunks(urls):
+                marks = ','.join('?' * len(chunk))
+                for url, job_id in db.execute(
+                    f'SELECT buildkite_url, job_id FROM jobs WHERE buildkite_url IN ({marks})',
+                    chunk,
+                ):
+                    found.setdefault(url, []).append(job_id)
+        return found
+
+    def lookup_job_ids(self, job_ids):
+        """Map each of `job_ids` that is tracked -> its Buildkite url."""
+        found = {}
+        with self._transaction() as db:
+            for chunk in chunks(job_ids):
+                marks = ','.join('?' * len(chunk))
+                found.update(db.execute(
+                    f'SELECT job_id, buildkite_url FROM jobs WHERE job_id IN ({marks})',
+                    chunk,
+                ))
+        return found
+
+    def update_states(self, states):
+        """Record the scheduler state of each job in `states` (job id -> state)."""
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE jobs SET state = ? WHERE job_id = ?',
+                [(state, job_id) for job_id, state in states.items()],
+            )
+
+    def prune(self, job_ids):
+        """Forget `job_ids` in one transaction. Returns how many were tracked."""
+        removed = 0
+        with self._transaction() as db:
+            for chunk in chunks(job_ids):
+                marks = ','.join('?' * len(chunk))
+                removed += db.execute(
+                    f'DELETE FROM jobs WHERE job_id IN ({marks})', chunk
+                ).rowcount
+        return removed
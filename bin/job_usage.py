@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from os.path import join as joinpath
+
+from sqlite_store import SqliteStore, sacct_time
+
+# What our jobs actually use, compared with what their slurm_* tags ask for.
+# The hooks write one usage record per buildkite job:
+#
+#   `start` (hooks/pre-command) notes the time and the CPU time of the job's
+#   running steps and, on GPU jobs, starts nvidia-smi sampling the node's
+#   GPUs every GPU_SAMPLE_SECONDS
+#
+#   `record` (hooks/post-command) stops the sampler and reads the job's steps
+#   from sstat (running: the batch and extern steps) and sacct (finished srun
+#   steps): their peak RSS and CPU time. The record goes to
+#   records/<date>/<buildkite job id>.json under USAGE_PATH, written under a
+#   temporary name and renamed, so nodes never share a file.
+#
+# Only the first node's GPUs are sampled, the one running the hooks. Memory is
+# per node: a step's peak is the larger of its largest task and its tasks'
+# total over its nodes, and the batch step's peak is added to the largest of
+# the other steps', since the command's sruns run alongside it.
+#
+# The allocation may have run other commands before this one (a pilot, or
+# a retry), so CPU time only counts the command: what the running steps used
+# since `start`, and the srun steps that started after it. The extern step,
+# which holds processes adopted by ssh, isn't counted.
+#
+# The poller imports the records into usage.sqlite (UsageHistory) and, on the
+# queues in job_schedulers.RIGHT_SIZING_POLICY, lowers the slurm_mem and
+# slurm_cpus_per_task tags of a step that asks for much more than it used
+# (see `recommend`). `job_usage.py report` shows requests, peaks and
+# recommendations per step.
+USAGE_PATH = joinpath(os.environ.get('BUILDKITE_PATH', '.'), 'usage')
+USAGE_HISTORY_FILE = joinpath(os.environ.get('BUILDKITE_PATH', '.'), 'usage.sqlite')
+
+GPU_SAMPLE_SECONDS = 15
+
+# Records older than this are forgotten (and their files deleted)
+HISTORY_DAYS = 30
+# Records are imported at most this often
+REFRESH_SECONDS = 600
+# Recommendations come from a step's most recent successful runs, and only
+# once it has at least MIN_RUNS of them
+RUNS_KEPT = 20
+MIN_RUNS = 5
+# memory = peak * MEM_MARGIN_FACTOR + MEM_MARGIN_MB, rounded up to GB and at
+# least MIN_MEM_MB
+MEM_MARGIN_FACTOR = 1.25
+MEM_MARGIN_MB = 2048
+MIN_MEM_MB = 4096
+# cpus per task = CPUs used per task on average * CPU_MARGIN_FACTOR, rounded up
+CPU_MARGIN_FACTOR = 1.5
+# A run (successful or not) that peaked this close to its memory allocation
+# may have been held back by it: its step is left alone
+MEM_CEILING = 0.9
+
+_UNITS = {'B': 1 / 1024 ** 2, 'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2, 'P': 1024 ** 3}
+
+def log(message):
+    print(f"job_usage: {message}", file=sys.stderr)
+
+def parse_mem_mb(value, default_unit='M'):
+    """MB of a Slurm memory size such as '1234K', '1.5G' or '4000' (in
+    `default_unit`), None if it isn't one."""
+    value = (value or '').strip().upper()
+    if not value:
+        return None
+    unit = value[-1] if value[-1] in _UNITS else default_unit
+    try:
+        return float(value.rstrip('KMGTPB') or 'x') * _UNITS[unit]
+    except ValueError:
+        return None
+
+def format_mem(mb):
+    """A Slurm memory size in whole GB, e.g. '12G'."""
+    return f'{math.ceil(mb / 1024)}G'
+
+def parse_cpu_time(value):
+    """Seconds of a Slurm CPU time such as '1-02:03:04', '02:03:04' or
+    '03:04.567', None if it isn't one."""
+    days, _, rest = (value or '').strip().rpartition('-')
+    try:
+        seconds = 0.0
+        for part in rest.split(':'):
+            seconds = seconds * 60 + float(part)
+        return seconds + (int(days) * 86400 if days else 0)
+    except ValueError:
+        return None
+
+def parse_tres(value):
+    """{name: value} of a TRES list such as 'cpu=00:01:02,mem=1.5G'."""
+    return dict(item.split('=', 1) for item in (value or '').split(',') if '=' in item)
+
+def _state_dir():
+    return joinpath(os.environ.get('TMPDIR', '/tmp'),
+                    f"job-usage-{os.environ.get('BUILDKITE_JOB_ID', 'unknown')}")
+
+def start():
+    """Note when the command starts and the CPU time used so far, and sample
+    the GPUs in the background."""
+    state = _state_dir()
+    os.makedirs(state, exist_ok=True)
+    with open(joinpath(state, 'start'), 'w') as f:
+        f.write(f'{time.time():.3f}\n')
+    if os.environ.get('SLURM_JOB_ID'):
+        running = {
+            step_id: cpu for step_id, (_, cpu, started) in
+            step_usage(os.environ['SLURM_JOB_ID'], _int_env('SLURM_JOB_NUM_NODES', 1)).items()
+            if started is None
+        }
+        with open(joinpath(state, 'cpu_start.json'), 'w') as f:
+            json.dump(running, f)
+    if not os.environ.get('SLURM_GPUS_ON_NODE'):
+        return
+    try:
+        with open(joinpath(state, 'gpus.csv'), 'w') as out:
+            sampler = subprocess.Popen(
+                ['nvidia-smi', '--query-gpu=index,utilization.gpu,memory.used',
+                 '--format=csv,noheader,nounits', '-l', str(GPU_SAMPLE_SECONDS)],
+                stdout=out, stderr=subprocess.DEVNULL, start_new_session=True,
+            )
+    except OSError as e:
+        log(f"could not start nvidia-smi: {e}")
+        return
+    with open(joinpath(state, 'sampler.pid'), 'w') as f:
+        f.write(f'{sampler.pid}\n')
+
+def _stop_sampler(state):
+    try:
+        with open(joinpath(state, 'sampler.pid')) as f:
+            os.kill(int(f.read()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+
+def gpu_stats(path):
+    """(GPUs, samples, mean utilization %, max utilization %, max memory MB)
+    of nvidia-smi's samples in `path`, None without samples."""
+    gpus, utilization, memory = set(), [], []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = [field.strip() for field in line.split(',')]
+                try:
+                    index, util, mem = fields[0], float(fields[1]), float(fields[2])
+                except (IndexError, ValueError):
+                    # '[N/A]', or a line cut short by the sampler being stopped
+                    continue
+                gpus.add(index)
+                utilization.append(util)
+                memory.append(mem)
+    except OSError:
+        return None
+    if not utilization:
+        return None
+    return (len(gpus), len(utilization), sum(utilization) / len(utilization),
+            max(utilization), max(memory))
+
+def _run(cmd):
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                         universal_newlines=True)
+    return out.stdout if out.returncode == 0 else ''
+
+def step_usage(slurm_job_id, num_nodes):
+    """{step id: (per node peak MB, CPU seconds, start)} of the job's steps:
+    the running ones from sstat, with no start, the finished ones from
+    sacct."""
+    steps = {}
+    for line in _run(['sstat', '-a', '-j', slurm_job_id, '--noheader', '--parsable2',
+                      '--format=JobID,MaxRSS,TRESUsageInTot']).splitlines():
+        fields = line.split('|')
+        if len(fields) < 3:
+            continue
+        step_id, max_rss, tres = fields[:3]
+        # The batch and extern steps only run on the first node
+        nodes = 1 if step_id.endswith(('.batch', '.extern')) else num_nodes
+        steps[step_id] = (max_rss, tres, nodes, None)
+    for line in _run(['sacct', '-j', slurm_job_id, '--noheader', '--parsable2',
+                      '--format=JobID,MaxRSS,TRESUsageInTot,NNodes,State,Start']).splitlines():
+        fields = line.split('|')
+        if len(fields) < 6 or '.' not in fields[0] or fields[0] in steps:
+            continue
+        step_id, max_rss, tres, nodes, state, start = fields[:6]
+        if state == 'RUNNING' or not tres:
+            continue
+        steps[step_id] = (max_rss, tres, int(nodes) if nodes.isdigit() else num_nodes,
+                          sacct_time(start))
+
+    usage = {}
+    for step_id, (max_rss, tres, nodes, start) in steps.items():
+        tres = parse_tres(tres)
+        peak = max(parse_mem_mb(max_rss, 'B') or 0,
+                   (parse_mem_mb(tres.get('mem'), 'B') or 0) / max(1, nodes))
+        usage[step_id] = (peak, parse_cpu_time(tres.get('cpu')) or 0.0, start)
+    return usage
+
+def command_usage(usage, started, cpu_start):
+    """The steps of `usage` that ran the command, and the CPU seconds they
+    used since it started. `cpu_start` has the CPU time of the steps
+    running at that point."""
+    steps, cpu_seconds = {}, 0.0
+    for step_id, (peak, cpu, start) in usage.items():
+        # sacct times are in whole seconds
+        if start is not None and start < int(started):
+            # Ran before the command started
+            continue
+        steps[step_id] = (peak, cpu, start)
+        if not step_id.endswith('.extern'):
+            cpu_seconds += max(0.0, cpu - cpu_start.get(step_id, 0.0))
+    return steps, cpu_seconds
+
+def _int_env(name, default=None):
+    try:
+        return int(os.environ[name])
+    except (KeyError, ValueError):
+        return default
+
+def record():
+    """Stop the GPU sampler and write the usage record of this job."""
+    state = _state_dir()
+    _stop_sampler(state)
+    now = time.time()
+    try:
+        with open(joinpath(state, 'start')) as f:
+            started = float(f.read())
+    except (OSError, ValueError):
+        log("no start time, was `job_usage.py start` run?")
+        return
+    slurm_job_id = os.environ.get('SLURM_JOB_ID')
+    if not slurm_job_id:
+        log("not a Slurm job, nothing recorded")
+        return
+    num_nodes = _int_env('SLURM_JOB_NUM_NODES', 1)
+    cpus_on_node = _int_env('SLURM_CPUS_ON_NODE', 1)
+    mem_mb = _int_env('SLURM_MEM_PER_NODE')
+    if mem_mb is None and _int_env('SLURM_MEM_PER_CPU') is not None:
+        mem_mb = _int_env('SLURM_MEM_PER_CPU') * cpus_on_node
+    try:
+        with open(joinpath(state, 'cpu_start.json')) as f:
+            cpu_start = json.load(f)
+    except (OSError, ValueError):
+        cpu_start = None
+    elapsed = now - started
+
+    usage, cpu_seconds = command_usage(step_usage(slurm_job_id, num_nodes), started, cpu_start or {})
+    batch_peak = max((peak for step_id, (peak, _, _) in usage.items()
+                      if step_id.endswith('.batch')), default=0.0)
+    step_peak = max((peak for step_id, (peak, _, _) in usage.items()
+                     if not step_id.endswith(('.batch', '.extern'))), default=0.0)
+    # Without the CPU time at the start, the batch step's covers the whole job
+    has_cpu = bool(usage) and cpu_start is not None
+    cpus = cpus_on_node * num_nodes
+    gpus = gpu_stats(joinpath(state, 'gpus.csv'))
+
+    usage_record = {
+        'job_id': os.environ.get('BUILDKITE_JOB_ID'),
+        'slurm_job_id': slurm_job_id,
+        'pipeline': os.environ.get('BUILDKITE_PIPELINE_SLUG'),
+        'step': os.environ.get('BUILDKITE_STEP_KEY') or os.environ.get('BUILDKITE_LABEL'),
+        'queue': os.environ.get('BUILDKITE_AGENT_META_DATA_QUEUE'),
+        'nodes': os.environ.get('SLURM_JOB_NODELIST'),
+        'num_nodes': num_nodes,
+        'ntasks': _int_env('SLURM_NTASKS', 1),
+        'cpus_per_task': _int_env('SLURM_CPUS_PER_TASK', 1),
+        'cpus': cpus,
+        'mem_mb': mem_mb,
+        'start': started,
+        'end': now,
+        'wall_seconds': now - started,
+        'exit_status': _int_env('BUILDKITE_COMMAND_EXIT_STATUS'),
+        'mem_peak_mb': (batch_peak + step_peak) if usage else None,
+        'cpu_seconds': cpu_seconds if has_cpu else None,
+        'cpu_efficiency': cpu_seconds / (elapsed * cpus) if has_cpu and elapsed > 0 else None,
+        'gpus': gpus[0] if gpus else None,
+        'gpu_samples': gpus[1] if gpus else None,
+        'gpu_util_mean': gpus[2] if gpus else None,
+        'gpu_util_max': gpus[3] if gpus else None,
+        'gpu_mem_max_mb': gpus[4] if gpus else None,
+    }
+    if not usage_record['job_id'] or not usage_record['pipeline'] or not usage_record['step']:
+        log("not a buildkite job, nothing recorded")
+        return
+    day_dir = joinpath(USAGE_PATH, 'records', time.strftime('%Y-%m-%d', time.localtime(now)))
+    os.makedirs(day_dir, exist_ok=True)
+    path = joinpath(day_dir, f"{usage_record['job_id']}.json")
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(usage_record, f)
+    os.rename(tmp_path, path)
+
+COLUMNS = [
+    'job_id', 'pipeline', 'step', 'queue', 'nodes', 'num_nodes', 'ntasks', 'cpus_per_task',
+    'cpus', 'mem_mb', 'end', 'wall_seconds', 'exit_status', 'mem_peak_mb', 'cpu_seconds',
+    'cpu_efficiency', 'gpus', 'gpu_util_mean', 'gpu_util_max', 'gpu_mem_max_mb',
+]
+
+class UsageHistory(SqliteStore):
+    def __init__(self, path=USAGE_HISTORY_FILE, records_path=joinpath(USAGE_PATH, 'records')):
+        super().__init__(path)
+        self.records_path = records_path
+        self.lock = threading.Lock()
+        self.refreshed = 0.0
+        # (pipeline, step) -> {'mem_mb': ..., 'cpus_per_task': ...}, recomputed
+        # on each refresh
+        self.recommendations = {}
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS usage ('
+                ' job_id TEXT PRIMARY KEY,'
+                ' pipeline TEXT NOT NULL,'
+                ' step TEXT NOT NULL,'
+                ' queue TEXT,'
+                ' nodes TEXT,'
+                ' num_nodes INTEGER,'
+                ' ntasks INTEGER,'
+                ' cpus_per_task INTEGER,'
+                ' cpus INTEGER,'
+                ' mem_mb REAL,'
+                ' end REAL,'
+                ' wall_seconds REAL,'
+                ' exit_status INTEGER,'
+                ' mem_peak_mb REAL,'
+                ' cpu_seconds REAL,'
+                ' cpu_efficiency REAL,'
+                ' gpus INTEGER,'
+                ' gpu_util_mean REAL,'
+                ' gpu_util_max REAL,'
+                ' gpu_mem_max_mb REAL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS usage_step ON usage (pipeline, step, end)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+
+    def refresh(self, logger, force=False):
+        """Import the new usage records and recompute the recommendations, at
+        most every REFRESH_SECONDS."""
+        with self.lock:
+            if not force and time.time() - self.refreshed < REFRESH_SECONDS:
+                return
+            self.refreshed = time.time()
+            try:
+                self._import_records(logger)
+                self.recommendations = self._compute_recommendations()
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Failed to update the usage history: {e}")
+
+    def _import_records(self, logger):
+        """Read the record directories of the days since the last import (and
+        the day before, for records written around midnight), and delete the
+        ones older than HISTORY_DAYS."""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone()
+        since = max(now - HISTORY_DAYS * 86400, float(row[0]) - 86400 if row else 0)
+        oldest = time.strftime('%Y-%m-%d', time.localtime(now - HISTORY_DAYS * 86400))
+        first = time.strftime('%Y-%m-%d', time.localtime(since))
+        try:
+            days = sorted(os.listdir(self.records_path))
+        except FileNotFoundError:
+            days = []
+        rows = []
+        for day in days:
+            day_dir = joinpath(self.records_path, day)
+            if day < oldest:
+                for name in os.listdir(day_dir):
+                    os.unlink(joinpath(day_dir, name))
+                os.rmdir(day_dir)
+                continue
+            if day < first:
+                continue
+            for name in os.listdir(day_dir):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(joinpath(day_dir, name)) as f:
+                        usage_record = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Skipping usage record {name}: {e}")
+                    continue
+                rows.append(tuple(usage_record.get(column) for column in COLUMNS))
+        with self._transaction() as db:
+            db.executemany(
+                f'INSERT OR IGNORE INTO usage ({", ".join(COLUMNS)})'
+                f' VALUES ({", ".join("?" * len(COLUMNS))})',
+                [row for row in rows if row[1] and row[2]],
+            )
+            db.execute('DELETE FROM usage WHERE end < ?', (now - HISTORY_DAYS * 86400,))
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)", (str(now),)
+            )
+
+    def step_runs(self):
+        """{(pipeline, step): [run, ...]} of the RUNS_KEPT most recent runs
+        of each step, newest first, each a dict of COLUMNS."""
+        runs = {}
+        with self._transaction() as db:
+            for row in db.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM usage ORDER BY end DESC'
+            ):
+                run = dict(zip(COLUMNS, row))
+                step_runs = runs.setdefault((run['pipeline'], run['step']), [])
+                if len(step_runs) < RUNS_KEPT:
+                    step_runs.append(run)
+        return runs
+
+    def _compute_recommendations(self):
+        return {key: recommend(step_runs) for key, step_runs in self.step_runs().items()}
+
+    def recommendation(self, pipeline, step):
+        """{'mem_mb': MB per node, 'cpus_per_task': N} (either may be missing)
+        for the next job of `step`, from its past usage."""
+        return self.recommendations.get((pipeline, step)) or {}
+
+def recommend(step_runs):
+    """What a step needs, from its recent runs: memory per node from the
+    highest peak, CPUs per task from the most CPUs a task used on average.
+    Nothing until it has MIN_RUNS successful runs, and no memory once any
+    run peaked within MEM_CEILING of its allocation."""
+    runs = [run for run in step_runs if run['exit_status'] == 0]
+    if len(runs) < MIN_RUNS:
+        return {}
+    result = {}
+    peaks = [run['mem_peak_mb'] for run in runs if run['mem_peak_mb']]
+    near_ceiling = any(
+        run['mem_peak_mb'] and run['mem_mb'] and run['mem_peak_mb'] >= MEM_CEILING * run['mem_mb']
+        for run in step_runs
+    )
+    if len(peaks) >= MIN_RUNS and not near_ceiling:
+        mem_mb = max(peaks) * MEM_MARGIN_FACTOR + MEM_MARGIN_MB
+        result['mem_mb'] = max(MIN_MEM_MB, math.ceil(mem_mb / 1024) * 1024)
+    # CPUs busy on average, per task
+    used = [
+        run['cpu_efficiency'] * run['cpus'] / run['ntasks']
+        for run in runs if run['cpu_efficiency'] and run['cpus'] and run['ntasks']
+    ]
+    if len(used) >= MIN_RUNS:
+        result['cpus_per_task'] = max(1, math.ceil(max(used) * CPU_MARGIN_FACTOR))
+    return result
+
+def report(logger, days):
+    """Print, per step with runs in the last `days`, what its last run
+    requested, what it used and what it would be given."""
+    history = UsageHistory()
+    history.refresh(logger, force=True)
+    since = time.time() - days * 86400
+    rows = []
+    for (pipeline, step), step_runs in history.step_runs().items():
+        if step_runs[0]['end'] < since:
+            continue
+        last = step_runs[0]
+        peak = max((run['mem_peak_mb'] or 0 for run in step_runs), default=0)
+        efficiency = [run['cpu_efficiency'] for run in step_runs if run['cpu_efficiency'] is not None]
+        gpu_util = [run['gpu_util_mean'] for run in step_runs if run['gpu_util_mean'] is not None]
+        gpu_mem = max((run['gpu_mem_max_mb'] or 0 for run in step_runs), default=0)
+        rows.append(((last['mem_mb'] or 0) - peak, f'{pipeline}/{step}', len(step_runs), last,
+                     peak, sorted(efficiency), gpu_util, gpu_mem, recommend(step_runs)))
+    if not rows:
+        print(f"No usage recorded in the last {days} days")
+        return
+    # Most memory asked for and not used first
+    rows.sort(key=lambda row: row[0], reverse=True)
+    print(f"{'step':<48} {'runs':>4} {'mem':>7} {'peak':>7} {'rec':>5} "
+          f"{'cpus/t':>6} {'cpu eff':>7} {'rec':>4} {'gpu %':>5} {'gpu mem':>7}")
+    for _, name, count, last, peak, efficiency, gpu_util, gpu_mem, rec in rows:
+        mem = format_mem(last['mem_mb']) if last['mem_mb'] else '-'
+        median = f'{efficiency[len(efficiency) // 2]:.0%}' if efficiency else '-'
+        util = f'{sum(gpu_util) / len(gpu_util):.0f}' if gpu_util else '-'
+        print(f"{name[:48]:<48} {count:>4} {mem:>7} {peak / 1024:>6.1f}G "
+              f"{format_mem(rec['mem_mb']) if 'mem_mb' in rec else '-':>5} "
+              f"{last['cpus_per_task'] or 1:>6} {median:>7} {rec.get('cpus_per_task', '-'):>4} "
+              f"{util:>5} {(f'{gpu_mem / 1024:.1f}G' if gpu_mem else '-'):>7}")
+
+def main():
+    import logging
+    logger = logging.Logger('job_usage')
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+    parser = argparse.ArgumentParser(description="Resource usage of our jobs")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('start', help="note the command's start and sample the GPUs (pre-command)")
+    commands.add_parser('record', help="write this job's usage record (post-command)")
+    commands.add_parser('import', help="import the new usage records")
+    report_parser = commands.add_parser(
+        'report', help="show requests, peaks and recommendations per step"
+    )
+    report_parser.add_argument('--days', type=float, default=7, help="steps that ran in the last DAYS")
+    args = parser.parse_args()
+
+    if args.command == 'start':
+        start()
+    elif args.command == 'record':
+        record()
+    elif args.command == 'import':
+        UsageHistory().refresh(logger, force=True)
+    elif args.command == 'report':
+        report(logger, args.days)
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
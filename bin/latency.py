@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+import calendar
+import os
+import re
+import threading
+import time
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH, BUILDKITE_QUEUE, pipeline_slug_from_url
+from sqlite_store import SqliteStore, chunks
+
+# Where the time goes between a step being runnable in buildkite and its
+# agent taking it. Each record joins one of our HPC jobs with its buildkite
+# job through the submissions log the poller writes: when the poll queued
+# the job for submission and when sbatch/qsub returned, with the buildkite url
+# (also the Slurm --comment) and the HPC job id. The scheduler's accounting
+# (sacct, qstat -x) adds the partition, GPU type, submit, start and end
+# times. The build (fetched once the HPC job ended) adds when the buildkite
+# job became runnable, started and finished. Records are updated
+# incrementally and stop being queried once both sides are done, or after
+# INCOMPLETE_DAYS.
+#
+# `latency.py --report` prints percentiles of each phase per queue,
+# pipeline, partition or GPU type; bin/build_history runs it too.
+LATENCY_FILE = joinpath(BUILDKITE_PATH, 'latency.sqlite')
+# Submissions are logged per day, in logs/<date>/submissions.log
+LOGS_PATH = joinpath(BUILDKITE_PATH, 'logs')
+
+# Records older than this are forgotten
+HISTORY_DAYS = 60
+# Records still missing either side after this long are left as they are
+INCOMPLETE_DAYS = 3
+# Percentiles shown by the report
+PERCENTILES = (0.5, 0.95, 0.99)
+
+# Phases of a job, as (name, start column, end column). agent_startup only
+# counts when the buildkite job started inside the HPC job, which leaves out
+# the duplicates and canceled jobs of a url.
+PHASES = [
+    ('poll_delay', 'runnable_at', 'queued_at'),
+    ('submit', 'queued_at', 'submitted_at'),
+    ('scheduler_wait', 'hpc_submit', 'hpc_start'),
+    ('agent_startup', 'hpc_start', 'bk_started_at'),
+    ('runtime', 'bk_started_at', 'bk_finished_at'),
+    ('end_to_end', 'runnable_at', 'bk_started_at'),
+]
+GROUPS = ['queue', 'pipeline', 'partition', 'gpu_type']
+
+def submissions_log(day):
+    """The submissions log of `day`, 'YYYY-MM-DD'."""
+    return joinpath(LOGS_PATH, day, 'submissions.log')
+
+def log_submission(buildkite_url, hpc_job_id, queued_at, submitted_at):
+    """Append a submission of the poller to today's submissions log."""
+    path = submissions_log(time.strftime('%Y-%m-%d'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(f'{queued_at:.3f}\t{submitted_at:.3f}\t{BUILDKITE_QUEUE}\t'
+                f'{hpc_job_id}\t{buildkite_url}\n')
+
+def _api_time(value):
+    """Epoch seconds of an API timestamp such as '2024-05-01T12:00:00.000Z',
+    or None."""
+    if not value:
+        return None
+    return calendar.timegm(time.strptime(value.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S'))
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def format_seconds(seconds):
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 7200:
+        return f'{seconds / 60:.1f}m'
+    return f'{seconds / 3600:.1f}h'
+
+class LatencyStore(SqliteStore):
+    def __init__(self, path=LATENCY_FILE):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' hpc_job_id TEXT PRIMARY KEY,'
+                ' buildkite_url TEXT NOT NULL,'
+                ' queue TEXT,'
+                ' pipeline TEXT,'
+                ' queued_at REAL,'
+                ' submitted_at REAL,'
+                ' partition TEXT,'
+                ' gpu_type TEXT,'
+                ' hpc_submit REAL,'
+                ' hpc_start REAL,'
+                ' hpc_end REAL,'
+                ' hpc_state TEXT,'
+                ' runnable_at REAL,'
+                ' bk_started_at REAL,'
+                ' bk_finished_at REAL,'
+                ' bk_state TEXT,'
+                ' complete INTEGER NOT NULL DEFAULT 0)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_complete ON jobs (complete)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+
+    def update(self, logger, scheduler):
+        """Import new submissions, then fill in the accounting and buildkite
+        sides of the incomplete records."""
+        with self.lock:
+            self._import_submissions()
+            self._import_accounting(logger, scheduler)
+            self._import_builds(logger)
+            with self._transaction() as db:
+                now = time.time()
+                db.execute(
+                    'UPDATE jobs SET complete = 1 WHERE complete = 0 AND ('
+                    ' (hpc_end IS NOT NULL AND bk_finished_at IS NOT NULL)'
+                    ' OR submitted_at < ?)',
+                    (now - INCOMPLETE_DAYS * 86400,),
+                )
+                db.execute(
+                    'DELETE FROM jobs WHERE submitted_at < ?', (now - HISTORY_DAYS * 86400,)
+                )
+
+    def _import_submissions(self):
+        """Read the submissions logs from where the last import stopped: the
+        rest of that day's log, then the logs of the days since."""
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'submissions'").fetchone()
+        # Before the logs were per day, the value was '<inode>:<offset>'
+        last_day, _, offset = row[0].partition(':') if row else ('', '', '0')
+        if not re.match(r'^\d{4}-\d{2}-\d{2}$', last_day):
+            last_day, offset = '', '0'
+        try:
+            days = sorted(
+                day for day in os.listdir(LOGS_PATH)
+                if re.match(r'^\d{4}-\d{2}-\d{2}$', day) and day >= last_day
+            )
+        except FileNotFoundError:
+            return
+        rows = []
+        for day in days:
+            read = int(offset) if day == last_day else 0
+            try:
+                f = open(submissions_log(day), 'rb')
+            except FileNotFoundError:
+                continue
+            with f:
+                f.seek(read)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Being written, read it next time
+                        break
+                    read += len(line)
+                    fields = line.decode('utf-8', 'replace').rstrip('\n').split('\t')
+                    if len(fields) != 5:
+                        continue
+                    queued_at, submitted_at, queue, hpc_job_id, url = fields
+                    rows.append((hpc_job_id, url, queue, pipeline_slug_from_url(url),
+                                 float(queued_at), float(submitted_at)))
+            last_day, offset = day, read
+        if not last_day:
+            return
+        with self._transaction() as db:
+            db.executemany(
+                'INSERT OR IGNORE INTO jobs'
+                ' (hpc_job_id, buildkite_url, queue, pipeline, queued_at, submitted_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('submissions', ?)",
+                (f'{last_day}:{offset}',),
+            )
+
+    def _import_accounting(self, logger, scheduler):
+        with self._transaction() as db:
+            job_ids = [row[0] for row in db.execute(
+                'SELECT hpc_job_id FROM jobs WHERE complete = 0 AND hpc_end IS NULL'
+            )]
+        accounting = {}
+        for chunk in chunks(job_ids):
+            accounting.update(scheduler.job_accounting(logger, chunk))
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE jobs SET partition = ?, gpu_type = ?, hpc_submit = ?, hpc_start = ?,'
+                ' hpc_end = ?, hpc_state = ? WHERE hpc_job_id = ?',
+                [values + (job_id,) for job_id, values in accounting.items()],
+            )
+
+    def _import_builds(self, logger):
+        """Fetch the builds of the records whose HPC job ended (or that have
+        none in the accounting, e.g. pilot jobs, after a day) and whose
+        buildkite job didn't finish yet, once per build."""
+        # Local imports, the report works without API access
+        from build_cache import build_key
+        from buildkite import BuildkiteAPIError, get_build_json
+
+        with self._transaction() as db:
+            urls = [row[0] for row in db.execute(
+                'SELECT DISTINCT buildkite_url FROM jobs WHERE complete = 0'
+                ' AND bk_finished_at IS NULL AND (hpc_end IS NOT NULL OR submitted_at < ?)',
+                (time.time() - 86400,),
+            )]
+        keys = {build_key(url) for url in urls} - {None}
+        rows = []
+        for key in sorted(keys):
+            slug, number = key.rsplit('/', 1)
+            try:
+                build = get_build_json(slug, int(number))
+            except BuildkiteAPIError as e:
+                logger.warning(f"Failed to fetch build {key}: {e}")
+                continue
+            for job in build.get('jobs') or []:
+                if job.get('type') != 'script' or not job.get('web_url'):
+                    continue
+                rows.append((
+                    _api_time(job.get('runnable_at') or job.get('scheduled_at')),
+                    _api_time(job.get('started_at')), _api_time(job.get('finished_at')),
+                    job.get('state'), job['web_url'],
+                ))
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE jobs SET runnable_at = ?, bk_started_at = ?, bk_finished_at = ?,'
+                ' bk_state = ? WHERE buildkite_url = ? AND complete = 0',
+                rows,
+            )
+
+    def phases(self, group, since):
+        """{group value: {phase: sorted seconds}} over the records submitted
+        after `since`."""
+        columns = sorted({column for _, start, end in PHASES for column in (start, end)} | {'hpc_end'})
+        result = {}
+        with self._transaction() as db:
+            for row in db.execute(
+                f'SELECT {group}, {", ".join(columns)} FROM jobs WHERE submitted_at >= ?',
+                (since,),
+            ):
+                key = row[0] or ('cpu' if group == 'gpu_type' else 'unknown')
+                values = dict(zip(columns, row[1:]))
+                by_phase = result.setdefault(key, {name: [] for name, _, _ in PHASES})
+                for name, start, end in PHASES:
+                    if values[start] is None or values[end] is None:
+                        continue
+                    if name == 'agent_startup' and not (
+                        values['hpc_end'] is None or values['bk_started_at'] <= values['hpc_end']
+                    ):
+                        continue
+                    if values[end] >= values[start]:
+                        by_phase[name].append(values[end] - values[start])
+        for by_phase in result.values():
+            for seconds in by_phase.values():
+                seconds.sort()
+        return result
+
+def report(store, group, days):
+    """Print the percentiles of each phase per `group`, over the last `days`."""
+    since = time.time() - days * 86400
+    phases = store.phases(group, since)
+    if not phases:
+        print(f"No submissions recorded in the last {days} days")
+        return
+    labels = '/'.join(f'p{int(q * 100)}' for q in PERCENTILES)
+    print(f"Last {days} days, by {group}: {labels} (jobs)")
+    for name, _, _ in PHASES:
+        print(f"\n{name}")
+        for key in sorted(phases):
+            seconds = phases[key][name]
+            if not seconds:
+                continue
+            values = ' / '.join(format_seconds(percentile(seconds, q)) for q in PERCENTILES)
+            print(f"  {key:<32} {values:<24} ({len(seconds)})")
+
+def main():
+    import argparse
+    import logging
+    logger = logging.Logger('latency')
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+    parser = argparse.ArgumentParser(
+        description="Queue latency of our jobs, from buildkite and the scheduler's accounting"
+    )
+    parser.add_argument(
+        '--report', action='store_true',
+        help="print percentiles of each phase (after updating, unless --no-update)",
+    )
+    parser.add_argument('--by', choices=GROUPS, default='queue', help="group the report by")
+    parser.add_argument('--days', type=float, default=7, help="report on the last DAYS")
+    parser.add_argument(
+        '--no-update', action='store_true', help="report on the stored records only",
+    )
+    args = parser.parse_args()
+    store = LatencyStore()
+    if not args.no_update:
+        import job_schedulers
+        store.update(logger, job_schedulers.get_job_scheduler())
+    if args.report:
+        report(store, args.by, args.days)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from os.path import join as joinpath
+
+# Per-poll instrumentation. Every timed phase (current_jobs, each API request,
+# each submit_job, each spill-check subprocess, cancel_jobs, ...) and every
+# job counter is collected since the end of the previous poll (so it includes
+# webhook events handled between daemon polls). At the end of the poll they are
+# written as a Prometheus textfile-collector file (overwritten on every poll,
+# point node_exporter's --collector.textfile.directory at METRICS_DIR) and
+# appended as one JSON line to a daily history file.
+BUILDKITE_PATH = os.environ['BUILDKITE_PATH']
+BUILDKITE_QUEUE = os.environ['BUILDKITE_QUEUE']
+METRICS_DIR = os.environ.get('BUILDKITE_METRICS_DIR') or joinpath(BUILDKITE_PATH, 'metrics')
+
+# Number of slowest individual operations kept in the history, with their
+# details (command line, API request, buildkite url), to find the slow one
+SLOWEST_KEPT = 10
+
+# Job counters, always exported so that alerts see a 0 rather than no series
+COUNTERS = [
+    'seen', 'submitted', 'deferred', 'late', 'spilled', 'piloted', 'failed', 'canceled',
+    'orphaned', 'rerouted', 'right_sized', 'webhook_events',
+]
+
+class PollMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}  # phase -> [calls, total seconds, max seconds]
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.slowest = []  # [(seconds, phase, detail)], at most SLOWEST_KEPT
+
+    def observe(self, phase, seconds, detail=None):
+        with self.lock:
+            calls, total, longest = self.phases.get(phase, (0, 0.0, 0.0))
+            self.phases[phase] = [calls + 1, total + seconds, max(longest, seconds)]
+            if detail is not None:
+                self.slowest.append((seconds, phase, detail))
+                self.slowest.sort(reverse=True)
+                del self.slowest[SLOWEST_KEPT:]
+
+    @contextmanager
+    def timer(self, phase, detail=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start, detail)
+
+    def timed(self, phase, iterable):
+        """Generate the items of `iterable`, timing only the time spent
+        producing them (e.g. downloading pages), not the caller's work on each
+        item in between."""
+        iterator = iter(iterable)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(phase, elapsed)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _prometheus(self, started, duration, ok):
+        labels = f'queue="{BUILDKITE_QUEUE}"'
+        lines = [
+            '# HELP buildkite_poll_duration_seconds Wall time of the last poll.',
+            '# TYPE buildkite_poll_duration_seconds gauge',
+            f'buildkite_poll_duration_seconds{{{labels}}} {duration:.6f}',
+            '# HELP buildkite_poll_success Whether the last poll completed without error.',
+            '# TYPE buildkite_poll_success gauge',
+            f'buildkite_poll_success{{{labels}}} {int(ok)}',
+            '# HELP buildkite_poll_timestamp_seconds Unix time the last poll finished.',
+            '# TYPE buildkite_poll_timestamp_seconds gauge',
+            f'buildkite_poll_timestamp_seconds{{{labels}}} {started + duration:.3f}',
+            '# HELP buildkite_poll_jobs Jobs handled by the last poll, by outcome.',
+            '# TYPE buildkite_poll_jobs gauge',
+        ]
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'buildkite_poll_jobs{{{labels},outcome="{name}"}} {value}')
+        for metric, index, help_text in [
+            ('buildkite_poll_phase_calls', 0, 'Calls of each phase in the last poll.'),
+            ('buildkite_poll_phase_seconds', 1, 'Total seconds spent in each phase in the last poll.'),
+            ('buildkite_poll_phase_max_seconds', 2, 'Slowest single call of each phase in the last poll.'),
+        ]:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} gauge')
+            for phase, values in sorted(self.phases.items()):
+                value = values[index]
+                value = f'{value:.6f}' if isinstance(value, float) else value
+                lines.append(f'{metric}{{{labels},phase="{phase}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, ok, started):
+        """Write the textfile and append the history line for the poll that
+        started at `started` (epoch seconds), then start collecting afresh."""
+        duration = time.time() - started
+        with self.lock:
+            prometheus = self._prometheus(started, duration, ok)
+            record = {
+                'time': round(started, 3),
+                'queue': BUILDKITE_QUEUE,
+                'pid': os.getpid(),
+                'ok': ok,
+                'duration': round(duration, 6),
+                'jobs': dict(self.counters),
+                'phases': {
+                    phase: {'calls': calls, 'seconds': round(total, 6), 'max': round(longest, 6)}
+                    for phase, (calls, total, longest) in self.phases.items()
+                },
+                'slowest': [
+                    {'phase': phase, 'seconds': round(seconds, 6), 'detail': detail}
+                    for seconds, phase, detail in self.slowest
+                ],
+            }
+
+        self.reset()
+
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        # The textfile collector may read at any time, so replace it atomically
+        path = joinpath(METRICS_DIR, f'poll_{BUILDKITE_QUEUE}.prom')
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(prometheus)
+        os.replace(tmp, path)
+
+        with open(joinpath(METRICS_DIR, f'poll-{date.today()}.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+# Shared by every module of the poller, like buildkite.SESSION
+METRICS = PollMetrics()
+timer = METRICS.timer
+timed = METRICS.timed
+count = METRICS.count
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+import math
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH
+from sqlite_store import SqliteStore, sacct_time
+import runtimes
+
+# Nodes that keep failing our jobs (a bad GPU, a full /tmp, a broken
+# interconnect) are quarantined: added to the --exclude of every sbatch next
+# to the manual list (.exclude_nodes or BUILDKITE_EXCLUDE_NODES), for
+# QUARANTINE_HOURS. Every finished `buildkite` job is read from sacct with
+# its nodes, partition and how it ended. Only outcomes that point at a node
+# count as failures:
+#
+#   NODE_FAIL
+#   a job killed by one of NODE_SIGNALS (the signal of its ExitCode)
+#   a failed step (the agent exits with its step's status) that passed on
+#   other nodes in the history, so the step itself isn't broken; the step of
+#   a job comes from the runtime history (runtimes.py)
+#
+# Other failures and timeouts say nothing about their nodes and are left
+# out. A failure of a job on several nodes counts 1/N against each. Each job
+# weighs less the older it is (half-life HALF_LIFE_HOURS). A node is compared
+# with the partitions it ran our jobs in, not with the whole fleet: its
+# baseline is the failure rate of the other nodes' jobs in those partitions,
+# weighted by its jobs.
+# It is quarantined when its decayed failure rate, smoothed towards its
+# baseline, is FAILURE_RATIO times the baseline and at least MIN_EXCESS above
+# it, over at least MIN_FAILURES failures. Once released, a node only counts
+# the jobs it ran since.
+#
+# `node_health.py --report` shows the quarantined nodes, the partition
+# failure rates and the nodes with the highest failure rates.
+NODE_HEALTH_FILE = joinpath(BUILDKITE_PATH, 'node_health.sqlite')
+
+# Jobs older than this are forgotten
+HISTORY_DAYS = 7
+# sacct is asked for finished jobs at most this often
+REFRESH_SECONDS = 600
+HALF_LIFE_HOURS = 24
+QUARANTINE_HOURS = 6
+FAILURE_RATIO = 3
+MIN_EXCESS = 0.25
+MIN_FAILURES = 3
+# Weight of the baseline in a node's smoothed rate, in jobs
+PRIOR_JOBS = 5
+# At most this many nodes are quarantined at once, the worst ones
+MAX_QUARANTINED = 10
+
+NODE_FAIL_STATE = 'NODE_FAIL'
+FAILED_STATE = 'FAILED'
+# Canceled, preempted, timed out and out-of-memory jobs say nothing about
+# their nodes
+SUCCESS_STATES = {'COMPLETED'}
+# Signals that kill a job for its node's sake: SIGBUS (bad memory, a lost
+# filesystem) and SIGILL (a CPU lacking the instructions the build expects)
+NODE_SIGNALS = {signal.SIGBUS, signal.SIGILL}
+
+def expand_nodelist(nodelist, cache=None):
+    """The node names of a Slurm node list such as 'hpc-[01-03],gpu-7'.
+    Plain names are split here, bracketed ones go through `scontrol show
+    hostnames` (memoized in `cache`)."""
+    if nodelist in ('', 'None assigned', '(null)'):
+        return []
+    if '[' not in nodelist:
+        return nodelist.split(',')
+    if cache is not None and nodelist in cache:
+        return cache[nodelist]
+    out = subprocess.run(
+        ['scontrol', 'show', 'hostnames', nodelist],
+        stdout=subprocess.PIPE, universal_newlines=True,
+    )
+    nodes = out.stdout.split() if out.returncode == 0 else []
+    if cache is not None:
+        cache[nodelist] = nodes
+    return nodes
+
+def _exit_signal(exit_code):
+    """The signal of a sacct ExitCode such as '0:9', 0 if none."""
+    try:
+        return int(exit_code.split(':')[1])
+    except (IndexError, ValueError):
+        return 0
+
+class NodeHealth(SqliteStore):
+    def __init__(self, path=NODE_HEALTH_FILE):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.refreshed = 0.0
+        # Nodes quarantined as of the last refresh
+        self.quarantined = []
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                ' job_id TEXT PRIMARY KEY,'
+                ' nodes TEXT,'
+                ' partition TEXT,'
+                ' state TEXT,'
+                ' exit_code TEXT,'
+                ' pipeline TEXT,'
+                ' step TEXT,'
+                ' end REAL)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS quarantine ('
+                ' node TEXT PRIMARY KEY,'
+                ' since REAL,'
+                ' until REAL,'
+                ' rate REAL,'
+                ' fleet_rate REAL)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+
+    def refresh(self, logger, force=False):
+        """Import the jobs that finished since the last refresh and update
+        the quarantine, at most every REFRESH_SECONDS."""
+        with self.lock:
+            if not force and time.time() - self.refreshed < REFRESH_SECONDS:
+                return
+            self.refreshed = time.time()
+            try:
+                self._import_sacct()
+                self.quarantined = self._update_quarantine(logger)
+            except (OSError, subprocess.CalledProcessError, sqlite3.Error) as e:
+                logger.warning(f"Failed to update the node health: {e}")
+
+    def _import_sacct(self):
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'imported'").fetchone()
+        # Look back an hour before the last import, for jobs that ended while
+        # it ran
+        since = max(time.time() - HISTORY_DAYS * 86400, float(row[0]) - 3600 if row else 0)
+        now = time.time()
+        out = subprocess.run(
+            ['sacct', '-X', '--noheader', '--parsable2', '--name=buildkite',
+             '--state=CD,F,NF,TO,CA,OOM,PR',
+             '-S', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(since)), '-E', 'now',
+             '--format=JobIDRaw,NodeList,Partition,State,ExitCode,End'],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+
+        jobs = []
+        hostnames = {}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) < 6:
+                continue
+            job_id, nodelist, partition, state, exit_code, end = fields[:6]
+            end = sacct_time(end)
+            # 'CANCELLED by 1234'
+            state = state.split()[0] if state else state
+            nodes = expand_nodelist(nodelist, hostnames)
+            if end is None or not nodes:
+                continue
+            jobs.append((job_id, ','.join(nodes), partition, state, exit_code, end))
+        steps = runtimes.RuntimeHistory().steps([job[0] for job in jobs])
+
+        with self._transaction() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO runs'
+                ' (job_id, nodes, partition, state, exit_code, pipeline, step, end)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [job[:5] + steps.get(job[0], (None, None)) + job[5:] for job in jobs],
+            )
+            db.execute('DELETE FROM runs WHERE end < ?', (now - HISTORY_DAYS * 86400,))
+            db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)", (str(now),)
+            )
+
+    def outcomes(self):
+        """[(nodes, partition, failed, end)] of the jobs whose outcome says
+        something about their nodes (see the top of this file), failed being
+        1 or 0."""
+        with self._transaction() as db:
+            runs = db.execute(
+                'SELECT nodes, partition, state, exit_code, pipeline, step, end FROM runs'
+            ).fetchall()
+        # Nodes each step passed on
+        passed = {}
+        for nodes, _, state, _, pipeline, step, _ in runs:
+            if state in SUCCESS_STATES and step is not None:
+                passed.setdefault((pipeline, step), set()).update(nodes.split(','))
+        outcomes = []
+        for nodes, partition, state, exit_code, pipeline, step, end in runs:
+            if state in SUCCESS_STATES:
+                failed = 0
+            elif state == NODE_FAIL_STATE or _exit_signal(exit_code) in NODE_SIGNALS:
+                failed = 1
+            elif state == FAILED_STATE and passed.get((pipeline, step), set()) - set(nodes.split(',')):
+                failed = 1
+            else:
+                continue
+            outcomes.append((nodes.split(','), partition, failed, end))
+        return outcomes
+
+    def node_stats(self):
+        """(node -> (decayed failures, decayed jobs, baseline rate), partition
+        -> failure rate), leaving out each node's jobs from before its last
+        quarantine ended. A node's baseline is the rate of the partitions it
+        ran its jobs in, without its own jobs."""
+        now = time.time()
+        with self._transaction() as db:
+            released = {
+                node: until for node, until in db.execute(
+                    'SELECT node, until FROM quarantine WHERE until <= ?', (now,)
+                )
+            }
+        weighted = []
+        by_partition = {}
+        for nodes, partition, failed, end in self.outcomes():
+            weight = 0.5 ** (max(0.0, now - end) / (HALF_LIFE_HOURS * 3600))
+            weighted.append((nodes, partition, failed, end, weight))
+            failures, total = by_partition.get(partition, (0.0, 0.0))
+            by_partition[partition] = (failures + failed * weight, total + weight)
+        partition_rates = {
+            partition: failures / total for partition, (failures, total) in by_partition.items()
+        }
+        # node -> partition -> (failures, jobs) of the node's jobs, whole
+        # jobs as counted in the partition rates
+        own = {}
+        stats = {}
+        for nodes, partition, failed, end, weight in weighted:
+            for node in nodes:
+                if end <= released.get(node, 0):
+                    continue
+                node_failures, node_total = stats.get(node, (0.0, 0.0))
+                stats[node] = (node_failures + failed * weight / len(nodes), node_total + weight)
+                failures, total = own.setdefault(node, {}).get(partition, (0.0, 0.0))
+                own[node][partition] = (failures + failed * weight, total + weight)
+        result = {}
+        for node, (failures, total) in stats.items():
+            # The rate of each partition without the node's own jobs, by how
+            # many of its jobs ran there
+            expected = 0.0
+            for partition, (own_failures, own_total) in own[node].items():
+                partition_failures, partition_total = by_partition[partition]
+                if partition_total - own_total > 1e-9:
+                    rate = (partition_failures - own_failures) / (partition_total - own_total)
+                else:
+                    rate = partition_rates[partition]
+                expected += rate * own_total
+            result[node] = (failures, total, expected / total if total else 0.0)
+        return result, partition_rates
+
+    @staticmethod
+    def smoothed_rate(failures, jobs, baseline):
+        return (failures + PRIOR_JOBS * baseline) / (jobs + PRIOR_JOBS)
+
+    def _update_quarantine(self, logger):
+        """Quarantine the nodes that fail well above their baseline; returns
+        the nodes quarantined now."""
+        now = time.time()
+        stats, _ = self.node_stats()
+        with self._transaction() as db:
+            current = {
+                node for (node,) in db.execute(
+                    'SELECT node FROM quarantine WHERE until > ?', (now,)
+                )
+            }
+        bad = []
+        for node, (failures, jobs, baseline) in stats.items():
+            rate = self.smoothed_rate(failures, jobs, baseline)
+            if (node not in current and failures >= MIN_FAILURES
+                    and rate >= FAILURE_RATIO * baseline and rate - baseline >= MIN_EXCESS):
+                bad.append((rate, node, baseline))
+        bad.sort(reverse=True)
+        bad = bad[:max(0, MAX_QUARANTINED - len(current))]
+        with self._transaction() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO quarantine (node, since, until, rate, fleet_rate)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                [(node, now, now + QUARANTINE_HOURS * 3600, rate, baseline)
+                 for rate, node, baseline in bad],
+            )
+        for rate, node, baseline in bad:
+            logger.warning(
+                f"Quarantining node {node} for {QUARANTINE_HOURS}h: failure rate "
+                f"{rate:.0%}, its partitions {baseline:.0%}"
+            )
+        return sorted(current | {node for _, node, _ in bad})
+
+def merge_exclude(manual, nodes):
+    """The manual exclude list (a Slurm node list, possibly empty) plus
+    `nodes`, for sbatch --exclude."""
+    return ','.join(([manual] if manual else []) + list(nodes))
+
+def report(logger):
+    """Print the quarantined nodes, the partition failure rates, then the
+    nodes with the highest failure rates."""
+    health = NodeHealth()
+    health.refresh(logger, force=True)
+    now = time.time()
+    with health._transaction() as db:
+        quarantine = db.execute(
+            'SELECT node, since, until, rate, fleet_rate FROM quarantine'
+            ' WHERE until > ? ORDER BY since', (now,)
+        ).fetchall()
+    stats, partition_rates = health.node_stats()
+    print(f"Partition failure rates (decayed, half-life {HALF_LIFE_HOURS}h): " + ', '.join(
+        f"{partition} {rate:.1%}" for partition, rate in sorted(partition_rates.items())
+    ))
+    print(f"Quarantined: {len(quarantine)}")
+    for node, since, until, rate, baseline in quarantine:
+        print(f"  {node:<24} since {time.strftime('%Y-%m-%d %H:%M', time.localtime(since))}, "
+              f"{math.ceil((until - now) / 60)} min left, rate {rate:.0%} (baseline {baseline:.0%})")
+    ranked = sorted(
+        ((health.smoothed_rate(f, n, b), node, f, n, b) for node, (f, n, b) in stats.items()),
+        reverse=True,
+    )
+    print(f"{'node':<24} {'rate':>6} {'base':>6} {'failed':>7} {'jobs':>7}")
+    for rate, node, failures, jobs, baseline in ranked[:20]:
+        print(f"{node:<24} {rate:>6.0%} {baseline:>6.0%} {failures:>7.1f} {jobs:>7.1f}")
+
+def main():
+    import argparse
+    import logging
+    logger = logging.Logger('node_health')
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
+    logger.addHandler(handler)
+
+    parser = argparse.ArgumentParser(
+        description="Failure rates of the nodes our jobs ran on, and the quarantined nodes"
+    )
+    parser.add_argument(
+        '--report', action='store_true',
+        help="show the quarantined nodes and the worst failure rates",
+    )
+    parser.add_argument(
+        '--release', metavar='NODE', nargs='+',
+        help="end the quarantine of NODE now",
+    )
+    args = parser.parse_args()
+    if args.release:
+        health = NodeHealth()
+        with health._transaction() as db:
+            db.executemany(
+                'UPDATE quarantine SET until = ? WHERE node = ? AND until > ?',
+                [(time.time(), node, time.time()) for node in args.release],
+            )
+    elif args.report:
+        report(logger)
+    else:
+        NodeHealth().refresh(logger, force=True)
+
+if __name__ == '__main__':
+    main()
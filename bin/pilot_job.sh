@@ -0,0 +1,64 @@
+#!/bin/bash
+
+# Runs the buildkite jobs the poller queues for this pilot allocation (see
+# bin/pilots.py), one at a time, until the inbox stays empty for IDLE seconds
+# or the next job wouldn't finish within the allocation's time limit.
+#
+# Usage: pilot_job.sh PILOT_DIR IDLE_SECONDS TIME_LIMIT_SECONDS
+#
+# Each inbox entry holds six lines: the buildkite job id, its max runtime in
+# seconds, its build log directory, its modules, its buildkite url and its
+# requested resources (JSON). Only the first four are read here, the other
+# two are for the poller.
+#
+# An idle pilot touches `closed` before it looks at the inbox one last time,
+# and the poller looks at `closed` after it queues a job, so a job queued
+# while the pilot leaves is either run here or taken back by the poller.
+
+PATH="${BUILDKITE_PATH}/bin:$PATH"
+
+PILOT_DIR="$1"
+IDLE="$2"
+TIME_LIMIT="$3"
+INBOX="$PILOT_DIR/inbox"
+
+last_busy=$SECONDS
+while true; do
+    entry=$(ls "$INBOX" 2>/dev/null | head -n 1)
+    if [ -z "$entry" ]; then
+        if (( SECONDS - last_busy >= IDLE )); then
+            touch "$PILOT_DIR/closed"
+            if [ -z "$(ls "$INBOX" 2>/dev/null)" ]; then
+                break
+            fi
+            rm -f "$PILOT_DIR/closed"
+            continue
+        fi
+        sleep 2
+        continue
+    fi
+
+    { read -r job; read -r seconds; read -r log_dir; read -r modules; } < "$INBOX/$entry"
+    if (( SECONDS + seconds > TIME_LIMIT )); then
+        break
+    fi
+    # Canceled by the poller in the meantime
+    mv "$INBOX/$entry" "$PILOT_DIR/current" 2>/dev/null || continue
+
+    echo "$(date) Running $job for at most ${seconds}s"
+    args=("$job")
+    if [ -n "$modules" ]; then
+        args+=("$modules")
+    fi
+    # SIGQUIT stops the agent without waiting for the job, which buildkite
+    # then reports as canceled
+    timeout --signal=QUIT --kill-after=60 "$seconds" \
+        schedule_job.sh "${args[@]}" &> "$log_dir/slurm-${SLURM_JOB_ID}-$job.log"
+    echo "$(date) $job exited with $?"
+    rm -f "$PILOT_DIR/current"
+    last_busy=$SECONDS
+done
+
+# No more jobs: whatever is left in the inbox is submitted again by the
+# poller once this allocation is gone
+touch "$PILOT_DIR/closed"
@@ -0,0 +1,195 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from os.path import join as joinpath, isfile
+
+from buildkite import BUILDKITE_PATH, BUILDKITE_QUEUE
+
+# Pilot allocations: long-lived Slurm jobs that each run many short buildkite
+# jobs, one after the other, saving the sbatch, the scheduling cycle and the
+# agent start-up per job. Opt-in per buildkite queue. The poller keeps a small
+# pool of pilots per allocation "shape" (the job's slurm_* tags, partition and
+# exclude): a short CPU job goes into the inbox of a pilot of its shape, or a
+# new pilot is started if all of them are full and the shape is below
+# PILOT_MAX_PER_SHAPE; otherwise it is submitted on its own as usual. Pilots
+# leave when idle, so the pool follows demand.
+#
+# Each pilot has a directory under PILOTS_DIR named after it (also its Slurm
+# --comment), with its shape and an inbox of queued jobs. bin/pilot_job.sh
+# takes entries from the inbox in order and starts an agent for each with
+# --acquire-job, as bin/schedule_job.sh does, logging to the job's build log
+# directory. Queued entries count as submitted HPC jobs of their buildkite
+# url (see SlurmJobScheduler.current_jobs), and canceling one removes it from
+# the inbox; a job already running is canceled by buildkite through its
+# agent, as usual.
+PILOT_QUEUES = set()  # e.g. {"central"}
+PILOTS_DIR = joinpath(BUILDKITE_PATH, 'pilots')
+PILOT_JOB_NAME = 'buildkite-pilot'
+
+# Time limit of a pilot allocation
+PILOT_TIMELIMIT = '1:00:00'
+# A pilot exits after this long without a job
+PILOT_IDLE_SECONDS = 120
+# Jobs whose time limit (set, or learned from their step's runtimes) is at
+# most this long go to pilots. A `pilot: true` tag sends longer jobs, or jobs
+# without runtime history, too, `pilot: false` none. Jobs in a pilot are
+# stopped after this long, or their own time limit if shorter.
+PILOT_MAX_JOB_SECONDS = 10 * 60
+# Max jobs waiting in a pilot's inbox, and max pilots per shape
+PILOT_BACKLOG = 4
+PILOT_MAX_PER_SHAPE = 4
+# A pilot directory without a Slurm job is removed after this long: sbatch may
+# still be running for a new one
+PILOT_DIR_GRACE = 5 * 60
+
+# HPC job ids of jobs queued in a pilot: 'pilot:<pilot name>/<inbox entry>'
+PILOT_ID_PREFIX = 'pilot:'
+
+def is_pilot_id(hpc_job_id):
+    return str(hpc_job_id).startswith(PILOT_ID_PREFIX)
+
+def job_shape(tags):
+    """The allocation a job needs, as a string: its slurm_* tags other than
+    the time limit, its partition and exclude tags."""
+    return ','.join(sorted(
+        f'{key}={value}' for key, value in tags.items()
+        if (key.startswith('slurm_') and key != 'slurm_time') or key in ('partition', 'exclude')
+    ))
+
+class Pilot:
+    __slots__ = ('name', 'shape', 'path')
+
+    def __init__(self, name, shape, path):
+        self.name = name
+        self.shape = shape
+        self.path = path
+
+    @property
+    def inbox(self):
+        return joinpath(self.path, 'inbox')
+
+    def closed(self):
+        """True once the pilot stopped taking jobs."""
+        return isfile(joinpath(self.path, 'closed'))
+
+    def backlog(self):
+        try:
+            return len(os.listdir(self.inbox))
+        except OSError:
+            return PILOT_BACKLOG
+
+    def entries(self):
+        """(hpc job id, buildkite url, resources JSON) of the jobs queued or
+        running in the pilot."""
+        files = [joinpath(self.path, 'current')]
+        try:
+            files.extend(joinpath(self.inbox, entry) for entry in sorted(os.listdir(self.inbox)))
+        except OSError:
+            pass
+        for path in files:
+            try:
+                with open(path, 'r') as f:
+                    lines = f.read().split('\n')
+            except OSError:
+                continue
+            if len(lines) >= 6:
+                yield f'{PILOT_ID_PREFIX}{self.name}/{os.path.basename(path)}', lines[4], lines[5]
+
+    def queue(self, job_id, seconds, log_dir, modules, url, resources):
+        """Add buildkite job `job_id` to the inbox, to run for at most
+        `seconds`; returns its hpc job id."""
+        entry = f'{time.time_ns()}-{job_id}'
+        tmp = joinpath(self.path, f'.{entry}.tmp')
+        # bin/pilot_job.sh reads the first four lines
+        with open(tmp, 'w') as f:
+            f.write('\n'.join([job_id, str(int(seconds)), log_dir, modules, url, resources]) + '\n')
+        os.replace(tmp, joinpath(self.inbox, entry))
+        return f'{PILOT_ID_PREFIX}{self.name}/{entry}'
+
+class PilotPool:
+    def __init__(self, path=PILOTS_DIR):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pilots = {}  # name -> Pilot, the ones with a Slurm job
+        os.makedirs(self.path, exist_ok=True)
+
+    def refresh(self, logger):
+        """Re-read the live pilots from squeue and remove the directories of
+        those that are gone. Returns the jobs queued in the live ones, as
+        (hpc job id, buildkite url, resources JSON)."""
+        squeue = subprocess.run(
+            ['squeue', f'--name={PILOT_JOB_NAME}', '--noheader', '--Format=Comment:256'],
+            stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        if squeue.returncode != 0:
+            logger.warning("Failed to list pilot jobs, keeping the last pool")
+            live = set(self.pilots)
+        else:
+            live = {line.strip() for line in squeue.stdout.splitlines()}
+
+        pilots = {}
+        for name in os.listdir(self.path):
+            path = joinpath(self.path, name)
+            try:
+                with open(joinpath(path, 'shape'), 'r') as f:
+                    shape = f.read()
+                created = os.path.getmtime(joinpath(path, 'shape'))
+            except OSError:
+                continue
+            if name in live:
+                pilots[name] = Pilot(name, shape, path)
+            elif time.time() - created > PILOT_DIR_GRACE:
+                # Whatever is left in its inbox is still scheduled in
+                # buildkite and gets submitted again
+                shutil.rmtree(path, ignore_errors=True)
+        with self.lock:
+            self.pilots = pilots
+        return [entry for pilot in pilots.values() for entry in pilot.entries()]
+
+    def dispatch(self, logger, shape, start_pilot, *entry):
+        """Queue a job of `shape` in the pilot with the shortest inbox, or in
+        a new one started with `start_pilot(logger, name, path)` (-> Slurm job
+        id or None) if they are all full. `entry` is as for `Pilot.queue`.
+        Returns the hpc job id, or None if the pool of the shape is full."""
+        with self.lock:
+            pilots = [p for p in self.pilots.values() if p.shape == shape and not p.closed()]
+            waiting = [p for p in pilots if p.backlog() < PILOT_BACKLOG]
+            if waiting:
+                pilot = min(waiting, key=Pilot.backlog)
+            elif len(pilots) < PILOT_MAX_PER_SHAPE:
+                name = f'{BUILDKITE_QUEUE}-{uuid.uuid4().hex[:12]}'
+                pilot = Pilot(name, shape, joinpath(self.path, name))
+                os.makedirs(pilot.inbox)
+                with open(joinpath(pilot.path, 'shape'), 'w') as f:
+                    f.write(shape)
+                if start_pilot(logger, name, pilot.path) is None:
+                    shutil.rmtree(pilot.path, ignore_errors=True)
+                    return None
+                self.pilots[name] = pilot
+            else:
+                return None
+            hpc_job_id = pilot.queue(*entry)
+            # The pilot may have closed while the entry was written (see
+            # bin/pilot_job.sh): take the entry back for an sbatch of its own,
+            # unless the pilot started it meanwhile
+            if pilot.closed():
+                try:
+                    os.remove(joinpath(pilot.inbox, hpc_job_id.rpartition('/')[2]))
+                    logger.debug(f"Pilot {pilot.name} closed, not queueing in it")
+                    return None
+                except FileNotFoundError:
+                    pass
+            return hpc_job_id
+
+    def cancel(self, logger, hpc_job_ids):
+        """Remove jobs from their pilots' inboxes. Jobs already taken by a
+        pilot are left to buildkite."""
+        for hpc_job_id in hpc_job_ids:
+            name, _, entry = hpc_job_id[len(PILOT_ID_PREFIX):].partition('/')
+            try:
+                os.remove(joinpath(self.path, name, 'inbox', entry))
+            except FileNotFoundError:
+                logger.debug(f"Pilot job {hpc_job_id} already started or gone")
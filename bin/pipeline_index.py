@@ -0,0 +1,62 @@
+import json
+import os
+import time
+from os.path import join as joinpath, isfile
+
+from buildkite import BUILDKITE_PATH, get_buildkite_job_tags
+
+# Which agent queues each pipeline has sent jobs to, learned from the
+# `agent_query_rules` of every build the poller sees: pipeline slug ->
+# {queue: epoch last seen}, plus the time of the last org-wide discovery
+# sweep. Lets a cluster's poller list only the pipelines that target its
+# queue, see BuildCache.
+PIPELINE_INDEX_FILE = joinpath(BUILDKITE_PATH, '.pipeline_queues.json')
+
+# A pipeline stays relevant to a queue for this long after its last job there
+RELEVANT_SECONDS = 30 * 24 * 3600
+
+class PipelineIndex:
+    def __init__(self, path=PIPELINE_INDEX_FILE):
+        self.path = path
+        self.pipelines = {}     # slug -> {queue: epoch last seen}
+        self.discovered = 0.0   # epoch seconds of the last org-wide sweep
+        self.load()
+
+    def load(self):
+        if not isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            self.pipelines = state['pipelines']
+            self.discovered = state['discovered']
+        except (OSError, ValueError, KeyError):
+            # Start over with a discovery sweep
+            self.pipelines, self.discovered = {}, 0.0
+
+    def save(self):
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'pipelines': self.pipelines, 'discovered': self.discovered}, f)
+        os.replace(tmp, self.path)
+
+    def learn(self, build):
+        """Record the queues the jobs of `build` target."""
+        now = time.time()
+        queues = self.pipelines.setdefault(build.pipeline_slug, {})
+        for job in build.jobs:
+            queue = get_buildkite_job_tags(job).get('queue')
+            if queue is not None:
+                queues[queue] = now
+
+    def known(self, slug):
+        return slug in self.pipelines
+
+    def is_relevant(self, slug, queue):
+        """True if pipeline `slug` sent a job to `queue` recently."""
+        last_seen = self.pipelines.get(slug, {}).get(queue, 0)
+        return time.time() - last_seen < RELEVANT_SECONDS
+
+    def relevant(self, queue):
+        """Slugs of the pipelines that sent a job to `queue` recently."""
+        return sorted(slug for slug in self.pipelines if self.is_relevant(slug, queue))
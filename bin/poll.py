@@ -9,142 +9,598 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+import argparse
+import fcntl
 import os
-import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
 from os.path import join as joinpath
 
-from buildkite import all_started_builds, all_canceled_builds, build_url
-from buildkite import get_buildkite_job_tags, BUILDKITE_PATH, BUILDKITE_QUEUE
+from buildkite import build_url, Build, CANCELED_STATES
+from buildkite import get_buildkite_job_tags, pipeline_slug_from_url
+from buildkite import BUILDKITE_PATH, BUILDKITE_QUEUE
+from build_cache import BuildCache
+import fair_share
 import job_schedulers
+import latency
+import metrics
+import spool
 
 # Time window to query buildkite jobs
 NHOURS = 96
 
-# Max concurrent Slurm jobs (pending + running) per buildkite pipeline slug.
+# Max concurrent resources (pending + running Slurm jobs) per buildkite
+# pipeline slug, as resource name -> max: 'jobs', 'gpus', 'nodes' and
+# 'cpu_hours' (reserved, CPUs times time limit), see job_schedulers.Resources.
 # All jobs share one service account, so a single pipeline flooding the queue
 # with high-priority (often un-runnable) jobs can consume the entire per-user
-# backfill window (bf_max_job_user) and starve every other pipeline. Capping
+# backfill window (bf_max_job_user) and starve every other pipeline, and a few
+# large distributed jobs can hold most of a GPU reservation. Capping
 # per-pipeline occupancy keeps the shared window populated with runnable work.
-# A job over the cap is left 'scheduled' in buildkite and reconsidered next poll.
-# Per-pipeline overrides go in PIPELINE_LIMITS; everything else uses the default.
-DEFAULT_PIPELINE_LIMIT = float("inf")  # no cap unless the pipeline is listed below
+# A job that doesn't fit under its pipeline's caps is left 'scheduled' in
+# buildkite and reconsidered next poll. Per-pipeline overrides go in
+# PIPELINE_LIMITS; everything else uses the default. The order jobs are
+# submitted in, and the queue-wide budget, are set by the weights and limits
+# in fair_share.py.
+DEFAULT_PIPELINE_LIMIT = {}  # no cap unless the pipeline is listed below
 PIPELINE_LIMITS = {
-    "oceananigans-distributed": 3,
+    "oceananigans-distributed": {"jobs": 3},
 }
 
-def pipeline_slug_from_url(url):
-    """Extract the buildkite pipeline slug from a job/build web_url, e.g.
-    'https://buildkite.com/clima/climacoupler-ci/builds/9247#...' -> 'climacoupler-ci'."""
-    match = re.search(r'buildkite\.com/[^/]+/([^/?#]+)', url or '')
-    return match.group(1) if match else None
+# Submissions (sbatch/qsub, plus the GPU spill checks) run concurrently on
+# this many threads. Per-pipeline caps are still counted in the main thread,
+# as each submission is queued.
+SUBMIT_WORKERS = 8
+# Stop starting new submissions this many seconds into a poll, so a slow
+# controller can't push a poll into the next cron interval. Jobs not submitted
+# in time stay 'scheduled' in buildkite and are picked up by the next poll.
+SUBMIT_DEADLINE = 40
 
-try:
-    scheduler = job_schedulers.get_job_scheduler()
+# Our pending HPC jobs whose buildkite job isn't waiting for an agent anymore
+# (it expired, timed out, was taken by another agent, finished...) would only
+# start, fail to acquire the job and exit, holding a slot in the shared
+# backfill window until then. Each poll compares the jobs in `current_jobs`
+# with the job states in its builds (the active builds, plus the builds of our
+# jobs that left the active set) and cancels those orphaned for
+# ORPHAN_GRACE_SECONDS -- which leaves time for the squeue/qstat snapshot and
+# the cached builds to catch up with jobs that just started -- at most
+# ORPHAN_CANCEL_MAX per poll. A buildkite job is waiting in these states:
+WAITING_JOB_STATES = {'scheduled'}
+ORPHAN_GRACE_SECONDS = 5 * 60
+ORPHAN_CANCEL_MAX = 200
 
-    current_jobs = scheduler.current_jobs(logger)
-    logger.info(f"Current jobs (submitted or started): {len(current_jobs)}")
-    logger.debug(f"Current jobs: {current_jobs}")
+# Held for the lifetime of a poller, so cron runs and the daemon never overlap
+LOCK_FILE = joinpath(BUILDKITE_PATH, '.poll.lock')
 
-    # Count active (submitted + running) Slurm jobs per pipeline, so we can
-    # enforce per-pipeline concurrency caps below. Updated in-loop as we submit.
-    pipeline_counts = {}
-    for url, slurm_ids in current_jobs.items():
-        slug = pipeline_slug_from_url(url)
-        if slug:
-            pipeline_counts[slug] = pipeline_counts.get(slug, 0) + len(slurm_ids)
+# Daemon mode (`poll.py --daemon`): the poll interval drops to the minimum
+# whenever a poll saw jobs waiting on this queue, and doubles after each idle
+# poll up to the maximum.
+DAEMON_MIN_INTERVAL = 5
+DAEMON_MAX_INTERVAL = 60
+# Between daemon polls, reuse the last squeue/qstat snapshot (plus our own
+# submissions and cancellations) for this long before querying it again
+CURRENT_JOBS_TTL = 30
+# Between daemon polls, check the webhook spool (see bin/webhook.py) this
+# often and handle new events right away
+SPOOL_CHECK_INTERVAL = 1
 
-    # poll the buildkite API to check if there are any scheduled/running builds
-    builds = all_started_builds(NHOURS)
+class PollState:
+    """State kept warm across polls in daemon mode. A one-shot (cron) poll
+    builds a fresh one."""
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler or job_schedulers.get_job_scheduler()
+        self.build_cache = BuildCache()
+        self.current_jobs = None
+        self.current_jobs_time = 0.0
 
-    # Accumulate jobs to be canceled in one batch 
-    jobs_to_cancel = []
-    # loop over all scheduled and running builds for all pipelines in the buildkite org
-    for build in builds:
+    def refresh_current_jobs(self, max_age=0):
+        if self.current_jobs is None or time.time() - self.current_jobs_time >= max_age:
+            with metrics.timer('current_jobs'):
+                self.current_jobs = self.scheduler.current_jobs(logger)
+            self.current_jobs_time = time.time()
+        return self.current_jobs
 
-        pipeline = build['pipeline']
-        pipeline_name = pipeline['name']
+def submit_before_deadline(scheduler, log_dir, job, deadline):
+    """Submit `job` unless the poll's submission deadline already passed by the
+    time a worker picks it up. Returns (submitted, hpc job id or None)."""
+    if time.time() > deadline:
+        return False, None
+    with metrics.timer('submit_job', job.web_url):
+        return True, scheduler.submit_job(logger, log_dir, job)
 
-        # for all jobs in this build
-        for job in build['jobs']:
+def pipeline_limit(slug):
+    return PIPELINE_LIMITS.get(slug, DEFAULT_PIPELINE_LIMIT)
 
-            # jobid, jobtype are attributes in every job object
-            jobid, jobtype = job['id'], job['type']
+class SubmitRound:
+    """One pass of the submission path, shared by the API poll and the webhook
+    spool: collects the jobs to submit and cancel, submits them in fair-share
+    order on a thread pool and cancels in one batch at the end."""
+    def __init__(self, scheduler, current_jobs):
+        self.scheduler = scheduler
+        self.current_jobs = current_jobs
+        # Sum the resources of active (submitted + running) Slurm jobs per
+        # pipeline, so we can enforce per-pipeline caps. Updated as we submit.
+        self.pipeline_usage = {}
+        for url, hpc_jobs in current_jobs.items():
+            slug = pipeline_slug_from_url(url)
+            for hpc_job in hpc_jobs:
+                self.pipeline_usage[slug] = (
+                    self.pipeline_usage.get(slug, job_schedulers.Resources()) + hpc_job.resources
+                )
+        # Queue-wide budget of in-flight resources
+        self.inflight_limits = dict(fair_share.QUEUE_INFLIGHT_LIMITS.get(
+            BUILDKITE_QUEUE, fair_share.DEFAULT_INFLIGHT_LIMITS
+        ))
+        user_job_limit = scheduler.user_job_limit(logger)
+        if user_job_limit is not None:
+            self.inflight_limits['jobs'] = min(
+                self.inflight_limits.get('jobs', user_job_limit), user_job_limit
+            )
+        # Jobs to submit, planned by `submit`: buildkite url -> (slug, waiting
+        # since, requested Resources, (job, log_dir, pipeline name))
+        self.candidates = {}
+        # Requested resources of the jobs being submitted, and when they were
+        # queued for submission, by buildkite url
+        self.requested = {}
+        self.queued_at = {}
+        # Submissions in flight on the pool, mapped to their buildkite url
+        self.pool = ThreadPoolExecutor(max_workers=SUBMIT_WORKERS)
+        self.submissions = {}
+        self.submitting = set()
+        self.deadline = time.time() + SUBMIT_DEADLINE
+        # Accumulate jobs to be canceled in one batch
+        self.jobs_to_cancel = []
+        self.canceled_urls = []
+        # Canceled while their submission was in flight, canceled after `wait`
+        self.cancel_after_wait = []
+        # Scheduled jobs seen on this queue (submitted or deferred)
+        self.waiting = 0
 
-            # don't schedule non-script jobs on slurm
-            if jobtype != 'script':
-                continue
+    def close(self):
+        self.pool.shutdown()
 
-            # this job is a script job, check if it has a scheduled state
-            # and not submitted as slurm job
-            # valid states: running, scheduled, passed, failed, blocked,
-            #               canceled, canceling, skipped, not_run, finished
-            # https://buildkite.com/docs/pipelines/defining-steps#build-states
-            jobstate = job['state']
-            buildkite_url = job['web_url']
-
-            # Cancel jobs marked by buildkite as 'canceled'
-            if jobstate == 'canceled':
-                if buildkite_url in current_jobs:
-                    logger.debug(f"Cancel job: {buildkite_url}")
-                    jobs_to_cancel.append(current_jobs[buildkite_url])
-                continue
+    def consider(self, build, job):
+        """Submit, defer or cancel one job of `build`."""
+        pipeline_name = build.pipeline_name
 
-            # jobstate is not pending, or a scheduled job (but not running yet)
-            # is already submitted to slurm
-            if jobstate != 'scheduled' or buildkite_url in current_jobs:
-                continue
+        # jobid, jobtype are attributes in every job object
+        jobid, jobtype = job.id, job.type
+
+        # don't schedule non-script jobs on slurm
+        if jobtype != 'script':
+            return
+
+        # this job is a script job, check if it has a scheduled state
+        # and not submitted as slurm job
+        # valid states: running, scheduled, passed, failed, blocked,
+        #               canceled, canceling, skipped, not_run, finished
+        # https://buildkite.com/docs/pipelines/defining-steps#build-states
+        jobstate = job.state
+        buildkite_url = job.web_url
+
+        # Cancel jobs marked by buildkite as 'canceled'
+        if jobstate == 'canceled':
+            self.cancel(buildkite_url)
+            return
 
-            # Directory containing slurm logs for given build
-            log_dir = joinpath(
-                BUILDKITE_PATH,
-                'logs',
-                f'{date.today()}',
-                f"build_{build['id']}",
+        # jobstate is not pending, or a scheduled job (but not running yet)
+        # is already submitted to slurm (or collected in this round)
+        if (jobstate != 'scheduled' or buildkite_url in self.current_jobs
+                or buildkite_url in self.submitting or buildkite_url in self.candidates):
+            return
+
+        # Directory containing slurm logs for given build
+        log_dir = joinpath(
+            BUILDKITE_PATH,
+            'logs',
+            f'{date.today()}',
+            f"build_{build.id}",
+        )
+
+        job_tags = get_buildkite_job_tags(job)
+        queue = job_tags.get('queue', None)
+
+        # Create the directory prefix if it does not exist
+        if not os.path.isdir(log_dir):
+            build_link = build_url(pipeline_name, build.number)
+            logger.info(f"New build on `{queue}`: {pipeline_name} - {build_link}")
+            os.makedirs(log_dir, exist_ok=True)
+
+        # Only log jobs on current queue unless debugging or missing queue
+        if queue is None:
+            logger.error(f"New job missing queue. Pipeline: {pipeline_name}, {buildkite_url}")
+            return
+        elif queue == BUILDKITE_QUEUE:
+            self.waiting += 1
+            metrics.count('seen')
+            self.candidates[buildkite_url] = (
+                pipeline_slug_from_url(buildkite_url),
+                fair_share.waiting_since(job.scheduled_at, time.time()),
+                self.scheduler.requested_resources(logger, job),
+                (job, log_dir, pipeline_name),
             )
 
-            job_tags = get_buildkite_job_tags(job)
-            queue = job_tags.get('queue', None)
+    def submit(self):
+        """Start submitting the collected jobs, in fair-share order and up to
+        the in-flight budget. A deferred job stays 'scheduled' in buildkite
+        and is reconsidered on the next poll."""
+        if not self.candidates:
+            return
+        requested = {url: candidate[2] for url, candidate in self.candidates.items()}
+        planned, deferred = fair_share.plan(
+            list(self.candidates.values()), self.pipeline_usage, self.inflight_limits,
+            pipeline_limit,
+        )
+        self.candidates = {}
+        for job, log_dir, pipeline_name in planned:
+            slug = pipeline_slug_from_url(job.web_url)
+            logger.info(f"New job: {pipeline_name}, {job.web_url}")
+            future = self.pool.submit(
+                submit_before_deadline, self.scheduler, log_dir, job, self.deadline
+            )
+            self.submissions[future] = job.web_url
+            self.submitting.add(job.web_url)
+            # Count this submission so the caps hold for the rest of the round
+            self.requested[job.web_url] = requested[job.web_url]
+            self.queued_at[job.web_url] = time.time()
+            self.pipeline_usage[slug] = (
+                self.pipeline_usage.get(slug, job_schedulers.Resources()) + requested[job.web_url]
+            )
+        for (job, _, _), reason in deferred:
+            slug = pipeline_slug_from_url(job.web_url)
+            if reason == 'cap':
+                logger.info(
+                    f"Deferring job needing {requested[job.web_url]}, pipeline '{slug}' "
+                    f"at cap {pipeline_limit(slug)}: {job.web_url}"
+                )
+            else:
+                logger.debug(
+                    f"Deferring job needing {requested[job.web_url]}, queue at in-flight "
+                    f"budget {self.inflight_limits}: {job.web_url}"
+                )
+        metrics.count('deferred', len(deferred))
+        budget_deferred = sum(1 for _, reason in deferred if reason == 'budget')
+        if budget_deferred:
+            logger.info(
+                f"Queue at in-flight budget {self.inflight_limits}, "
+                f"left {budget_deferred} jobs for the next poll"
+            )
+
+    def cancel(self, buildkite_url):
+        """Cancel the hpc jobs running `buildkite_url`, if any."""
+        self.candidates.pop(buildkite_url, None)
+        if buildkite_url in self.submitting:
+            self.cancel_after_wait.append(buildkite_url)
+            return
+        if buildkite_url in self.current_jobs and buildkite_url not in self.canceled_urls:
+            logger.debug(f"Cancel job: {buildkite_url}")
+            self.jobs_to_cancel.append(self.current_jobs[buildkite_url])
+            self.canceled_urls.append(buildkite_url)
 
-            # Create the directory prefix if it does not exist
-            if not os.path.isdir(log_dir):
-                build_link = build_url(pipeline_name, build['number'])
-                logger.info(f"New build on `{queue}`: {pipeline_name} - {build_link}")
-                os.mkdir(log_dir)
+    def cancel_build(self, build):
+        if build.jobs:
+            for job in build.jobs:
+                if job.type == 'script':
+                    self.cancel(job.web_url)
+            return
+        # Build webhooks may come without their jobs: our jobs of the build
+        # are the current jobs under its url. Jobs not submitted yet are left
+        # to the poll, which skips canceled builds.
+        if build.web_url:
+            prefix = f'{build.web_url}#'
+            for buildkite_url in list(self.current_jobs):
+                if buildkite_url.startswith(prefix):
+                    self.cancel(buildkite_url)
 
-            # Only log jobs on current queue unless debugging or missing queue
-            if queue is None:
-                logger.error(f"New job missing queue. Pipeline: {pipeline_name}, {buildkite_url}")
+    def wait(self):
+        """Wait for the submissions in flight."""
+        late = 0
+        for future in as_completed(self.submissions):
+            buildkite_url = self.submissions[future]
+            try:
+                submitted, hpc_job_id = future.result()
+            except Exception:
+                logger.error(f"Caught exception submitting {buildkite_url}", exc_info=True)
+                metrics.count('failed')
+                continue
+            if not submitted:
+                late += 1
                 continue
-            elif queue == BUILDKITE_QUEUE:
-                # Enforce per-pipeline concurrency cap. A deferred job stays
-                # 'scheduled' in buildkite and is reconsidered on the next poll.
-                slug = pipeline_slug_from_url(buildkite_url)
-                limit = PIPELINE_LIMITS.get(slug, DEFAULT_PIPELINE_LIMIT)
-                if limit is not None and pipeline_counts.get(slug, 0) >= limit:
-                    logger.info(
-                        f"Deferring job, pipeline '{slug}' at cap {limit}: {buildkite_url}"
+            metrics.count('submitted' if hpc_job_id else 'failed')
+            if hpc_job_id:
+                try:
+                    latency.log_submission(
+                        buildkite_url, hpc_job_id, self.queued_at[buildkite_url], time.time()
                     )
+                except OSError as e:
+                    logger.warning(f"Failed to log the submission of {buildkite_url}: {e}")
+            # Keep the (possibly reused) snapshot in line with what we submitted
+            self.current_jobs[buildkite_url] = [
+                job_schedulers.SchedulerJob(str(hpc_job_id), self.requested[buildkite_url])
+            ] if hpc_job_id else []
+        self.submissions, self.submitting, self.requested = {}, set(), {}
+        self.queued_at = {}
+        for buildkite_url in self.cancel_after_wait:
+            self.cancel(buildkite_url)
+        self.cancel_after_wait = []
+        metrics.count('late', late)
+        if late:
+            logger.warning(
+                f"Submission deadline ({SUBMIT_DEADLINE}s) reached, "
+                f"left {late} jobs for the next poll"
+            )
+
+    def reconcile(self, job_states, orphans):
+        """Cancel our pending hpc jobs orphaned for ORPHAN_GRACE_SECONDS.
+        `job_states` maps buildkite urls to their job's state; `orphans` maps
+        hpc job ids to when they were first seen orphaned, and is updated."""
+        now = time.time()
+        seen, due = {}, {}
+        for url, hpc_jobs in self.current_jobs.items():
+            state = job_states.get(url)
+            if (state is None or state in WAITING_JOB_STATES
+                    or url in self.canceled_urls or url in self.submitting):
+                continue
+            for hpc_job in hpc_jobs:
+                if not hpc_job.pending:
                     continue
-                logger.info(f"New job: {pipeline_name}, {buildkite_url}")
-                scheduler.submit_job(logger, log_dir, job)
-                # Count this submission so the cap holds within a single poll pass
-                pipeline_counts[slug] = pipeline_counts.get(slug, 0) + 1
-
-    # Cancel jobs in canceled builds
-    canceled_builds = all_canceled_builds()
-
-    for build in canceled_builds:
-        for job in build['jobs']:
-            if job['type'] == 'script':
-                buildkite_url = job['web_url']
-                if buildkite_url in current_jobs:
-                    jobs_to_cancel.append(current_jobs[buildkite_url])
-
-    # Cancel individually marked hpc jobs in one call
-    if jobs_to_cancel:
-        logger.debug(f"Jobs to cancel: {jobs_to_cancel}")
-        scheduler.cancel_jobs(logger, jobs_to_cancel)
-
-except Exception:
-    logger.error("Caught exception during poll",  exc_info=True)
+                seen[hpc_job.id] = orphans.get(hpc_job.id, now)
+                if now - seen[hpc_job.id] >= ORPHAN_GRACE_SECONDS:
+                    due.setdefault(url, []).append(hpc_job)
+        orphans.clear()
+        orphans.update(seen)
+
+        canceled = 0
+        for url, hpc_jobs in due.items():
+            if canceled >= ORPHAN_CANCEL_MAX:
+                logger.warning(
+                    f"Canceled {canceled} orphaned jobs, leaving the rest for the next poll"
+                )
+                break
+            logger.info(
+                f"Cancel orphaned jobs {[j.id for j in hpc_jobs]}: {url} is {job_states[url]}"
+            )
+            self.jobs_to_cancel.append(hpc_jobs)
+            for hpc_job in hpc_jobs:
+                orphans.pop(hpc_job.id)
+            # Keep the snapshot's started jobs of the url, if any
+            remaining = [j for j in self.current_jobs[url] if j not in hpc_jobs]
+            if remaining:
+                self.current_jobs[url] = remaining
+            else:
+                self.canceled_urls.append(url)
+            canceled += len(hpc_jobs)
+        metrics.count('orphaned', canceled)
+
+    def finish_cancels(self):
+        # Cancel individually marked hpc jobs in one call
+        if self.jobs_to_cancel:
+            logger.debug(f"Jobs to cancel: {self.jobs_to_cancel}")
+            with metrics.timer('cancel_jobs'):
+                self.scheduler.cancel_jobs(logger, self.jobs_to_cancel)
+            metrics.count('canceled', len(self.jobs_to_cancel))
+            for url in self.canceled_urls:
+                self.current_jobs.pop(url, None)
+            self.jobs_to_cancel, self.canceled_urls = [], []
+
+def take_spooled_events(submit_round):
+    """Feed the webhook events waiting in the spool to `submit_round`. Returns
+    the claimed spool paths, to be released with `spool.done` once the round
+    went through. Events that can't be handled are moved aside with
+    `spool.reject`, so they don't block later rounds."""
+    events = spool.claim_events()
+    if events:
+        logger.debug(f"Spooled webhook events: {len(events)}")
+        metrics.count('webhook_events', len(events))
+    paths = []
+    for path, event in events:
+        try:
+            build = Build.from_dict(event['build'])
+            if event['event'] == 'job.scheduled':
+                for job in build.jobs:
+                    submit_round.consider(build, job)
+            else:
+                submit_round.cancel_build(build)
+        except Exception:
+            logger.error(f"Rejecting spooled event {path}", exc_info=True)
+            spool.reject(path)
+            continue
+        paths.append(path)
+    return paths
+
+def consume_spool(state):
+    """Handle the webhook events waiting in the spool right away, between
+    polls: submit newly scheduled jobs and cancel jobs of canceled builds."""
+    submit_round = None
+    try:
+        current_jobs = state.refresh_current_jobs(CURRENT_JOBS_TTL)
+        submit_round = SubmitRound(state.scheduler, current_jobs)
+        paths = take_spooled_events(submit_round)
+        submit_round.submit()
+        submit_round.wait()
+        submit_round.finish_cancels()
+        for path in paths:
+            spool.done(path)
+    except Exception:
+        logger.error("Caught exception handling spooled events", exc_info=True)
+        state.current_jobs = None
+    finally:
+        if submit_round is not None:
+            submit_round.close()
+
+def poll(state, current_jobs_ttl=0):
+    """Run one poll cycle. Returns the number of scheduled jobs seen on this
+    queue (submitted or deferred), which the daemon uses to pick its next
+    interval. Phase timings and job counts are written out through `metrics`."""
+    started = time.time()
+    waiting = 0
+    submit_round = None
+    ok = False
+    try:
+        current_jobs = state.refresh_current_jobs(current_jobs_ttl)
+        logger.info(f"Current jobs (submitted or started): {len(current_jobs)}")
+        logger.debug(f"Current jobs: {current_jobs}")
+        state.build_cache.track_jobs(current_jobs)
+
+        # Runtimes, node health and usage, read by every submission
+        state.scheduler.refresh_histories(logger)
+
+        submit_round = SubmitRound(state.scheduler, current_jobs)
+
+        # Jobs stuck pending are canceled, and submitted again differently by
+        # the next poll, as their buildkite jobs are still scheduled
+        with metrics.timer('stuck_jobs'):
+            stuck = state.scheduler.stuck_jobs(logger, current_jobs)
+        for buildkite_url, _ in stuck:
+            submit_round.cancel(buildkite_url)
+        metrics.count('rerouted', len(stuck))
+
+        # Webhook events first, they may be newer than the build cache
+        spooled = take_spooled_events(submit_round)
+
+        # poll the buildkite API to check if there are any scheduled/running builds.
+        # Only builds created or changed since the last poll are downloaded; the
+        # rest come from the on-disk build cache.
+        builds = metrics.timed('fetch_builds', state.build_cache.started_builds(logger, NHOURS))
+
+        # loop over all scheduled and running builds for all pipelines in the buildkite org
+        for build in builds:
+            # for all jobs in this build
+            for job in build.jobs:
+                # Its HPC job ended since the build was last read: it is most
+                # likely not scheduled anymore, wait for the build's re-check
+                if job.state == 'scheduled' and state.build_cache.awaiting_recheck(build, job):
+                    continue
+                submit_round.consider(build, job)
+
+        # Submit everything collected, spooled and listed, in fair-share order
+        submit_round.submit()
+        submit_round.wait()
+
+        # Cancel jobs in canceled builds. Active builds were handled above,
+        # so only look up the builds of our current jobs that left the
+        # active set (finished, canceling, or older than the window).
+        with metrics.timer('canceled_builds'):
+            inactive_builds = state.build_cache.inactive_builds(logger, current_jobs)
+
+        for build in inactive_builds:
+            if build.state in CANCELED_STATES:
+                submit_round.cancel_build(build)
+            else:
+                for job in build.jobs:
+                    if job.type == 'script' and job.state == 'canceled':
+                        submit_round.cancel(job.web_url)
+
+        submit_round.reconcile(
+            state.build_cache.job_states(current_jobs), state.build_cache.orphans
+        )
+        submit_round.finish_cancels()
+        waiting = submit_round.waiting
+
+        for path in spooled:
+            spool.done(path)
+
+        # Only advance the cursor once the whole poll went through
+        state.build_cache.save()
+        ok = True
+
+    except Exception:
+        logger.error("Caught exception during poll",  exc_info=True)
+        # Submissions may have gone through unrecorded, re-read the scheduler
+        state.current_jobs = None
+    finally:
+        if submit_round is not None:
+            submit_round.close()
+        try:
+            metrics.METRICS.write(ok, started)
+        except OSError as e:
+            logger.warning(f"Failed to write poll metrics: {e}")
+
+    return waiting
+
+def acquire_lock():
+    """Take the poller lock without blocking. Returns the open lock file (keep
+    it referenced to hold the lock) or None if another poller holds it."""
+    lock = open(LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+def log_to_daily_file():
+    """Point the log handler at logs/<date>/cron, like cron.sh does for
+    one-shot polls, switching files when the date changes."""
+    global handler
+    path = joinpath(BUILDKITE_PATH, 'logs', f'{date.today()}', 'cron')
+    if getattr(handler, 'baseFilename', None) == path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    new_handler = logging.FileHandler(path)
+    new_handler.setLevel(handler.level)
+    new_handler.setFormatter(formatter)
+    logger.addHandler(new_handler)
+    logger.removeHandler(handler)
+    handler.close()
+    handler = new_handler
+
+def source_mtime():
+    """Latest modification time of the poller's own modules, so the daemon can
+    exit (and be restarted by cron) after an update."""
+    bindir = os.path.dirname(os.path.abspath(__file__))
+    return max(
+        os.path.getmtime(joinpath(bindir, name))
+        for name in os.listdir(bindir) if name.endswith('.py')
+    )
+
+def run_daemon(state):
+    started_mtime = source_mtime()
+    interval = DAEMON_MIN_INTERVAL
+    logger.info(f"Starting poll daemon (pid {os.getpid()}) on `{BUILDKITE_QUEUE}`")
+    while True:
+        log_to_daily_file()
+        waiting = poll(state, current_jobs_ttl=CURRENT_JOBS_TTL)
+        if waiting:
+            interval = DAEMON_MIN_INTERVAL
+        else:
+            interval = min(interval * 2, DAEMON_MAX_INTERVAL)
+        if source_mtime() != started_mtime:
+            logger.info("Poller source changed, exiting so cron restarts the daemon")
+            return
+        next_poll = time.time() + interval
+        while time.time() < next_poll:
+            if spool.has_events():
+                consume_spool(state)
+            time.sleep(max(0, min(SPOOL_CHECK_INTERVAL, next_poll - time.time())))
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit scheduled Buildkite jobs to the HPC scheduler")
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help="keep polling with an adaptive interval instead of polling once",
+    )
+    args = parser.parse_args()
+
+    lock = acquire_lock()
+    if lock is None:
+        # A one-shot poll while the daemon is running is expected, stay quiet
+        if not args.daemon:
+            logger.debug("Another poller holds the lock, skipping this poll")
+        sys.exit(0)
+
+    try:
+        state = PollState()
+    except Exception:
+        logger.error("Caught exception during poll setup", exc_info=True)
+        return
+
+    if args.daemon:
+        run_daemon(state)
+    else:
+        poll(state)
+
+if __name__ == '__main__':
+    main()
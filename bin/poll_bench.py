@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+"""Record/replay harness and benchmark for a full poll cycle.
+
+  poll_bench.py record FIXTURES   record the Buildkite builds and the squeue/
+                                  sinfo/scontrol/qstat output seen by one poll
+  poll_bench.py synth FIXTURES    generate synthetic fixtures
+  poll_bench.py replay FIXTURES   replay fixtures through poll.py and report
+                                  per-phase timings and peak memory
+
+Nothing is ever submitted or canceled: sbatch/qsub/scancel/qdel are replaced
+by stand-ins that log their argv to `<workdir>/submissions.log`. Replay runs
+against a throwaway BUILDKITE_PATH, so it never touches a live poller's build
+cache or job store.
+
+A fixture directory holds:
+  meta.json      queue, scheduler and the time the fixtures were recorded
+  builds.json    raw Buildkite build objects, newest first
+  cmd/           scheduler command output, one file per command line
+                 (`<cmd>-<args>.out`), with `<cmd>.out` as a catch-all
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from os.path import join as joinpath
+from urllib.parse import urlparse, parse_qs
+
+BINDIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scheduler commands whose output is recorded and replayed
+READ_COMMANDS = ['squeue', 'sinfo', 'scontrol', 'qstat', 'sacct', 'sacctmgr']
+# Scheduler commands that change state; always replaced by argv loggers
+WRITE_COMMANDS = ['sbatch', 'qsub', 'scancel', 'qdel']
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def _parse_iso(value):
+    return datetime.strptime(value.split('.')[0].rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+
+def _iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def command_key(args):
+    """File-name-safe key for a command line. Must match the shell version in
+    `_read_stub`."""
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', ' '.join(args))[:200]
+
+# --- Stand-in scheduler binaries ---------------------------------------------
+
+_KEY_SH = """key=$(printf '%s' "$*" | tr -c 'A-Za-z0-9_.-' '_' | cut -c1-200)"""
+
+def _write_stub(path, body):
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n' + body)
+    os.chmod(path, 0o755)
+
+def _write_stub_submitters(stub_dir, workdir):
+    log = joinpath(workdir, 'submissions.log')
+    # sbatch --parsable and qsub both print the new job id first; the pid is
+    # unique enough for one run
+    # Submitted Slurm jobs show up in later squeue calls, like the real thing
+    queued = joinpath(workdir, 'squeue.submitted')
+    _write_stub(joinpath(stub_dir, 'sbatch'), f"""echo "sbatch $*" >> {log}
+for arg in "$@"; do
+    case "$arg" in --comment=*) echo "$$|1:05:00|cpu=1,node=1|PD|None|$(date +%Y-%m-%dT%H:%M:%S)|(null)|${{arg#--comment=}}" >> {queued} ;; esac
+done
+echo $$
+""")
+    _write_stub(joinpath(stub_dir, 'qsub'), f'echo "qsub $*" >> {log}\necho $$.bench\n')
+    _write_stub(joinpath(stub_dir, 'scancel'), f'echo "scancel $*" >> {log}\n')
+    _write_stub(joinpath(stub_dir, 'qdel'), f'echo "qdel $*" >> {log}\n')
+
+def _read_stub(fixtures, workdir, name):
+    cmd_dir = joinpath(fixtures, 'cmd')
+    stub = f"""{_KEY_SH}
+if [ -f "{cmd_dir}/{name}-$key.out" ]; then
+    cat "{cmd_dir}/{name}-$key.out"
+elif [ -f "{cmd_dir}/{name}.out" ]; then
+    cat "{cmd_dir}/{name}.out"
+fi
+"""
+    if name == 'squeue':
+        stub += f"""case "$*" in *--name=buildkite*) cat {joinpath(workdir, 'squeue.submitted')} 2>/dev/null ;; esac
+"""
+    return stub
+
+def _record_stub(fixtures, name, real):
+    cmd_dir = joinpath(fixtures, 'cmd')
+    return f"""{_KEY_SH}
+"{real}" "$@" | tee "{cmd_dir}/{name}-$key.out"
+"""
+
+# --- Buildkite API stand-in --------------------------------------------------
+
+def _make_response(request, status, body=None, headers=None):
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    resp = requests.Response()
+    resp.status_code = status
+    # Served through `raw`, so streamed reads behave as they do over the wire
+    resp.raw = io.BytesIO(json.dumps(body).encode() if body is not None else b'')
+    resp.headers = CaseInsensitiveDict(headers or {})
+    resp.headers.setdefault('Content-Type', 'application/json')
+    resp.url = request.url
+    resp.request = request
+    resp.encoding = 'utf-8'
+    return resp
+
+def _etag(build):
+    return '"' + hashlib.md5(json.dumps(build, sort_keys=True).encode()).hexdigest() + '"'
+
+def make_replay_adapter(builds, offset, faults=0.0, rng=None):
+    """A requests transport adapter that answers Buildkite builds API calls
+    from `builds`: list endpoints (org and pipeline) with state and time
+    filters and Link pagination, and single-build GETs with ETags. Fixture
+    timestamps are shifted forward by `offset`, so a replay sees the same
+    window that was recorded. A `faults` fraction of requests fail with a
+    503 or a 429, to exercise retries."""
+    from requests.adapters import BaseAdapter
+
+    by_number = {(b['pipeline']['slug'], b['number']): b for b in builds}
+    # Shift and parse fixture timestamps once, not on every request
+    created = {b['id']: _parse_iso(b['created_at']) + offset for b in builds if b.get('created_at')}
+    finished = {b['id']: _parse_iso(b['finished_at']) + offset for b in builds if b.get('finished_at')}
+    # Filtered build lists by (path, filters), so paging through one listing
+    # filters the fixtures once
+    listings = {}
+
+    def listing(path, query):
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in query.items() if k not in ('page', 'per_page'))))
+        if key in listings:
+            return listings[key]
+        selected = builds
+        m = re.search(r'/pipelines/([^/]+)/builds$', path)
+        if m:
+            selected = [b for b in selected if b['pipeline']['slug'] == m.group(1)]
+        if 'state[]' in query:
+            selected = [b for b in selected if b['state'] in query['state[]']]
+        if 'created_from' in query:
+            since = _parse_iso(query['created_from'][0])
+            selected = [b for b in selected if b['id'] in created and created[b['id']] >= since]
+        if 'finished_from' in query:
+            since = _parse_iso(query['finished_from'][0])
+            selected = [b for b in selected if b['id'] in finished and finished[b['id']] >= since]
+        listings[key] = selected
+        return selected
+
+    class ReplayAdapter(BaseAdapter):
+        requests = 0
+
+        def send(self, request, **kwargs):
+            ReplayAdapter.requests += 1
+            if faults and rng.random() < faults:
+                if rng.random() < 0.5:
+                    return _make_response(request, 503, {'message': 'Service Unavailable'})
+                return _make_response(request, 429, {'message': 'Too Many Requests'},
+                                      {'RateLimit-Remaining': '0', 'RateLimit-Reset': '0'})
+            url = urlparse(request.url)
+            query = parse_qs(url.query)
+            m = re.search(r'/pipelines/([^/]+)/builds/(\d+)$', url.path)
+            if m:
+                build = by_number.get((m.group(1), int(m.group(2))))
+                if build is None:
+                    return _make_response(request, 404, {'message': 'Not Found'})
+                etag = _etag(build)
+                if request.headers.get('If-None-Match') == etag:
+                    return _make_response(request, 304, None, {'ETag': etag})
+                return _make_response(request, 200, build, {'ETag': etag})
+
+            selected = listing(url.path, query)
+            page = int(query.get('page', ['1'])[0])
+            per_page = int(query.get('per_page', ['30'])[0])
+            last = max(1, -(-len(selected) // per_page))
+            headers = {}
+            if page < last:
+                base = f'{url.scheme}://{url.netloc}{url.path}?per_page={per_page}'
+                headers['Link'] = (
+                    f'<{base}&page={page + 1}>; rel="next", <{base}&page={last}>; rel="last"'
+                )
+            body = selected[(page - 1) * per_page:page * per_page]
+            return _make_response(request, 200, body, headers)
+
+        def close(self):
+            pass
+
+    return ReplayAdapter()
+
+def make_recording_adapter(recorded):
+    """Wraps the normal HTTPS adapter and keeps every build object returned
+    by the builds API in `recorded` (build id -> build)."""
+    from requests.adapters import HTTPAdapter
+
+    class RecordingAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            resp = super().send(request, **kwargs)
+            if resp.status_code == 200 and '/builds' in request.url:
+                body = resp.json()
+                for build in body if isinstance(body, list) else [body]:
+                    if isinstance(build, dict) and 'id' in build:
+                        recorded[build['id']] = build
+            return resp
+
+    return RecordingAdapter()
+
+# --- Phase timing ------------------------------------------------------------
+
+class PhaseTimer:
+    """Accumulates call counts and wall time per phase, from any thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.first = {}  # phase -> perf_counter at the start of its first call
+
+    def add(self, phase, start, elapsed):
+        with self.lock:
+            calls, total = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = (calls + 1, total + elapsed)
+            self.first.setdefault(phase, start)
+
+    def wrap(self, phase, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(phase, start, time.perf_counter() - start)
+        return timed
+
+    def wrap_iter(self, phase, fn):
+        """Like `wrap` for a generator function: times producing the items,
+        not the caller's work in between."""
+        def timed(*args, **kwargs):
+            iterator = fn(*args, **kwargs)
+            first, elapsed = None, 0.0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    first = first or start
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield item
+            finally:
+                self.add(phase, first or time.perf_counter(), elapsed)
+        return timed
+
+    def report(self, out=sys.stdout):
+        print(f"{'phase':<20} {'calls':>8} {'total s':>10} {'mean ms':>10}", file=out)
+        for phase, (calls, total) in self.phases.items():
+            print(f"{phase:<20} {calls:>8} {total:>10.3f} {1000 * total / calls:>10.3f}", file=out)
+
+# --- Commands ----------------------------------------------------------------
+
+def _load_fixtures(fixtures):
+    with open(joinpath(fixtures, 'meta.json')) as f:
+        meta = json.load(f)
+    opener = gzip.open if os.path.exists(joinpath(fixtures, 'builds.json.gz')) else open
+    name = 'builds.json.gz' if opener is gzip.open else 'builds.json'
+    with opener(joinpath(fixtures, name), 'rt') as f:
+        builds = json.load(f)
+    return meta, builds
+
+def _prepare_env(workdir, queue, stub_dir):
+    """Point the poller at a throwaway BUILDKITE_PATH and the stand-in
+    binaries. Must run before the poller modules are imported."""
+    os.environ['BUILDKITE_PATH'] = workdir
+    os.environ['BUILDKITE_QUEUE'] = queue
+    os.environ.setdefault('BUILDKITE_API_TOKEN', 'bench')
+    os.environ['PATH'] = f"{stub_dir}:{os.environ['PATH']}"
+    sys.path.insert(0, BINDIR)
+
+def record(args):
+    """Run one poll against the live API and scheduler, with submissions and
+    cancellations replaced by argv loggers, and save what it read."""
+    buildkite_path = os.environ['BUILDKITE_PATH']
+    queue = os.environ['BUILDKITE_QUEUE']
+    if 'BUILDKITE_API_TOKEN' not in os.environ:
+        with open(joinpath(buildkite_path, '.buildkite_token')) as f:
+            os.environ['BUILDKITE_API_TOKEN'] = f.read().rstrip()
+
+    fixtures = os.path.abspath(args.fixtures)
+    os.makedirs(joinpath(fixtures, 'cmd'), exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix='poll_bench-')
+    stub_dir = joinpath(workdir, 'stubs')
+    os.makedirs(stub_dir)
+    for name in READ_COMMANDS:
+        real = shutil.which(name)
+        if real:
+            _write_stub(joinpath(stub_dir, name), _record_stub(fixtures, name, real))
+    _write_stub_submitters(stub_dir, workdir)
+    recorded_at = datetime.utcnow()
+    _prepare_env(workdir, queue, stub_dir)
+
+    import api_budget
+    import buildkite
+    import poll
+    # Draw from the live pollers' request budget, not the throwaway one
+    api_budget.BUDGET_FILE = joinpath(buildkite_path, '.api_budget')
+    recorded = {}
+    buildkite.SESSION.mount('https://', make_recording_adapter(recorded))
+    state = poll.PollState()
+    poll.poll(state)
+
+    scheduler = 'pbs' if type(state.scheduler).__name__ == 'PBSJobScheduler' else 'slurm'
+    with open(joinpath(fixtures, 'meta.json'), 'w') as f:
+        json.dump({
+            'queue': queue,
+            'scheduler': scheduler,
+            'recorded_at': recorded_at.strftime(ISO_FORMAT),
+        }, f, indent=2)
+    builds = sorted(recorded.values(), key=lambda b: b.get('created_at') or '', reverse=True)
+    with gzip.open(joinpath(fixtures, 'builds.json.gz'), 'wt') as f:
+        json.dump(builds, f)
+    print(f"Recorded {len(builds)} builds and {len(os.listdir(joinpath(fixtures, 'cmd')))} "
+          f"command outputs to {fixtures}; would-be submissions in {workdir}/submissions.log")
+
+def synth(args):
+    """Generate synthetic fixtures: `--builds` builds of `--jobs-per-build`
+    jobs, a fraction of them scheduled on the benchmark queue, plus squeue/
+    qstat listings of `--queued` jobs and a GPU partition for spill checks."""
+    rng = random.Random(args.seed)
+    fixtures = os.path.abspath(args.fixtures)
+    os.makedirs(joinpath(fixtures, 'cmd'), exist_ok=True)
+    now = datetime.utcnow().replace(microsecond=0)
+    queues = [args.queue, 'other-a', 'other-b']
+    # With --relevant-fraction, each pipeline sends all its jobs to one home
+    # queue, the benchmark queue for that fraction of them
+    home_queues = {
+        f'pipeline-{p}': args.queue if rng.random() < args.relevant_fraction else rng.choice(queues[1:])
+        for p in range(args.pipelines)
+    } if args.relevant_fraction is not None else {}
+
+    builds = []
+    for i in range(args.builds):
+        slug = f'pipeline-{rng.randrange(args.pipelines)}'
+        number = i + 1
+        created = now - timedelta(seconds=rng.randrange(int(timedelta(hours=90).total_seconds())))
+        jobs = []
+        for k in range(args.jobs_per_build):
+            queue = home_queues.get(slug) or rng.choice(queues)
+            state = 'scheduled' if rng.random() < args.scheduled_fraction else \
+                rng.choice(['running', 'passed', 'waiting', 'canceled'])
+            rules = [f'queue={queue}']
+            if rng.random() < args.gpu_fraction:
+                rules += ['slurm_gpus=1', 'slurm_ntasks=1']
+            else:
+                rules += [f'slurm_ntasks={rng.choice([1, 2, 4])}', 'slurm_mem=8G']
+            job_id = f'{i:06d}-{k:03d}-0000-0000-000000000000'
+            jobs.append({
+                'id': job_id,
+                'type': 'script',
+                'name': f'step {k}',
+                'step_key': f'step-{k}',
+                'state': state,
+                'web_url': f'https://buildkite.com/clima/{slug}/builds/{number}#{job_id}',
+                'agent_query_rules': rules,
+                'command': 'julia --project -e "using Pkg; Pkg.test()"',
+                'env': {'JULIA_NUM_THREADS': '4'},
+                'scheduled_at': _iso(created),
+                'created_at': _iso(created),
+            })
+        builds.append({
+            'id': f'build-{i:06d}',
+            'number': number,
+            'state': rng.choice(['running', 'running', 'failing', 'scheduled']),
+            'created_at': _iso(created),
+            'finished_at': None,
+            'web_url': f'https://buildkite.com/clima/{slug}/builds/{number}',
+            'message': 'Synthetic build ' * 4,
+            'pipeline': {'name': slug, 'slug': slug, 'description': 'Synthetic pipeline'},
+            'jobs': jobs,
+        })
+    builds.sort(key=lambda b: b['created_at'], reverse=True)
+
+    # Some of the scheduled jobs are already queued, the rest of the queue
+    # belongs to jobs we don't see in builds
+    our_jobs = [j['web_url'] for b in builds for j in b['jobs']
+                if j['state'] == 'scheduled' and f'queue={args.queue}' in j['agent_query_rules']]
+    queued = rng.sample(our_jobs, min(len(our_jobs) // 2, args.queued))
+    queued += [f'https://buildkite.com/clima/gone/builds/1#{n}' for n in range(args.queued - len(queued))]
+    # Cancel some builds after their jobs were queued, for the cancellation sweep
+    for build in rng.sample(builds, int(len(builds) * args.canceled_fraction)):
+        build['state'] = 'canceled'
+        build['finished_at'] = _iso(_parse_iso(build['created_at']) + timedelta(minutes=5))
+        for job in build['jobs']:
+            if job['state'] in ('scheduled', 'running'):
+                job['state'] = 'canceled'
+    with open(joinpath(fixtures, 'cmd', 'squeue.out'), 'w') as f:
+        for n, url in enumerate(queued):
+            tres = 'cpu=1,mem=8G,node=1,billing=1,gres/gpu=1' if n % 3 == 0 else 'cpu=4,mem=8G,node=1,billing=4'
+            f.write(f'{100000 + n}|1:05:00|{tres}|PD|Priority|2024-01-01T00:00:00|(null)|{url}\n')
+    with open(joinpath(fixtures, 'cmd', 'qstat.out'), 'w') as f:
+        f.write('Job id            Name             User              Time Use S Queue\n')
+        f.write('----------------  ---------------- ----------------  -------- - -----\n')
+        for n in range(args.queued):
+            f.write(f'{100000 + n}.desched1  buildkite  svc  00:00:00 Q preempt\n')
+    # A GPU partition with a congested preferred type, for the spill checks
+    gpu_types = ['p100', 'v100', 'nvidia_l40s', 'h100']
+    with open(joinpath(fixtures, 'cmd', 'sinfo.out'), 'w') as f:
+        for n in range(64):
+            t = gpu_types[n % len(gpu_types)]
+            used = 4 if t == 'p100' else rng.randrange(5)
+            f.write(f'hpc-{n:03d}|mix|gpu:{t}:4(S:0-1)|gpu:{t}:{used}(IDX:0-3)\n')
+    pending_key = command_key(['-h', '-p', 'gpu', '-t', 'PD', '-O', 'tres-per-node:60'])
+    with open(joinpath(fixtures, 'cmd', f'squeue-{pending_key}.out'), 'w') as f:
+        f.write('gres/gpu:p100:1\n' * 40)
+    with open(joinpath(fixtures, 'cmd', 'scontrol.out'), 'w') as f:
+        f.write('ReservationName=bench Nodes=(null)\n')
+    if args.bf_max_job_user:
+        with open(joinpath(fixtures, 'cmd', f"scontrol-{command_key(['show', 'config'])}.out"), 'w') as f:
+            f.write(f'SchedulerParameters     = bf_interval=30,bf_max_job_user={args.bf_max_job_user}\n')
+
+    with gzip.open(joinpath(fixtures, 'builds.json.gz'), 'wt') as f:
+        json.dump(builds, f)
+    with open(joinpath(fixtures, 'meta.json'), 'w') as f:
+        json.dump({
+            'queue': args.queue,
+            'scheduler': args.scheduler,
+            'recorded_at': now.strftime(ISO_FORMAT),
+        }, f, indent=2)
+    njobs = sum(len(b['jobs']) for b in builds)
+    print(f"Wrote {len(builds)} builds ({njobs} jobs, {len(our_jobs)} scheduled on "
+          f"`{args.queue}`) and {args.queued} queued jobs to {fixtures}")
+
+def replay(args):
+    fixtures = os.path.abspath(args.fixtures)
+    meta, builds = _load_fixtures(fixtures)
+    workdir = tempfile.mkdtemp(prefix='poll_bench-')
+    stub_dir = joinpath(workdir, 'stubs')
+    os.makedirs(stub_dir)
+    for name in READ_COMMANDS:
+        _write_stub(joinpath(stub_dir, name), _read_stub(fixtures, workdir, name))
+    _write_stub_submitters(stub_dir, workdir)
+    _prepare_env(workdir, meta['queue'], stub_dir)
+    offset = datetime.utcnow() - _parse_iso(meta['recorded_at'])
+
+    import logging
+    import api_budget
+    import buildkite
+    import job_schedulers
+    import poll
+    if not args.verbose:
+        poll.handler.setLevel(logging.WARNING)
+    if args.no_deadline:
+        poll.SUBMIT_DEADLINE = float('inf')
+    # The stand-in API has no rate limit, only keep the bucket's overhead
+    api_budget.BUDGET_PER_MINUTE = api_budget.BUDGET_BURST = 1e9
+    buildkite.RETRY_BASE = 0.01
+    adapter = make_replay_adapter(builds, offset, args.faults, random.Random(0))
+    buildkite.SESSION.mount('https://', adapter)
+    del builds
+
+    if meta['scheduler'] == 'pbs':
+        scheduler = job_schedulers.PBSJobScheduler()
+    else:
+        scheduler = job_schedulers.SlurmJobScheduler()
+
+    timer = PhaseTimer()
+    scheduler.current_jobs = timer.wrap('current_jobs', scheduler.current_jobs)
+    scheduler.submit_job = timer.wrap('submit_job', scheduler.submit_job)
+    scheduler.cancel_jobs = timer.wrap('cancel_jobs', scheduler.cancel_jobs)
+    job_schedulers.pick_spill_gpu_type = timer.wrap('spill_check', job_schedulers.pick_spill_gpu_type)
+    tags = timer.wrap('tag_parsing', buildkite.get_buildkite_job_tags)
+    poll.get_buildkite_job_tags = job_schedulers.get_buildkite_job_tags = tags
+    state = poll.PollState(scheduler)
+    state.build_cache.started_builds = timer.wrap_iter('fetch_builds', state.build_cache.started_builds)
+    state.build_cache.inactive_builds = timer.wrap('canceled_builds', state.build_cache.inactive_builds)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    for cycle in range(args.cycles):
+        timer.wrap(f'poll[{cycle}]', poll.poll)(state)
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+
+    log = joinpath(workdir, 'submissions.log')
+    submissions = sum(1 for _ in open(log)) if os.path.exists(log) else 0
+    timer.report()
+    if 'submit_job' in timer.first:
+        print(f"First submission:    {timer.first['submit_job'] - timer.first['poll[0]']:.3f} s into poll[0]")
+    print(f"API requests:        {adapter.requests}")
+    print(f"Scheduler commands:  {submissions} submissions/cancellations logged")
+    # ru_maxrss is in KiB on Linux
+    print(f"Peak RSS:            {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    if traced_peak is not None:
+        print(f"Peak Python heap:    {traced_peak / 2 ** 20:.1f} MiB")
+    if not args.keep:
+        shutil.rmtree(workdir)
+    else:
+        print(f"Work directory:      {workdir}")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record/replay harness and benchmark for poll.py",
+    )
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('record', help="record one live poll (BUILDKITE_PATH/BUILDKITE_QUEUE from the environment)")
+    p.add_argument('fixtures')
+    p.set_defaults(func=record)
+
+    p = sub.add_parser('synth', help="generate synthetic fixtures")
+    p.add_argument('fixtures')
+    p.add_argument('--queue', default='central')
+    p.add_argument('--scheduler', choices=['slurm', 'pbs'], default='slurm')
+    p.add_argument('--builds', type=int, default=1000)
+    p.add_argument('--jobs-per-build', type=int, default=10)
+    p.add_argument('--pipelines', type=int, default=50)
+    p.add_argument('--queued', type=int, default=1000, help="jobs already in squeue/qstat")
+    p.add_argument('--scheduled-fraction', type=float, default=0.02)
+    p.add_argument('--gpu-fraction', type=float, default=0.3)
+    p.add_argument('--canceled-fraction', type=float, default=0.01)
+    p.add_argument('--bf-max-job-user', type=int, default=0,
+                   help="per-user backfill window reported by scontrol show config (0: none)")
+    p.add_argument('--relevant-fraction', type=float, default=None,
+                   help="give each pipeline one home queue, this fraction of them the benchmark queue")
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=synth)
+
+    p = sub.add_parser('replay', help="replay fixtures through poll.py and report timings")
+    p.add_argument('fixtures')
+    p.add_argument('--cycles', type=int, default=1, help="polls to run; later ones use the warm build cache")
+    p.add_argument('--trace-memory', action='store_true', help="also report the tracemalloc peak (slower)")
+    p.add_argument('--no-deadline', action='store_true', help="disable the per-poll submission deadline")
+    p.add_argument('--faults', type=float, default=0.0, help="fraction of API requests that fail with 429/503")
+    p.add_argument('--keep', action='store_true', help="keep the work directory")
+    p.add_argument('--verbose', action='store_true', help="show the poller's log")
+    p.set_defaults(func=replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import time
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH
+from sqlite_store import SqliteStore
+
+# Slurm jobs stuck pending on something that won't go away by waiting: nodes
+# that are down or drained, a partition or reservation the job doesn't fit
+# (e.g. the reservation expired). Left alone, they sit in the queue until the
+# buildkite job times out. Each poll looks at the squeue reason of our pending
+# jobs; a job that has been pending for one of STUCK_REASONS for STUCK_SECONDS
+# is canceled, and its buildkite job (still scheduled) is submitted again by a
+# later poll with the next remediation of its url:
+#
+#   'no_reservation'     without the reservation the poller added
+#   'gpu_type=<type>'    with the next untried type of GPU_SPILL_FALLBACK
+#   'fail'               as a bk_error job, so the step fails right away
+#
+# A url gets at most MAX_REMEDIATIONS before it fails. Tags that set the
+# reservation or the GPU type explicitly are never overridden.
+REMEDIATION_FILE = joinpath(BUILDKITE_PATH, 'remediation.sqlite')
+
+# squeue reasons (up to the first comma) of jobs that can't start as
+# submitted. Resources, Priority, the QOS/association limits and so on are
+# normal waits.
+STUCK_REASONS = {
+    'ReqNodeNotAvail', 'PartitionConfig', 'PartitionNodeLimit', 'PartitionTimeLimit',
+    'PartitionDown', 'PartitionInactive', 'BadConstraints', 'ReservationDeleted',
+    'InvalidReservation', 'NodeDown',
+}
+STUCK_SECONDS = 30 * 60
+MAX_REMEDIATIONS = 3
+# Remediations older than this are forgotten
+REMEDIATION_DAYS = 7
+
+NO_RESERVATION = 'no_reservation'
+GPU_TYPE_PREFIX = 'gpu_type='
+FAIL = 'fail'
+
+def stuck_reason(reason):
+    """The reason of a pending job if it is one of STUCK_REASONS, else None."""
+    reason = (reason or '').split(',')[0].strip()
+    return reason if reason in STUCK_REASONS else None
+
+class RemediationStore(SqliteStore):
+    def __init__(self, path=REMEDIATION_FILE):
+        super().__init__(path)
+        with self._transaction() as db:
+            # Our pending jobs currently stuck, since when
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS stuck ('
+                ' job_id TEXT PRIMARY KEY,'
+                ' since REAL NOT NULL)'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS remediations ('
+                ' buildkite_url TEXT NOT NULL,'
+                ' action TEXT NOT NULL,'
+                ' job_id TEXT,'
+                ' reason TEXT,'
+                ' time REAL NOT NULL)'
+            )
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS remediations_url ON remediations (buildkite_url)'
+            )
+
+    def stuck_since(self, job_ids):
+        """Map each of `job_ids` (the jobs stuck right now) -> when it was
+        first seen stuck. Jobs no longer stuck are forgotten."""
+        now = time.time()
+        with self._transaction() as db:
+            since = dict(db.execute('SELECT job_id, since FROM stuck'))
+            current = {job_id: since.get(job_id, now) for job_id in job_ids}
+            db.execute('DELETE FROM stuck')
+            db.executemany('INSERT INTO stuck (job_id, since) VALUES (?, ?)', current.items())
+        return current
+
+    def record(self, buildkite_url, action, job_id, reason):
+        """Record that `job_id` of `buildkite_url` was canceled, stuck on
+        `reason`, to be submitted again with `action`."""
+        with self._transaction() as db:
+            db.execute(
+                'DELETE FROM remediations WHERE time < ?',
+                (time.time() - REMEDIATION_DAYS * 86400,),
+            )
+            db.execute(
+                'INSERT INTO remediations (buildkite_url, action, job_id, reason, time)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (buildkite_url, action, str(job_id), reason, time.time()),
+            )
+
+    def remediations(self, buildkite_url):
+        """(action, job id, reason) of the remediations of `buildkite_url`,
+        oldest first."""
+        with self._transaction() as db:
+            return db.execute(
+                'SELECT action, job_id, reason FROM remediations'
+                ' WHERE buildkite_url = ? ORDER BY time',
+                (buildkite_url,),
+            ).fetchall()
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH, pipeline_slug_from_url
+from sqlite_store import SqliteStore, chunks
+
+# How long each pipeline step's HPC jobs run, to request a time limit close to
+# that instead of DEFAULT_TIMELIMIT: backfill only starts a job in a gap its
+# time limit fits in. Each submission is recorded with its pipeline slug and
+# step (the step key, or the label for steps without one); the scheduler's
+# accounting (sacct, qstat -x) fills in how it ended and how long it ran. A
+# step gets a high percentile of its recent runtimes plus a margin, and goes
+# back to the default as soon as one of them timed out.
+RUNTIME_HISTORY_FILE = joinpath(BUILDKITE_PATH, 'runtimes.sqlite')
+
+# Jobs older than this are forgotten
+HISTORY_DAYS = 30
+# Accounting is read for unfinished jobs at most this often
+REFRESH_SECONDS = 600
+# The limit is computed from a step's most recent finished runs, and only once
+# it has at least MIN_RUNS of them
+RUNS_KEPT = 50
+MIN_RUNS = 5
+PERCENTILE = 0.95
+# limit = PERCENTILE runtime * MARGIN_FACTOR + MARGIN_SECONDS, at least
+# MIN_LIMIT_SECONDS
+MARGIN_FACTOR = 1.5
+MARGIN_SECONDS = 5 * 60
+MIN_LIMIT_SECONDS = 10 * 60
+
+# Final states, as reported by the schedulers' `finished_runtimes` (Slurm's,
+# PBS exit statuses are mapped onto them) that say how long a step needs.
+# Canceled and preempted jobs don't.
+RUNTIME_STATES = {'COMPLETED', 'FAILED', 'OUT_OF_MEMORY'}
+TIMEOUT_STATE = 'TIMEOUT'
+
+def format_time_limit(seconds):
+    """'H:MM:SS', understood by both sbatch --time and qsub -l walltime."""
+    seconds = int(seconds + 59) // 60 * 60
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:00'
+
+def job_step(job):
+    """(pipeline slug, step) of a buildkite job, the step being its key or,
+    for steps without one, its label. None if either is missing."""
+    pipeline = pipeline_slug_from_url(job.web_url)
+    step = job.step_key or job.name
+    if pipeline is None or not step:
+        return None
+    return pipeline, step
+
+class RuntimeHistory(SqliteStore):
+    def __init__(self, path=RUNTIME_HISTORY_FILE):
+        super().__init__(path)
+        self.lock = threading.Lock()
+        self.refreshed = 0.0
+        # (pipeline, step) -> limit in seconds, recomputed on each refresh
+        self.limits = {}
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                ' job_id TEXT PRIMARY KEY,'
+                ' pipeline TEXT NOT NULL,'
+                ' step TEXT NOT NULL,'
+                ' submit_time REAL,'
+                ' state TEXT,'
+                ' elapsed REAL)'
+            )
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS runs_step ON runs (pipeline, step, submit_time)'
+            )
+
+    def record_submit(self, job_id, pipeline, step):
+        """Record an HPC job just submitted for `step` of `pipeline`."""
+        with self._transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO runs (job_id, pipeline, step, submit_time)'
+                ' VALUES (?, ?, ?, ?)',
+                (str(job_id), pipeline, step, time.time()),
+            )
+
+    def refresh(self, logger, finished_runtimes, force=False):
+        """Ask `finished_runtimes(logger, job_ids)` (-> {job id: (state, elapsed
+        seconds)} for the ones that finished) about the jobs still running,
+        then recompute the limits. At most every REFRESH_SECONDS."""
+        with self.lock:
+            if not force and time.time() - self.refreshed < REFRESH_SECONDS:
+                return
+            self.refreshed = time.time()
+            try:
+                horizon = time.time() - HISTORY_DAYS * 86400
+                with self._transaction() as db:
+                    db.execute('DELETE FROM runs WHERE submit_time < ?', (horizon,))
+                    unfinished = [row[0] for row in db.execute(
+                        'SELECT job_id FROM runs WHERE state IS NULL'
+                    )]
+                finished = {}
+                for chunk in chunks(unfinished):
+                    finished.update(finished_runtimes(logger, chunk))
+                with self._transaction() as db:
+                    db.executemany(
+                        'UPDATE runs SET state = ?, elapsed = ? WHERE job_id = ?',
+                        [(state, elapsed, job_id) for job_id, (state, elapsed) in finished.items()],
+                    )
+                self.limits = self._compute_limits()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to update the runtime history: {e}")
+
+    def _compute_limits(self):
+        runs = {}
+        with self._transaction() as db:
+            for pipeline, step, state, elapsed in db.execute(
+                'SELECT pipeline, step, state, elapsed FROM runs'
+                ' WHERE state IS NOT NULL ORDER BY submit_time DESC'
+            ):
+                if state in RUNTIME_STATES or state == TIMEOUT_STATE:
+                    step_runs = runs.setdefault((pipeline, step), [])
+                    if len(step_runs) < RUNS_KEPT:
+                        step_runs.append((state, elapsed))
+        limits = {}
+        for key, step_runs in runs.items():
+            if len(step_runs) < MIN_RUNS or any(state == TIMEOUT_STATE for state, _ in step_runs):
+                continue
+            elapsed = sorted(e for _, e in step_runs)
+            high = elapsed[min(len(elapsed) - 1, int(PERCENTILE * len(elapsed)))]
+            limits[key] = max(MIN_LIMIT_SECONDS, high * MARGIN_FACTOR + MARGIN_SECONDS)
+        return limits
+
+    def limit_seconds(self, pipeline, step):
+        """The time limit for the next job of `step`, or None for the default."""
+        return self.limits.get((pipeline, step))
+
+    def steps(self, job_ids):
+        """{job id: (pipeline, step)} of those of `job_ids` recorded here."""
+        job_ids = [str(job_id) for job_id in job_ids]
+        steps = {}
+        with self._transaction() as db:
+            for chunk in chunks(job_ids):
+                for job_id, pipeline, step in db.execute(
+                    f'SELECT job_id, pipeline, step FROM runs'
+                    f' WHERE job_id IN ({",".join("?" * len(chunk))})',
+                    chunk,
+                ):
+                    steps[job_id] = (pipeline, step)
+        return steps
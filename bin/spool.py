@@ -0,0 +1,84 @@
+import json
+import os
+import time
+import uuid
+from os.path import join as joinpath
+
+from buildkite import BUILDKITE_PATH
+
+# Webhook events (see bin/webhook.py) waiting for the poller, one JSON file per
+# event. Files are written to tmp/ and renamed into new/, so the poller never
+# reads a partial event; it claims an event by renaming it into cur/ and
+# deletes it once handled. Anything left in cur/ by a crashed poller is picked
+# up again, since submissions are deduplicated against the current jobs.
+# Events the poller can't handle are moved to failed/, for inspection.
+SPOOL_DIR = joinpath(BUILDKITE_PATH, 'spool')
+
+def _dirs(spool_dir):
+    return [joinpath(spool_dir, name) for name in ('tmp', 'new', 'cur')]
+
+def _failed_dir(spool_dir):
+    return joinpath(spool_dir, 'failed')
+
+def write_event(event, spool_dir=SPOOL_DIR):
+    """Atomically add `event` (a JSON-serializable dict) to the spool."""
+    tmp_dir, new_dir, _ = _dirs(spool_dir)
+    os.makedirs(tmp_dir, exist_ok=True)
+    os.makedirs(new_dir, exist_ok=True)
+    # Zero-padded time first, so sorting the names gives arrival order
+    name = f'{time.time_ns():020d}-{uuid.uuid4().hex}.json'
+    tmp = joinpath(tmp_dir, name)
+    with open(tmp, 'w') as f:
+        json.dump(event, f)
+    os.replace(tmp, joinpath(new_dir, name))
+    return name
+
+def has_events(spool_dir=SPOOL_DIR):
+    _, new_dir, cur_dir = _dirs(spool_dir)
+    for path in (new_dir, cur_dir):
+        try:
+            with os.scandir(path) as entries:
+                if any(entry.name.endswith('.json') for entry in entries):
+                    return True
+        except FileNotFoundError:
+            pass
+    return False
+
+def claim_events(spool_dir=SPOOL_DIR):
+    """Claim every waiting event. Returns [(path, event)] in arrival order;
+    pass each path to `done` once the event is handled."""
+    _, new_dir, cur_dir = _dirs(spool_dir)
+    os.makedirs(cur_dir, exist_ok=True)
+    try:
+        for name in os.listdir(new_dir):
+            if name.endswith('.json'):
+                os.replace(joinpath(new_dir, name), joinpath(cur_dir, name))
+    except FileNotFoundError:
+        pass
+    events = []
+    for name in sorted(os.listdir(cur_dir)):
+        if not name.endswith('.json'):
+            continue
+        path = joinpath(cur_dir, name)
+        try:
+            with open(path, 'r') as f:
+                events.append((path, json.load(f)))
+        except ValueError:
+            # Never written by write_event, nothing to retry
+            os.remove(path)
+    return events
+
+def done(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def reject(path, spool_dir=SPOOL_DIR):
+    """Move a claimed event that can't be handled out of the way, to failed/."""
+    failed_dir = _failed_dir(spool_dir)
+    os.makedirs(failed_dir, exist_ok=True)
+    try:
+        os.replace(path, joinpath(failed_dir, os.path.basename(path)))
+    except FileNotFoundError:
+        pass
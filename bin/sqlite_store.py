@@ -0,0 +1,41 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+
+# What the SQLite stores under BUILDKITE_PATH (jobs, runtimes, GPU waits,
+# remediations, node health, latency, usage) have in common: one database
+# file each, in WAL mode so other tools can read it while a poller writes,
+# and a connection per transaction.
+
+# SQLite limits the number of `?` parameters in one statement
+CHUNK = 500
+
+def chunks(items):
+    """`items` in lists of at most CHUNK."""
+    items = list(items)
+    for i in range(0, len(items), CHUNK):
+        yield items[i:i + CHUNK]
+
+def sacct_time(value):
+    """Epoch seconds of a sacct timestamp, None for 'Unknown', 'None', ..."""
+    try:
+        return time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+class SqliteStore:
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+
+    @contextmanager
+    def _transaction(self):
+        """One connection per transaction, so the store can be used from
+        several threads (and processes) at once."""
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import logging
+# setup root logger
+logger = logging.Logger('webhook')
+handler = logging.StreamHandler()
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join as joinpath, isfile
+
+from buildkite import get_buildkite_job_tags, BUILDKITE_PATH, BUILDKITE_QUEUE, CANCELED_STATES
+from buildkite import Build
+import spool
+
+# Receives Buildkite webhooks (Settings > Notification Services > Webhook in
+# the organization) and writes the ones the poller acts on to the spool, so
+# `poll.py --daemon` submits a newly scheduled job within a second instead of
+# on its next API poll. The API poll stays on as the reconciliation sweep, so
+# missed or dropped webhooks only cost latency.
+#
+# Buildkite sends the webhook token set on the notification service in the
+# X-Buildkite-Token header, or signs the body with it (X-Buildkite-Signature).
+WEBHOOK_TOKEN_FILE = joinpath(BUILDKITE_PATH, '.buildkite_webhook_token')
+
+DEFAULT_PORT = 8787
+# Largest request body accepted, build payloads with many jobs stay well below
+MAX_BODY = 16 * 2 ** 20
+# Signed requests older than this are rejected as replays
+SIGNATURE_MAX_AGE = 5 * 60
+
+def read_webhook_token():
+    token = os.environ.get('BUILDKITE_WEBHOOK_TOKEN')
+    if token:
+        return token
+    if isfile(WEBHOOK_TOKEN_FILE):
+        with open(WEBHOOK_TOKEN_FILE, 'r') as f:
+            return f.read().rstrip()
+    return None
+
+def verify_request(headers, body, token):
+    """True if the request carries `token` or a valid, recent signature made
+    with it."""
+    sent = headers.get('X-Buildkite-Token')
+    if sent is not None:
+        return hmac.compare_digest(sent, token)
+    signature = headers.get('X-Buildkite-Signature')
+    if signature is None:
+        return False
+    # timestamp=<unix time>,signature=<hex HMAC-SHA256 of "<timestamp>.<body>">
+    fields = dict(part.split('=', 1) for part in signature.split(',') if '=' in part)
+    timestamp, digest = fields.get('timestamp', ''), fields.get('signature', '')
+    if not timestamp.isdigit() or abs(time.time() - int(timestamp)) > SIGNATURE_MAX_AGE:
+        return False
+    expected = hmac.new(
+        token.encode(), timestamp.encode() + b'.' + body, hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(digest, expected)
+
+def spool_event(event_name, payload):
+    """Turn a webhook payload into a spool event, with the build in the
+    trimmed form of `Build.as_dict`. Returns None for events the poller
+    doesn't act on."""
+    if event_name == 'job.scheduled':
+        build = Build.from_dict(
+            {**payload['build'], 'pipeline': payload['pipeline'], 'jobs': [payload['job']]}
+        )
+        job = build.jobs[0]
+        if job.type != 'script' or get_buildkite_job_tags(job).get('queue') != BUILDKITE_QUEUE:
+            return None
+        return {'event': event_name, 'build': build.as_dict()}
+    if event_name.startswith('build.'):
+        build = Build.from_dict({**payload['build'], 'pipeline': payload['pipeline']})
+        if build.state not in CANCELED_STATES:
+            return None
+        return {'event': event_name, 'build': build.as_dict()}
+    return None
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Set by `serve`
+    token = None
+    spool_dir = spool.SPOOL_DIR
+
+    def reply(self, code, message):
+        body = f'{message}\n'.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            return self.reply(413, 'too large')
+        body = self.rfile.read(length)
+        if not verify_request(self.headers, body, self.token):
+            logger.warning(f"Rejected webhook from {self.client_address[0]}: bad token")
+            return self.reply(401, 'unauthorized')
+
+        event_name = self.headers.get('X-Buildkite-Event', '')
+        if event_name == 'ping':
+            return self.reply(200, 'pong')
+        try:
+            event = spool_event(event_name, json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Malformed {event_name} webhook: {e!r}")
+            return self.reply(400, 'malformed payload')
+        if event is None:
+            return self.reply(200, 'ignored')
+
+        try:
+            spool.write_event(event, self.spool_dir)
+        except OSError as e:
+            # Buildkite retries failed deliveries
+            logger.error(f"Failed to spool {event_name} webhook: {e}")
+            return self.reply(500, 'spool error')
+        logger.info(f"Spooled {event_name}: {event['build']['web_url']}")
+        return self.reply(200, 'spooled')
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def serve(bind, port, token, spool_dir=spool.SPOOL_DIR):
+    WebhookHandler.token = token
+    WebhookHandler.spool_dir = spool_dir
+    server = ThreadingHTTPServer((bind, port), WebhookHandler)
+    logger.info(f"Receiving Buildkite webhooks for `{BUILDKITE_QUEUE}` on {bind}:{port}")
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Receive Buildkite webhooks and spool them for poll.py --daemon"
+    )
+    parser.add_argument('--bind', default='0.0.0.0', help="address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument('--spool', default=spool.SPOOL_DIR, help="spool directory")
+    args = parser.parse_args()
+
+    token = read_webhook_token()
+    if not token:
+        logger.error(
+            f"No webhook token: set BUILDKITE_WEBHOOK_TOKEN or write {WEBHOOK_TOKEN_FILE}"
+        )
+        raise SystemExit(1)
+
+    server = serve(args.bind, args.port, token, args.spool)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
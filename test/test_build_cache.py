@@ -0,0 +1,221 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from os.path import join as joinpath
+from unittest import mock
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import build_cache
+from buildkite import Build, Job, BUILDKITE_QUEUE
+from pipeline_index import PipelineIndex
+
+def make_build(number, slug='pipeline', state='running', job_state='scheduled',
+               queue=BUILDKITE_QUEUE, age=60):
+    web_url = f'https://buildkite.com/org/{slug}/builds/{number}'
+    created_at = (datetime.utcnow() - timedelta(seconds=age)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    job = Job(f'{slug}-{number}-job', 'script', job_state, f'{web_url}#{slug}-{number}-job',
+              [f'queue={queue}'])
+    return Build(f'{slug}-{number}', number, state, created_at, web_url, slug, slug, [job])
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        with mock.patch.object(build_cache, 'PipelineIndex',
+                               lambda: PipelineIndex(joinpath(self.dir, 'index.json'))):
+            self.cache = build_cache.BuildCache(joinpath(self.dir, 'cache.json'))
+        self.logger = logging.getLogger('test')
+        self.logger.disabled = True
+        # The API: listings and get_build answers, and the builds fetched
+        self.started, self.finished, self.summaries = [], [], []
+        self.answers = {}
+        self.fetched = []
+        for name, function in (
+            ('started_builds_since', lambda since: iter(self.started)),
+            ('pipeline_started_builds_since', lambda slug, since: iter(
+                [b for b in self.started if b.pipeline_slug == slug])),
+            ('finished_builds_since', lambda since: iter(self.finished)),
+            ('started_build_summaries_since', lambda since: iter(self.summaries)),
+            ('get_build', self.get_build),
+        ):
+            patcher = mock.patch.object(build_cache, name, function)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_build(self, slug, number, etag=None):
+        self.fetched.append((slug, number))
+        build = self.answers.get((slug, number))
+        return (build, 'etag') if build is not None else (None, etag)
+
+    def poll(self):
+        return list(self.cache.started_builds(self.logger, 96))
+
+    def incremental(self, since_last_poll=0):
+        """Next poll is an incremental one, `since_last_poll` seconds after
+        the last."""
+        cursor = datetime.utcnow() - timedelta(seconds=since_last_poll)
+        self.cache.cursor = cursor.strftime(build_cache.ISO_FORMAT)
+        self.cache.full_sync = time.time()
+        self.cache.reactivation_check = time.time()
+        self.started = []
+        return self.poll()
+
+    def age(self, build, changed, checked):
+        entry = self.cache.builds[build.id]
+        entry['changed'] = time.time() - changed
+        entry['checked'] = time.time() - checked
+
+class BuildCacheTest(CacheTestCase):
+    def test_full_resync(self):
+        self.started = [make_build(2), make_build(1)]
+        self.assertEqual([b.number for b in self.poll()], [2, 1])
+        self.assertIsNotNone(self.cache.cursor)
+        self.assertEqual(len(self.cache.builds), 2)
+
+    def test_incremental(self):
+        self.started = [make_build(1), make_build(2)]
+        self.poll()
+        self.finished = [make_build(1, state='passed')]
+        self.started = [make_build(3)]
+        self.cache.cursor = (datetime.utcnow() - timedelta(seconds=1)).strftime(build_cache.ISO_FORMAT)
+        self.cache.full_sync = self.cache.reactivation_check = time.time()
+        self.assertEqual(sorted(b.number for b in self.poll()), [2, 3])
+
+    def test_refresh_drops_finished_builds(self):
+        self.started = [make_build(1)]
+        self.poll()
+        self.age(self.started[0], changed=60, checked=10)
+        self.answers[('pipeline', 1)] = make_build(1, state='passed')
+        self.assertEqual(self.incremental(), [])
+
+    def test_hot_builds_first(self):
+        builds = self.started = [make_build(i) for i in range(1, 4)]
+        self.poll()
+        now = time.time()
+        self.age(builds[0], changed=3600, checked=600)  # cold, due
+        self.age(builds[1], changed=60, checked=10)     # hot
+        self.age(builds[2], changed=3600, checked=10)   # cold, not due
+        self.incremental()
+        self.assertEqual(self.fetched, [('pipeline', 2)])
+        self.fetched = []
+        self.incremental(since_last_poll=60)
+        self.assertEqual(self.fetched, [('pipeline', 2), ('pipeline', 1)])
+        self.assertGreaterEqual(self.cache.builds[builds[0].id]['checked'], now)
+
+    def test_allowance(self):
+        builds = self.started = [make_build(i) for i in range(1, 101)]
+        self.poll()
+        for build in builds:
+            self.age(build, changed=60, checked=10)
+        self.incremental(since_last_poll=14)
+        # 40 a minute, for 14 seconds and a fraction
+        self.assertEqual(len(self.fetched), 10)
+        self.fetched = []
+        self.incremental(since_last_poll=600)
+        self.assertEqual(len(self.fetched), build_cache.MAX_REFRESHES_PER_POLL)
+
+    def test_reactivated(self):
+        self.started = [make_build(1)]
+        self.poll()
+        old = make_build(2, age=3600)
+        self.summaries = [make_build(1), old]
+        self.answers[('pipeline', 2)] = old
+        self.cache.reactivation_check = 0.0
+        self.cache.cursor = (datetime.utcnow() - timedelta(seconds=1)).strftime(build_cache.ISO_FORMAT)
+        self.cache.full_sync = time.time()
+        self.started = []
+        self.assertEqual(sorted(b.number for b in self.poll()), [1, 2])
+        self.assertIn(('pipeline', 2), self.fetched)
+
+    def test_irrelevant_pipelines(self):
+        self.started = [make_build(1, slug='other', queue='elsewhere')]
+        self.poll()
+        # Not seen before: cached from the first build on
+        self.assertEqual(len(self.cache.builds), 1)
+        self.started = [make_build(2, slug='other', queue='elsewhere'), make_build(1)]
+        self.cache.full_sync = 0.0
+        self.assertEqual([b.pipeline_slug for b in self.poll()], ['pipeline'])
+
+    def test_relevant_pipelines_listed(self):
+        self.started = [make_build(1), make_build(1, slug='other', queue='elsewhere')]
+        self.poll()
+        self.assertEqual(self.cache.index.relevant(BUILDKITE_QUEUE), ['pipeline'])
+        listed = []
+        def pipeline_listing(slug, since):
+            listed.append(slug)
+            return iter([make_build(2)])
+        self.cache.full_sync = 0.0
+        with mock.patch.object(build_cache, 'pipeline_started_builds_since', pipeline_listing), \
+                mock.patch.object(build_cache, 'started_builds_since', side_effect=AssertionError):
+            self.assertEqual([b.number for b in self.poll()], [2])
+        self.assertEqual(listed, ['pipeline'])
+        # Until the next discovery sweep
+        self.cache.full_sync = self.cache.index.discovered = 0.0
+        self.started = [make_build(3)]
+        self.assertEqual([b.number for b in self.poll()], [3])
+
+    def test_save_and_load(self):
+        self.started = [make_build(1)]
+        self.poll()
+        self.cache.orphans['123'] = 1.0
+        self.cache.track_jobs({'url': []})
+        self.cache.save()
+        loaded = build_cache.BuildCache(self.cache.path)
+        self.assertEqual(loaded.cursor, self.cache.cursor)
+        self.assertEqual(loaded.builds[self.started[0].id]['build'], self.started[0])
+        self.assertEqual(loaded.orphans, {'123': 1.0})
+        self.assertEqual(loaded.tracked, {'url'})
+
+class EndedJobsTest(CacheTestCase):
+    def test_track_jobs(self):
+        self.cache.track_jobs({'a': [], 'b': []})
+        self.cache.track_jobs({'b': []})
+        self.assertEqual(set(self.cache.ended), {'a'})
+        # Back in the scheduler, e.g. submitted again
+        self.cache.track_jobs({'a': [], 'b': []})
+        self.assertEqual(self.cache.ended, {})
+        self.cache.track_jobs({})
+        for url in self.cache.ended:
+            self.cache.ended[url] -= build_cache.ENDED_RECHECK_SECONDS
+        self.cache.track_jobs({})
+        self.assertEqual(self.cache.ended, {})
+
+    def test_awaiting_recheck(self):
+        build = make_build(1)
+        job = build.jobs[0]
+        self.started = [build]
+        self.poll()
+        self.age(build, changed=3600, checked=10)
+        self.cache.track_jobs({job.web_url: []})
+        self.cache.track_jobs({})
+        self.assertTrue(self.cache.awaiting_recheck(build, job))
+        # Re-checked first, though it isn't due
+        other = make_build(2)
+        self.cache.builds[other.id] = self.cache._entry(other)
+        self.incremental()
+        self.assertEqual(self.fetched, [('pipeline', 1)])
+        self.assertFalse(self.cache.awaiting_recheck(build, job))
+
+    def test_full_resync_is_fresh(self):
+        build = make_build(1)
+        self.started = [build]
+        self.poll()
+        self.age(build, changed=3600, checked=10)
+        self.cache.track_jobs({build.jobs[0].web_url: []})
+        self.cache.track_jobs({})
+        self.cache.full_sync = 0.0
+        for listed in self.poll():
+            self.assertFalse(self.cache.awaiting_recheck(listed, listed.jobs[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from buildkite import _iter_json_array
+
+class ChunkedResponse:
+    """A response whose body arrives `size` bytes at a time."""
+    status_code = 200
+
+    def __init__(self, body, size):
+        self.body = body
+        self.size = size
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), self.size):
+            yield self.body[i:i + self.size]
+
+class IterJsonArrayTest(unittest.TestCase):
+    PAYLOADS = [
+        [],
+        [12345],
+        [1, 23, 456, -7.5e3],
+        [True, False, None, 'xyz'],
+        [{'id': 'é' * 10, 'jobs': [{'state': 'scheduled'}] * 3}, {'number': 42}, 'a"b', 0],
+    ]
+
+    def test_any_chunk_size(self):
+        for payload in self.PAYLOADS:
+            for separators in ((',', ':'), (', ', ': ')):
+                body = json.dumps(payload, ensure_ascii=False, separators=separators).encode()
+                for size in range(1, len(body) + 1):
+                    with self.subTest(body=body, size=size):
+                        self.assertEqual(list(_iter_json_array(ChunkedResponse(body, size))), payload)
+
+    def test_truncated(self):
+        for body in (b'[12345', b'[{"id": 1}', b'[{"id": 1}, {"id"'):
+            for size in (1, 2, 64 * 1024):
+                with self.subTest(body=body, size=size), self.assertRaises(ValueError):
+                    list(_iter_json_array(ChunkedResponse(body, size)))
+
+    def test_not_a_list(self):
+        with self.assertRaises(ValueError):
+            list(_iter_json_array(ChunkedResponse(b'{"message": "Not Found"}', 3)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from os.path import join as joinpath
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import depot_cache
+
+MANIFEST = '''\
+julia_version = "1.10.0"
+manifest_format = "2.0"
+
+[[deps.Bar]]
+git-tree-sha1 = "1111111111111111111111111111111111111111"
+uuid = "b0000000-0000-0000-0000-000000000000"
+version = "1.0.0"
+
+[[deps.Foo]]
+deps = [
+    "Bar",
+    "LinearAlgebra",
+]
+git-tree-sha1 = "2222222222222222222222222222222222222222"
+uuid = "f0000000-0000-0000-0000-000000000000"
+
+[[deps.Dev]]
+path = "../Dev"
+uuid = "d0000000-0000-0000-0000-000000000000"
+
+[[deps.UsesDev]]
+git-tree-sha1 = "3333333333333333333333333333333333333333"
+uuid = "e0000000-0000-0000-0000-000000000000"
+
+    [deps.UsesDev.deps]
+    Dev = "d0000000-0000-0000-0000-000000000000"
+
+[[deps.LinearAlgebra]]
+deps = ["Libdl"]
+uuid = "37e2e46d-f89d-539d-b4ee-838fcccc9c8e"
+
+[[deps.Libdl]]
+uuid = "8f399da3-3557-5675-b5ff-fb832c97cbdb"
+'''
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, text, name='Manifest.toml'):
+        path = joinpath(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_graph(self):
+        graph = depot_cache.read_manifest_graph(self.write(MANIFEST))
+        self.assertEqual(graph['Foo'][0]['deps'], ['Bar', 'LinearAlgebra'])
+        self.assertEqual(graph['UsesDev'][0]['deps'], ['Dev'])
+        self.assertEqual(graph['LinearAlgebra'][0]['deps'], ['Libdl'])
+        self.assertEqual(graph['Dev'][0]['path'], '../Dev')
+        self.assertEqual(graph['Bar'][0]['version'], '1.0.0')
+
+    def test_registered_packages(self):
+        self.assertEqual(sorted(depot_cache.read_manifest(self.write(MANIFEST))), [
+            ('Bar', 'b0000000-0000-0000-0000-000000000000', '1' * 40),
+            ('Foo', 'f0000000-0000-0000-0000-000000000000', '2' * 40),
+            ('UsesDev', 'e0000000-0000-0000-0000-000000000000', '3' * 40),
+        ])
+
+    def test_format_1(self):
+        path = self.write(
+            '[[Foo]]\ndeps = ["Bar"]\ngit-tree-sha1 = "' + '2' * 40 + '"\n'
+            'uuid = "f0000000-0000-0000-0000-000000000000"\n\n'
+            '[[Bar]]\ngit-tree-sha1 = "' + '1' * 40 + '"\n'
+            'uuid = "b0000000-0000-0000-0000-000000000000"\n'
+        )
+        self.assertEqual(depot_cache.read_manifest_graph(path)['Foo'][0]['deps'], ['Bar'])
+        self.assertEqual(set(depot_cache.manifest_keys(path)), {'Foo', 'Bar'})
+
+    def test_keys(self):
+        keys = depot_cache.manifest_keys(self.write(MANIFEST))
+        # Dev'ed packages and their dependents have no key
+        self.assertEqual(set(keys), {'Bar', 'Foo', 'LinearAlgebra', 'Libdl'})
+        self.assertEqual(len(set(keys.values())), 4)
+
+    def test_key_follows_dependencies(self):
+        keys = depot_cache.manifest_keys(self.write(MANIFEST))
+        bumped = depot_cache.manifest_keys(self.write(MANIFEST.replace('1' * 40, '4' * 40), 'Other.toml'))
+        self.assertNotEqual(keys['Bar'], bumped['Bar'])
+        self.assertNotEqual(keys['Foo'], bumped['Foo'])
+        self.assertEqual(keys['LinearAlgebra'], bumped['LinearAlgebra'])
+
+    def test_ambiguous_name(self):
+        text = MANIFEST + (
+            '\n[[deps.Bar]]\ngit-tree-sha1 = "' + '5' * 40 + '"\n'
+            'uuid = "b1000000-0000-0000-0000-000000000000"\n'
+        )
+        keys = depot_cache.manifest_keys(self.write(text))
+        self.assertNotIn('Bar', keys)
+        self.assertNotIn('Foo', keys)
+        self.assertEqual(len(depot_cache.read_manifest(self.write(text))), 4)
+
+class EvictTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = depot_cache.DepotCache(self.dir, max_bytes=250)
+
+    def add(self, entry, size, used):
+        """An entry of `size` bytes last used `used` seconds ago."""
+        path = joinpath(self.dir, entry)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        self.cache.touch(entry, size)
+        os.utime(self.cache._marker(entry), (time.time() - used,) * 2)
+
+    def test_least_recently_used_first(self):
+        self.add('artifacts/' + 'a' * 40, 100, used=300)
+        self.add('artifacts/' + 'b' * 40, 100, used=100)
+        self.add('artifacts/' + 'c' * 40, 100, used=200)
+        self.add('artifacts/' + 'd' * 40, 100, used=0)
+        self.cache.evict(force=True)
+        self.assertEqual(sorted(os.listdir(joinpath(self.dir, 'artifacts'))), ['b' * 40, 'd' * 40])
+        self.assertEqual(sorted(os.listdir(joinpath(self.dir, '.used', 'artifacts'))), ['b' * 40, 'd' * 40])
+        self.assertEqual(os.listdir(joinpath(self.dir, '.trash')), [])
+
+    def test_within_budget(self):
+        self.add('artifacts/' + 'a' * 40, 100, used=300)
+        self.add('artifacts/' + 'b' * 40, 100, used=100)
+        self.cache.evict(force=True)
+        self.assertEqual(len(os.listdir(joinpath(self.dir, 'artifacts'))), 2)
+
+    def test_interval(self):
+        self.cache.evict(force=True)
+        self.add('artifacts/' + 'a' * 40, 300, used=300)
+        self.cache.evict()
+        self.assertEqual(len(os.listdir(joinpath(self.dir, 'artifacts'))), 1)
+
+    def test_linked_files_survive(self):
+        entry = 'artifacts/' + 'a' * 40
+        self.add(entry, 300, used=300)
+        depot = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, depot)
+        depot_cache.link_file(joinpath(self.dir, entry), joinpath(depot, 'a'))
+        self.cache.evict(force=True)
+        self.assertFalse(os.path.exists(joinpath(self.dir, entry)))
+        with open(joinpath(depot, 'a'), 'rb') as f:
+            self.assertEqual(len(f.read()), 300)
+
+class RemoveTreeTest(unittest.TestCase):
+    def test_shared_files_keep_their_mode(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        shared = joinpath(root, 'shared')
+        with open(shared, 'w') as f:
+            f.write('x')
+        os.chmod(shared, 0o444)
+        tree = joinpath(root, 'tree')
+        os.makedirs(joinpath(tree, 'src'))
+        os.link(shared, joinpath(tree, 'src', 'file'))
+        os.chmod(joinpath(tree, 'src'), 0o555)
+        os.chmod(tree, 0o555)
+        depot_cache.remove_tree(tree)
+        self.assertFalse(os.path.exists(tree))
+        self.assertEqual(os.stat(shared).st_mode & 0o777, 0o444)
+        self.assertEqual(os.stat(root).st_mode & 0o777, 0o700)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import fair_share
+from job_schedulers import Resources
+
+NOW = 1_700_000_000.0
+
+def job(slug, name, waited=0, gpus=0, nodes=1, cpu_hours=1.0):
+    """A candidate of `slug` waiting for `waited` seconds."""
+    return (slug, NOW - waited, Resources(1, gpus, nodes, cpu_hours), name)
+
+def no_caps(slug):
+    return {}
+
+class PlanTest(unittest.TestCase):
+    def plan(self, candidates, inflight=None, queue_limits=None, pipeline_limits=no_caps):
+        return fair_share.plan(candidates, inflight or {}, queue_limits or {}, pipeline_limits, NOW)
+
+    def test_round_robin(self):
+        planned, left_out = self.plan([
+            job('a', 'a1', waited=30), job('a', 'a2', waited=20), job('a', 'a3', waited=10),
+            job('b', 'b1', waited=5),
+        ])
+        self.assertEqual(planned, ['a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(left_out, [])
+
+    def test_oldest_first_within_a_pipeline(self):
+        planned, _ = self.plan([job('a', 'new', waited=1), job('a', 'old', waited=100)])
+        self.assertEqual(planned, ['old', 'new'])
+
+    def test_least_served_first(self):
+        planned, _ = self.plan(
+            [job('a', 'a1', waited=100), job('b', 'b1', waited=1)],
+            inflight={'a': Resources(jobs=2)},
+        )
+        self.assertEqual(planned, ['b1', 'a1'])
+
+    def test_weights(self):
+        with mock.patch.dict(fair_share.PIPELINE_WEIGHTS, {'a': 3.0}):
+            planned, _ = self.plan(
+                [job('a', f'a{i}', waited=10 - i) for i in range(4)] + [job('b', 'b1', waited=1)],
+            )
+        # a gets three slots for b's one
+        self.assertEqual(planned, ['a0', 'a1', 'a2', 'b1', 'a3'])
+
+    def test_aging(self):
+        inflight = {'a': Resources(jobs=3)}
+        candidates = [job('a', 'a1', waited=fair_share.AGING_SECONDS * 4), job('b', 'b1', waited=1)]
+        with mock.patch.dict(fair_share.PIPELINE_WEIGHTS, {'a': 1.0, 'b': 1.0}):
+            planned, _ = self.plan(candidates, inflight=inflight)
+        # a holds 3 jobs, but its job has waited 4 aging periods: weight 5
+        self.assertEqual(planned, ['a1', 'b1'])
+        planned, _ = self.plan([job('a', 'a1', waited=60), job('b', 'b1', waited=1)],
+                               inflight=inflight)
+        self.assertEqual(planned, ['b1', 'a1'])
+
+    def test_budget(self):
+        planned, left_out = self.plan(
+            [job('a', 'big', waited=30, gpus=4), job('a', 'small', waited=20, gpus=1),
+             job('b', 'b1', waited=10, gpus=2)],
+            inflight={'c': Resources(1, gpus=2)},
+            queue_limits={'gpus': 5},
+        )
+        # big doesn't fit next to c's 2 GPUs, the smaller jobs after it do
+        self.assertEqual(planned, ['small', 'b1'])
+        self.assertEqual(left_out, [('big', 'budget')])
+
+    def test_budget_in_jobs(self):
+        planned, left_out = self.plan(
+            [job('a', f'a{i}', waited=10 - i) for i in range(3)], queue_limits={'jobs': 2},
+        )
+        self.assertEqual(planned, ['a0', 'a1'])
+        self.assertEqual(left_out, [('a2', 'budget')])
+
+    def test_pipeline_caps(self):
+        caps = {'a': {'gpus': 4}, 'b': {'nodes': 2}}
+        planned, left_out = self.plan(
+            [job('a', 'a1', waited=30, gpus=2), job('a', 'a2', waited=20, gpus=4),
+             job('a', 'a3', waited=10, gpus=2), job('b', 'b1', waited=30, nodes=2),
+             job('b', 'b2', waited=20, nodes=1)],
+            inflight={'b': Resources(1, nodes=1)},
+            pipeline_limits=lambda slug: caps.get(slug, {}),
+        )
+        self.assertEqual(planned, ['a1', 'b2', 'a3'])
+        self.assertEqual(sorted(left_out), [('a2', 'cap'), ('b1', 'cap')])
+
+    def test_budget_before_cap(self):
+        _, left_out = self.plan(
+            [job('a', 'a1', gpus=8)], queue_limits={'gpus': 4},
+            pipeline_limits=lambda slug: {'gpus': 2},
+        )
+        self.assertEqual(left_out, [('a1', 'budget')])
+
+    def test_empty(self):
+        self.assertEqual(self.plan([]), ([], []))
+
+class WaitingSinceTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(fair_share.waiting_since('2023-11-14T22:00:00.000Z', NOW), 1699999200)
+
+    def test_missing_or_future(self):
+        self.assertEqual(fair_share.waiting_since(None, NOW), NOW)
+        self.assertEqual(fair_share.waiting_since('2099-01-01T00:00:00Z', NOW), NOW)
+
+if __name__ == '__main__':
+    unittest.main()
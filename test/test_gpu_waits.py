@@ -0,0 +1,93 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os.path import join as joinpath
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import gpu_waits
+from gpu_waits import GpuWaitHistory, MIN_SAMPLES
+
+class FitTest(unittest.TestCase):
+    def test_line(self):
+        samples = [(depth, 60.0 + 30.0 * depth) for depth in range(MIN_SAMPLES)]
+        intercept, slope = GpuWaitHistory._fit(samples)
+        self.assertAlmostEqual(intercept, 60.0)
+        self.assertAlmostEqual(slope, 30.0)
+
+    def test_too_few_depths(self):
+        # Imported from sacct: no depth, the median wait
+        samples = [(None, 100.0)] * MIN_SAMPLES + [(1, 500.0), (2, 900.0)]
+        self.assertEqual(GpuWaitHistory._fit(samples), (100.0, 0.0))
+
+    def test_constant_depth(self):
+        samples = [(3, float(wait)) for wait in range(MIN_SAMPLES)]
+        self.assertEqual(GpuWaitHistory._fit(samples), (MIN_SAMPLES // 2, 0.0))
+
+    def test_never_shorter_with_depth(self):
+        samples = [(depth, 1000.0 - 10.0 * depth) for depth in range(MIN_SAMPLES)]
+        intercept, slope = GpuWaitHistory._fit(samples)
+        self.assertEqual(slope, 0.0)
+        self.assertGreater(intercept, 0.0)
+
+class ModelTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.history = GpuWaitHistory(joinpath(self.dir, 'gpu_waits.sqlite'))
+        self.job_id = 0
+
+    def add(self, count, gpu_type='p100', gpus=1, short=True, depth=None, wait=600.0):
+        with self.history._transaction() as db:
+            for _ in range(count):
+                self.job_id += 1
+                db.execute(
+                    'INSERT INTO waits (job_id, partition, gpu_type, gpus, short, depth, submit, start)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (str(self.job_id), 'gpu', gpu_type, gpus, int(short), depth, 1000.0,
+                     1000.0 + wait),
+                )
+
+    def test_no_history(self):
+        self.add(MIN_SAMPLES - 1)
+        self.assertIsNone(self.history.predict('gpu', 'p100', 1, True, 0))
+
+    def test_own_bucket(self):
+        self.add(MIN_SAMPLES, gpus=1, wait=100.0)
+        self.add(MIN_SAMPLES, gpus=4, wait=1000.0)
+        self.assertEqual(self.history.predict('gpu', 'p100', 1, True, 5), 100.0)
+        self.assertEqual(self.history.predict('gpu', 'p100', 8, True, 5), 1000.0)
+
+    def test_pooled(self):
+        # Too few of each count and length, enough together
+        self.add(MIN_SAMPLES // 2, gpus=1, short=True, wait=100.0)
+        self.add(MIN_SAMPLES // 2, gpus=2, short=False, wait=300.0)
+        self.assertEqual(self.history._model('gpu', 'p100', 4, False)[2], MIN_SAMPLES)
+        self.assertEqual(self.history.predict('gpu', 'p100', 4, False, 0), 300.0)
+        self.assertIsNone(self.history.predict('gpu', 'v100', 1, True, 0))
+
+    def test_depth(self):
+        for depth in range(MIN_SAMPLES):
+            self.add(1, depth=depth, wait=60.0 * depth)
+        self.assertAlmostEqual(self.history.predict('gpu', 'p100', 1, True, 10), 600.0)
+
+    def test_pending_jobs_left_out(self):
+        self.add(MIN_SAMPLES)
+        with self.history._transaction() as db:
+            db.execute('UPDATE waits SET start = NULL WHERE job_id = ?', ('1',))
+        self.assertIsNone(self.history.predict('gpu', 'p100', 1, True, 0))
+
+class BucketTest(unittest.TestCase):
+    def test_buckets(self):
+        self.assertEqual([gpu_waits.gpu_bucket(n) for n in (1, 2, 3, 4, 8)], [1, 2, 2, 4, 4])
+        self.assertTrue(gpu_waits.is_short(gpu_waits.SHORT_JOB_HOURS))
+        self.assertFalse(gpu_waits.is_short(None))
+
+if __name__ == '__main__':
+    unittest.main()
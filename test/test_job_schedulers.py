@@ -0,0 +1,371 @@
+import os
+import sys
+import tempfile
+import shutil
+import subprocess
+import unittest
+from unittest import mock
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import job_schedulers
+import remediation
+from job_schedulers import Resources
+
+class Job:
+    """The parts of a buildkite Job the schedulers read."""
+    def __init__(self, tags, web_url='https://buildkite.com/org/pipeline/builds/1#job'):
+        self.agent_query_rules = [f'{key}={value}' for key, value in tags.items()]
+        self.web_url = web_url
+        self.step_key = 'step'
+        self.name = 'step'
+
+class ResourcesTest(unittest.TestCase):
+    def test_add(self):
+        total = Resources(1, 2, 1, 4.0) + Resources(1, 0, 2, 1.5)
+        self.assertEqual(total.as_dict(), {'jobs': 2, 'gpus': 2, 'nodes': 3, 'cpu_hours': 5.5})
+
+    def test_exceeds(self):
+        held = Resources(2, 4, 1, 10.0)
+        self.assertFalse(held.exceeds({}))
+        self.assertFalse(held.exceeds({'gpus': 4, 'jobs': 2}))
+        self.assertTrue(held.exceeds({'gpus': 3}))
+        self.assertTrue(held.exceeds({'jobs': 8, 'cpu_hours': 9.5}))
+
+    def test_round_trip(self):
+        held = Resources(1, 2, 3, 4.5)
+        self.assertEqual(Resources.from_dict(held.as_dict()).as_dict(), held.as_dict())
+
+class TimeLimitTest(unittest.TestCase):
+    def test_formats(self):
+        hours = job_schedulers.time_limit_hours
+        self.assertEqual(hours('90'), 1.5)
+        self.assertEqual(hours('30:00'), 0.5)
+        self.assertEqual(hours('2:00:00'), 2)
+        self.assertEqual(hours('1-12'), 36)
+        self.assertEqual(hours('1-00:30'), 24.5)
+        self.assertEqual(hours('3600', bare_unit_hours=1 / 3600), 1)
+        self.assertIsNone(hours('UNLIMITED'))
+
+class SlurmResourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = job_schedulers.SlurmJobScheduler()
+
+    def requested(self, **tags):
+        return self.scheduler.requested_resources(None, Job(tags)).as_dict()
+
+    def test_cpu_job(self):
+        self.assertEqual(
+            self.requested(slurm_ntasks='4', slurm_cpus_per_task='2', slurm_time='2:00:00'),
+            {'jobs': 1, 'gpus': 0, 'nodes': 1, 'cpu_hours': 16},
+        )
+
+    def test_tasks_per_node(self):
+        self.assertEqual(
+            self.requested(slurm_nodes='2', slurm_ntasks_per_node='3', slurm_time='1:00:00'),
+            {'jobs': 1, 'gpus': 0, 'nodes': 2, 'cpu_hours': 6},
+        )
+
+    def test_gpus(self):
+        self.assertEqual(self.requested(slurm_gpus='4', slurm_time='60')['gpus'], 4)
+        self.assertEqual(
+            self.requested(slurm_nodes='2', slurm_gres='gpu:a100:4', slurm_time='60')['gpus'], 8,
+        )
+        self.assertEqual(
+            self.requested(slurm_gpus_per_task='1', slurm_ntasks='3', slurm_time='60')['gpus'], 3,
+        )
+
+    def test_bad_tags(self):
+        self.assertEqual(self.requested(slurm_ntasks='many', slurm_time='60'),
+                         Resources(jobs=1).as_dict())
+
+    def test_tres(self):
+        held = self.scheduler.tres_resources('cpu=4,mem=16G,node=1,billing=4,gres/gpu=2', '3:00:00')
+        self.assertEqual(held.as_dict(), {'jobs': 1, 'gpus': 2, 'nodes': 1, 'cpu_hours': 12})
+
+class LearnedTimeLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = job_schedulers.SlurmJobScheduler()
+        self.scheduler._runtimes = mock.Mock(limits={})
+        self.scheduler._runtimes.limit_seconds = lambda pipeline, step: (
+            self.scheduler._runtimes.limits.get((pipeline, step))
+        )
+        self.job = Job({'queue': 'test'}, 'https://buildkite.com/org/pipeline/builds/1#job')
+
+    def test_learned(self):
+        self.scheduler._runtimes.limits[('pipeline', 'step')] = 1800
+        self.assertEqual(self.scheduler.time_limit(None, self.job), '0:30:00')
+
+    def test_default(self):
+        # No history, or a limit longer than the default
+        self.assertEqual(self.scheduler.time_limit(None, self.job), job_schedulers.DEFAULT_TIMELIMIT)
+        self.scheduler._runtimes.limits[('pipeline', 'step')] = 2 * 3600
+        self.assertEqual(self.scheduler.time_limit(None, self.job), job_schedulers.DEFAULT_TIMELIMIT)
+
+class ClusterSnapshotTest(unittest.TestCase):
+    def test_claim_tightest_node(self):
+        nodes = {'a': {'p100': 4}, 'b': {'p100': 2, 'v100': 4}, 'c': {'p100': 1}}
+        self.assertTrue(job_schedulers.ClusterSnapshot.claim(nodes, 'p100', 2))
+        self.assertEqual(nodes['b']['p100'], 0)
+        self.assertTrue(job_schedulers.ClusterSnapshot.claim(nodes, 'p100', 2))
+        self.assertEqual(nodes['a']['p100'], 2)
+
+    def test_claim_single_node(self):
+        nodes = {'a': {'p100': 1}, 'b': {'p100': 1}}
+        # Two free GPUs, but not on one node
+        self.assertFalse(job_schedulers.ClusterSnapshot.fits(nodes, 'p100', 2))
+        self.assertFalse(job_schedulers.ClusterSnapshot.claim(nodes, 'p100', 2))
+        self.assertFalse(job_schedulers.ClusterSnapshot.claim(nodes, 'h100', 1))
+        self.assertEqual(nodes, {'a': {'p100': 1}, 'b': {'p100': 1}})
+
+    def test_claims_add_up(self):
+        nodes = {'a': {'p100': 4}}
+        claims = [job_schedulers.ClusterSnapshot.claim(nodes, 'p100', 1) for _ in range(5)]
+        self.assertEqual(claims, [True] * 4 + [False])
+
+    def test_copy(self):
+        snapshot = job_schedulers.ClusterSnapshot()
+        snapshot._partitions['gpu'] = {'a': {'p100': 1}}
+        snapshot._pending['gpu'] = {'p100': 3}
+        other = snapshot.copy()
+        other.claim(other.partition_free('gpu'), 'p100', 1)
+        other.pending('gpu')['p100'] += 1
+        self.assertEqual(snapshot._partitions['gpu'], {'a': {'p100': 1}})
+        self.assertEqual(snapshot._pending['gpu'], {'p100': 3})
+        self.assertEqual(other.created, snapshot.created)
+
+class WaitHistory:
+    """Predicted waits by GPU type, as gpu_waits.GpuWaitHistory.predict
+    gives them."""
+    def __init__(self, waits):
+        self.waits = waits
+
+    def refresh(self, logger):
+        pass
+
+    def predict(self, partition, gpu_type, gpus, short, depth):
+        return self.waits.get(gpu_type)
+
+class SpillTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = job_schedulers.ClusterSnapshot()
+        self.snapshot._partitions['gpu'] = {'a': {'p100': 0, 'v100': 2}, 'b': {'h100': 0}}
+        self.snapshot._pending['gpu'] = {'p100': 11}
+        self.logger = mock.Mock()
+
+    def pick(self, gpus=1, policy='threshold', history=None, decision=None, **kwargs):
+        return job_schedulers.pick_spill_gpu_type(
+            self.logger, 'central', 'p100', gpus, 'gpu', self.snapshot, hours=1,
+            history=history, policy=policy, decision=decision, **kwargs,
+        )
+
+    def test_preferred_free(self):
+        self.snapshot._partitions['gpu']['a']['p100'] = 1
+        self.assertIsNone(self.pick())
+        self.assertEqual(self.snapshot._partitions['gpu']['a']['p100'], 0)
+
+    def test_reservation_free(self):
+        self.snapshot._reservations['res'] = {'r': {'p100': 2}}
+        self.assertIsNone(self.pick(gpus=2, reservation='res'))
+        self.assertEqual(self.snapshot._reservations['res']['r']['p100'], 0)
+
+    def test_threshold(self):
+        self.assertEqual(self.pick(), 'v100')
+        self.assertEqual(self.snapshot._partitions['gpu']['a']['v100'], 1)
+
+    def test_below_threshold(self):
+        self.snapshot._pending['gpu']['p100'] = 10
+        decision = {}
+        self.assertIsNone(self.pick(decision=decision))
+        self.assertEqual(decision, {'depth': 10})
+        # Queued behind the others for the next decision
+        self.assertEqual(self.snapshot._pending['gpu']['p100'], 11)
+
+    def test_no_fallback_free(self):
+        decision = {}
+        self.assertIsNone(self.pick(gpus=4, decision=decision))
+        self.assertEqual(decision, {'depth': 11})
+
+    def test_predict_spills(self):
+        history = WaitHistory({'p100': 3600, 'v100': None, 'h100': 0})
+        self.assertEqual(self.pick(policy='predict', history=history), 'v100')
+
+    def test_predict_keeps_preferred(self):
+        self.snapshot._pending['gpu']['p100'] = 50
+        decision = {}
+        history = WaitHistory({'p100': 300})
+        self.assertIsNone(self.pick(policy='predict', history=history, decision=decision))
+        self.assertEqual(decision, {'depth': 50})
+
+    def test_predict_queues_on_a_busy_fallback(self):
+        self.snapshot._partitions['gpu']['a']['v100'] = 0
+        decision = {}
+        # h100 is the third step down: 0 + 3 * 600 < 3600
+        history = WaitHistory({'p100': 3600, 'v100': 3000, 'nvidia_l40s': None, 'h100': 0})
+        self.assertEqual(self.pick(policy='predict', history=history, decision=decision), 'h100')
+        self.assertEqual(decision, {'depth': 0})
+        self.assertEqual(self.snapshot._pending['gpu']['h100'], 1)
+
+    def test_predict_without_history(self):
+        self.snapshot._pending['gpu']['p100'] = 1
+        self.assertIsNone(self.pick(policy='predict', history=WaitHistory({})))
+        self.snapshot._pending['gpu']['p100'] = 20
+        self.assertEqual(self.pick(policy='predict', history=WaitHistory({})), 'v100')
+
+    def test_shadow(self):
+        self.snapshot._pending['gpu']['p100'] = 1
+        history = WaitHistory({'p100': 3600})
+        # The threshold rule decides, the prediction is only logged
+        self.assertIsNone(self.pick(policy='shadow', history=history))
+        self.assertIn('Predicted spill choice', self.logger.info.call_args[0][0])
+
+    def test_errors(self):
+        with mock.patch.object(self.snapshot, 'partition_free', side_effect=OSError('sinfo')):
+            self.assertIsNone(self.pick())
+        self.logger.warning.assert_called_once()
+
+class RemediationTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = job_schedulers.SlurmJobScheduler()
+
+    def next_actions(self, job, queue='central'):
+        """The actions taken one after the other while `job` stays stuck."""
+        actions = []
+        while not actions or actions[-1] != remediation.FAIL:
+            actions.append(self.scheduler.remediation_action(queue, job, actions))
+        return actions
+
+    def test_gpu_job(self):
+        job = job_schedulers.SchedulerJob('1', tres='cpu=4,gres/gpu:p100=1', reservation='clima')
+        with mock.patch.object(remediation, 'MAX_REMEDIATIONS', 10):
+            self.assertEqual(self.next_actions(job), [
+                remediation.NO_RESERVATION, 'gpu_type=v100', 'gpu_type=nvidia_l40s',
+                'gpu_type=h100', 'gpu_type=nvidia_h200', remediation.FAIL,
+            ])
+
+    def test_at_most_max_remediations(self):
+        job = job_schedulers.SchedulerJob('1', tres='cpu=4,gres/gpu:p100=1', reservation='clima')
+        self.assertEqual(self.next_actions(job), [
+            remediation.NO_RESERVATION, 'gpu_type=v100', 'gpu_type=nvidia_l40s', remediation.FAIL,
+        ])
+
+    def test_skips_the_current_type(self):
+        job = job_schedulers.SchedulerJob('1', tres='gres/gpu:v100=2')
+        self.assertEqual(
+            self.scheduler.remediation_action('central', job, []), 'gpu_type=nvidia_l40s'
+        )
+
+    def test_own_reservation_kept(self):
+        job = job_schedulers.SchedulerJob('1', tres='cpu=4', reservation='theirs')
+        self.assertEqual(self.next_actions(job), [remediation.FAIL])
+        job = job_schedulers.SchedulerJob('1', tres='cpu=4', reservation='clima_cpu')
+        self.assertEqual(self.next_actions(job), [remediation.NO_RESERVATION, remediation.FAIL])
+
+    def test_stuck_reason(self):
+        self.assertEqual(remediation.stuck_reason('ReqNodeNotAvail, Reserved for maintenance'),
+                         'ReqNodeNotAvail')
+        self.assertIsNone(remediation.stuck_reason('Resources'))
+        self.assertIsNone(remediation.stuck_reason(None))
+
+    def test_stuck_jobs(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        self.scheduler._remediations = remediation.RemediationStore(os.path.join(dir, 'r.sqlite'))
+        logger = mock.Mock()
+        stuck = job_schedulers.SchedulerJob(
+            '1', pending=True, reason='ReqNodeNotAvail, UnavailableNodes:a', tres='cpu=1',
+            reservation='clima_cpu',
+        )
+        waiting = job_schedulers.SchedulerJob('2', pending=True, reason='Priority')
+        current_jobs = {'url1': [stuck], 'url2': [waiting]}
+        # Not for long enough yet
+        self.assertEqual(self.scheduler.stuck_jobs(logger, current_jobs), [])
+        with self.scheduler._remediations._transaction() as db:
+            db.execute('UPDATE stuck SET since = since - ?', (remediation.STUCK_SECONDS,))
+        with mock.patch.object(job_schedulers, 'BUILDKITE_QUEUE', 'central'):
+            self.assertEqual(self.scheduler.stuck_jobs(logger, current_jobs), [('url1', stuck)])
+        self.assertEqual(self.scheduler._remediations.remediations('url1'),
+                         [(remediation.NO_RESERVATION, '1', 'ReqNodeNotAvail')])
+
+class Pilots:
+    """Pilots with jobs queued, as `pilots.Pilots.refresh` lists them."""
+    def __init__(self, entries):
+        self.entries = entries
+
+    def refresh(self, logger):
+        return self.entries
+
+class PilotJobsTest(unittest.TestCase):
+    def test_queued_resources(self):
+        scheduler = job_schedulers.SlurmJobScheduler()
+        scheduler.pilots = Pilots([
+            ('pilot:p/1', 'url1', '{"jobs": 1, "gpus": 0, "nodes": 1, "cpu_hours": 0.5}'),
+            ('pilot:p/current', 'url2', 'not json'),
+            ('pilot:p/3', 'url3', '[1, 2]'),
+            ('pilot:p/4', 'url4', '{"cpus": 4}'),
+            ('pilot:p/5', 'url5', 'null'),
+        ])
+        squeue = subprocess.CompletedProcess([], 0, stdout=b'')
+        with mock.patch.object(job_schedulers.subprocess, 'run', return_value=squeue):
+            current_jobs = scheduler.current_jobs(None)
+        self.assertEqual(current_jobs['url1'][0].resources.cpu_hours, 0.5)
+        self.assertTrue(current_jobs['url1'][0].pending)
+        self.assertFalse(current_jobs['url2'][0].pending)
+        for url in ('url2', 'url3', 'url4', 'url5'):
+            self.assertEqual(current_jobs[url][0].resources.as_dict(), Resources(jobs=1).as_dict())
+
+QSTAT_HISTORY = """{"Jobs": {
+    "101.server": {"job_state": "F", "Exit_status": 0, "queue": "cpu",
+                   "resources_used": {"walltime": "01:30:00"},
+                   "Resource_List": {"select": "1:ncpus=4"},
+                   "qtime": "Mon Jan  1 10:00:00 2024", "stime": "Mon Jan  1 10:05:00 2024",
+                   "obittime": "Mon Jan  1 11:35:00 2024"},
+    "102.server": {"job_state": "F", "Exit_status": -29, "queue": "gpu",
+                   "resources_used": {"walltime": "00:10:00"},
+                   "Resource_List": {"select": "1:ncpus=4:ngpus=1:gpu_type=a100"}},
+    "103.server": {"job_state": "R", "queue": "gpu",
+                   "Resource_List": {"select": "1:ncpus=4:ngpus=2"},
+                   "qtime": "Mon Jan  1 10:00:00 2024"}
+}}"""
+
+class PBSHistoryTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(job_schedulers.DEFAULT_PBS_SERVERS, {'test': 'server'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = job_schedulers.PBSJobScheduler()
+        self.logger = mock.Mock()
+
+    def qstat(self, stdout):
+        return mock.patch.object(job_schedulers.subprocess, 'run', return_value=(
+            subprocess.CompletedProcess([], 0, stdout=stdout)
+        ))
+
+    def test_finished_runtimes(self):
+        with self.qstat(QSTAT_HISTORY) as run:
+            finished = self.scheduler.finished_runtimes(self.logger, ['101', '102', '103'])
+        self.assertEqual(finished, {'101': ('COMPLETED', 5400), '102': ('TIMEOUT', 600)})
+        self.assertIn('101@server', run.call_args[0][0])
+
+    def test_job_accounting(self):
+        with self.qstat(QSTAT_HISTORY):
+            accounting = self.scheduler.job_accounting(self.logger, ['101', '102', '103'])
+        queue, gpu_type, submit, start, end, state = accounting['101']
+        self.assertEqual((queue, gpu_type, state), ('cpu', None, 'COMPLETED'))
+        self.assertEqual((start - submit, end - start), (300, 5400))
+        self.assertEqual(accounting['102'][1::4], ('a100', 'TIMEOUT'))
+        self.assertEqual(accounting['103'][1], 'gpu')
+        self.assertEqual(accounting['103'][4:], (None, None))
+
+    def test_unreadable(self):
+        for stdout in ('', 'not json'):
+            with self.qstat(stdout):
+                self.assertEqual(self.scheduler.finished_runtimes(self.logger, ['101']), {})
+                self.assertEqual(self.scheduler.job_accounting(self.logger, ['101']), {})
+
+if __name__ == '__main__':
+    unittest.main()
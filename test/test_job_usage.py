@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import job_usage
+
+def run(exit_status=0, mem_mb=16384, mem_peak_mb=4096, cpus=8, ntasks=2, cpu_efficiency=0.25):
+    return {'exit_status': exit_status, 'mem_mb': mem_mb, 'mem_peak_mb': mem_peak_mb,
+            'cpus': cpus, 'ntasks': ntasks, 'cpu_efficiency': cpu_efficiency}
+
+class RecommendTest(unittest.TestCase):
+    def test_too_few_runs(self):
+        self.assertEqual(job_usage.recommend([run()] * (job_usage.MIN_RUNS - 1)), {})
+        # Failed runs don't count
+        runs = [run()] * (job_usage.MIN_RUNS - 1) + [run(exit_status=1)]
+        self.assertEqual(job_usage.recommend(runs), {})
+
+    def test_recommendation(self):
+        runs = [run()] * (job_usage.MIN_RUNS - 1) + [run(mem_peak_mb=8192, cpu_efficiency=0.5)]
+        # 8192 * 1.25 + 2048 = 12288; 0.5 * 8 / 2 = 2 CPUs per task * 1.5
+        self.assertEqual(job_usage.recommend(runs), {'mem_mb': 12288, 'cpus_per_task': 3})
+
+    def test_minimum(self):
+        runs = [run(mem_peak_mb=100, cpu_efficiency=0.01)] * job_usage.MIN_RUNS
+        self.assertEqual(job_usage.recommend(runs), {'mem_mb': job_usage.MIN_MEM_MB, 'cpus_per_task': 1})
+
+    def test_near_ceiling(self):
+        # Even a failed run near its allocation keeps the memory as it is
+        runs = [run()] * job_usage.MIN_RUNS + [run(exit_status=1, mem_peak_mb=15000)]
+        self.assertNotIn('mem_mb', job_usage.recommend(runs))
+        self.assertIn('cpus_per_task', job_usage.recommend(runs))
+
+    def test_no_cpu_time(self):
+        runs = [run(cpu_efficiency=None)] * job_usage.MIN_RUNS
+        self.assertEqual(set(job_usage.recommend(runs)), {'mem_mb'})
+
+class CommandUsageTest(unittest.TestCase):
+    def test_command_steps(self):
+        usage = {
+            '1.batch': (100.0, 500.0, None),
+            '1.extern': (10.0, 50.0, None),
+            '1.0': (200.0, 300.0, 990.0),   # before the command
+            '1.1': (400.0, 120.0, 1000.0),
+            '1.2': (300.0, 80.0, 1010.0),
+        }
+        steps, cpu_seconds = job_usage.command_usage(usage, 1000.5, {'1.batch': 450.0, '1.extern': 40.0})
+        self.assertEqual(sorted(steps), ['1.1', '1.2', '1.batch', '1.extern'])
+        # batch since the start, srun steps in full, extern not at all
+        self.assertEqual(cpu_seconds, 50.0 + 120.0 + 80.0)
+
+    def test_no_start_cpu(self):
+        _, cpu_seconds = job_usage.command_usage({'1.batch': (1.0, 30.0, None)}, 1000.0, {})
+        self.assertEqual(cpu_seconds, 30.0)
+
+class ParseTest(unittest.TestCase):
+    def test_mem(self):
+        self.assertEqual(job_usage.parse_mem_mb('1.5G'), 1536)
+        self.assertEqual(job_usage.parse_mem_mb('1024K'), 1)
+        self.assertEqual(job_usage.parse_mem_mb('4000'), 4000)
+        self.assertEqual(job_usage.parse_mem_mb('2097152', 'B'), 2)
+
+    def test_cpu_time(self):
+        self.assertEqual(job_usage.parse_cpu_time('1-00:00:01'), 86401)
+        self.assertEqual(job_usage.parse_cpu_time('01:02:03'), 3723)
+        self.assertEqual(job_usage.parse_cpu_time('02:03.500'), 123.5)
+
+class RecordTest(unittest.TestCase):
+    def test_not_a_slurm_job(self):
+        state = tempfile.mkdtemp()
+        with open(os.path.join(state, 'start'), 'w') as f:
+            f.write('1000.0\n')
+        env = {'TMPDIR': os.path.dirname(state), 'BUILDKITE_JOB_ID': 'x'}
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(job_usage, '_state_dir', return_value=state), \
+                mock.patch.object(job_usage, 'step_usage') as step_usage:
+            os.environ.pop('SLURM_JOB_ID', None)
+            job_usage.record()
+        step_usage.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
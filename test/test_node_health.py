@@ -0,0 +1,134 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from os.path import join as joinpath
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import node_health
+
+class NodeHealthTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.health = node_health.NodeHealth(joinpath(self.dir, 'node_health.sqlite'))
+        self.logger = logging.getLogger('test')
+        self.logger.disabled = True
+        self.job_id = 0
+
+    def run_job(self, nodes, state='COMPLETED', exit_code='0:0', partition='gpu',
+                step='test', age=0):
+        self.job_id += 1
+        with self.health._transaction() as db:
+            db.execute(
+                'INSERT INTO runs (job_id, nodes, partition, state, exit_code, pipeline, step, end)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (str(self.job_id), nodes, partition, state, exit_code, 'pipeline', step,
+                 time.time() - age),
+            )
+
+    def test_outcomes(self):
+        self.run_job('a', 'NODE_FAIL')
+        self.run_job('a', 'FAILED', '0:7')  # SIGBUS
+        self.run_job('a', 'TIMEOUT')
+        self.run_job('a', 'OUT_OF_MEMORY')
+        # Failed on a, passed on b: counts against a
+        self.run_job('a', 'FAILED', '1:0', step='flaky')
+        self.run_job('b', 'COMPLETED', step='flaky')
+        # Never passed anywhere: the step is broken, not the node
+        self.run_job('a', 'FAILED', '1:0', step='broken')
+        self.run_job('b', 'FAILED', '1:0', step='broken')
+        outcomes = sorted((nodes, failed) for nodes, _, failed, _ in self.health.outcomes())
+        self.assertEqual(outcomes, [(['a'], 1), (['a'], 1), (['a'], 1), (['b'], 0)])
+
+    def test_multi_node_failures_are_shared(self):
+        self.run_job('a,b', 'NODE_FAIL')
+        stats, _ = self.health.node_stats()
+        self.assertAlmostEqual(stats['a'][0], 0.5, places=3)
+        self.assertAlmostEqual(stats['b'][0], 0.5, places=3)
+        self.assertAlmostEqual(stats['a'][1], 1.0, places=3)
+
+    def test_baseline_leaves_out_the_node(self):
+        for node in 'bcd':
+            self.run_job(node)
+            self.run_job(node, 'NODE_FAIL')
+        for _ in range(4):
+            self.run_job('a', 'NODE_FAIL')
+        stats, rates = self.health.node_stats()
+        self.assertAlmostEqual(rates['gpu'], 7 / 10, places=3)
+        # The other nodes failed half their jobs
+        self.assertAlmostEqual(stats['a'][2], 0.5, places=3)
+
+    def test_baseline_by_partition(self):
+        for node in 'bc':
+            for _ in range(4):
+                self.run_job(node, partition='cpu')
+            self.run_job(node, 'NODE_FAIL', partition='gpu')
+        for _ in range(4):
+            self.run_job('a', partition='cpu')
+        stats, _ = self.health.node_stats()
+        self.assertAlmostEqual(stats['a'][2], 0.0, places=3)
+        self.run_job('a', 'NODE_FAIL', partition='gpu')
+        stats, _ = self.health.node_stats()
+        # 4 jobs in cpu (rate 0) and 1 in gpu (rate 1 without its own)
+        self.assertAlmostEqual(stats['a'][2], 1 / 5, places=3)
+
+    def test_quarantine(self):
+        for node in 'bcdefg':
+            for _ in range(10):
+                self.run_job(node)
+        for _ in range(4):
+            self.run_job('a', 'NODE_FAIL')
+        self.run_job('a')
+        self.assertEqual(self.health._update_quarantine(self.logger), ['a'])
+        # Already quarantined: not again, but still listed
+        self.assertEqual(self.health._update_quarantine(self.logger), ['a'])
+
+    def test_too_few_failures(self):
+        for node in 'bcd':
+            for _ in range(10):
+                self.run_job(node)
+        for _ in range(node_health.MIN_FAILURES - 1):
+            self.run_job('a', 'NODE_FAIL')
+        self.assertEqual(self.health._update_quarantine(self.logger), [])
+
+    def test_bad_partition_is_not_a_bad_node(self):
+        for node in 'abcd':
+            for _ in range(3):
+                self.run_job(node, 'NODE_FAIL')
+            self.run_job(node)
+        self.assertEqual(self.health._update_quarantine(self.logger), [])
+
+    def test_released_nodes_start_over(self):
+        for node in 'bcdefg':
+            for _ in range(10):
+                self.run_job(node)
+        for _ in range(4):
+            self.run_job('a', 'NODE_FAIL', age=3600)
+        with self.health._transaction() as db:
+            db.execute(
+                'INSERT INTO quarantine (node, since, until, rate, fleet_rate) VALUES (?, ?, ?, ?, ?)',
+                ('a', time.time() - 7200, time.time() - 60, 1.0, 0.0),
+            )
+        self.assertEqual(self.health._update_quarantine(self.logger), [])
+        self.assertNotIn('a', self.health.node_stats()[0])
+
+    def test_merge_exclude(self):
+        self.assertEqual(node_health.merge_exclude('', ['a', 'b']), 'a,b')
+        self.assertEqual(node_health.merge_exclude('x-[1-2]', ['a']), 'x-[1-2],a')
+        self.assertEqual(node_health.merge_exclude('x', []), 'x')
+
+    def test_expand_plain_nodelist(self):
+        self.assertEqual(node_health.expand_nodelist('a,b'), ['a', 'b'])
+        self.assertEqual(node_health.expand_nodelist('None assigned'), [])
+
+if __name__ == '__main__':
+    unittest.main()
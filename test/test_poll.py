@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import poll
+from job_schedulers import SchedulerJob
+
+poll.logger.disabled = True
+
+class Scheduler:
+    def user_job_limit(self, logger):
+        return None
+
+def url(n):
+    return f'https://buildkite.com/org/pipeline/builds/1#job{n}'
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        self.current_jobs = {
+            url(1): [SchedulerJob('1', pending=True)],
+            url(2): [SchedulerJob('2', pending=True)],
+            url(3): [SchedulerJob('3', pending=False)],
+            url(4): [SchedulerJob('4', pending=True)],
+        }
+        self.round = poll.SubmitRound(Scheduler(), self.current_jobs)
+        self.addCleanup(self.round.close)
+        self.job_states = {url(1): 'scheduled', url(2): 'expired', url(3): 'running'}
+
+    def test_grace(self):
+        orphans = {}
+        self.round.reconcile(self.job_states, orphans)
+        # Waiting, started or not in the cached builds: not orphans
+        self.assertEqual(list(orphans), ['2'])
+        self.assertEqual(self.round.jobs_to_cancel, [])
+        orphans['2'] -= poll.ORPHAN_GRACE_SECONDS
+        self.round.reconcile(self.job_states, orphans)
+        self.assertEqual([[j.id for j in jobs] for jobs in self.round.jobs_to_cancel], [['2']])
+        self.assertEqual(orphans, {})
+        self.assertEqual(self.round.canceled_urls, [url(2)])
+
+    def test_forgotten_once_waiting_again(self):
+        orphans = {'2': time.time() - 60}
+        self.job_states[url(2)] = 'scheduled'
+        self.round.reconcile(self.job_states, orphans)
+        self.assertEqual(orphans, {})
+
+    def test_started_jobs_of_the_url_kept(self):
+        self.current_jobs[url(2)].append(SchedulerJob('5', pending=False))
+        orphans = {'2': time.time() - poll.ORPHAN_GRACE_SECONDS}
+        self.round.reconcile(self.job_states, orphans)
+        self.assertEqual([j.id for j in self.current_jobs[url(2)]], ['5'])
+        self.assertEqual(self.round.canceled_urls, [])
+
+    def test_at_most_per_poll(self):
+        self.job_states = {url(n): 'expired' for n in (1, 2, 4)}
+        orphans = {n: time.time() - poll.ORPHAN_GRACE_SECONDS for n in ('1', '2', '4')}
+        with mock.patch.object(poll, 'ORPHAN_CANCEL_MAX', 2):
+            self.round.reconcile(self.job_states, orphans)
+        self.assertEqual(len(self.round.jobs_to_cancel), 2)
+        # The rest waits for the next poll, still past its grace
+        self.assertEqual(len(orphans), 1)
+
+if __name__ == '__main__':
+    unittest.main()
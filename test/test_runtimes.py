@@ -0,0 +1,124 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from os.path import join as joinpath
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import runtimes
+from buildkite import Job
+from runtimes import MIN_RUNS, MIN_LIMIT_SECONDS
+
+class RuntimeHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.history = runtimes.RuntimeHistory(joinpath(self.dir, 'runtimes.sqlite'))
+        self.logger = logging.getLogger('test')
+        self.logger.disabled = True
+        self.finished = {}
+        self.asked = []
+        self.job_id = 0
+
+    def finished_runtimes(self, logger, job_ids):
+        self.asked.extend(job_ids)
+        return {job_id: self.finished[job_id] for job_id in job_ids if job_id in self.finished}
+
+    def run_job(self, elapsed, state='COMPLETED', step='test'):
+        self.job_id += 1
+        self.history.record_submit(self.job_id, 'pipeline', step)
+        self.finished[str(self.job_id)] = (state, elapsed)
+
+    def refresh(self):
+        self.history.refresh(self.logger, self.finished_runtimes, force=True)
+
+    def test_limit(self):
+        for elapsed in range(1, 21):
+            self.run_job(elapsed * 60.0)
+        self.refresh()
+        # The 95th percentile of 20 runs is the longest
+        self.assertEqual(self.history.limit_seconds('pipeline', 'test'), 20 * 60 * 1.5 + 300)
+        self.assertIsNone(self.history.limit_seconds('pipeline', 'other'))
+
+    def test_minimum(self):
+        for _ in range(MIN_RUNS):
+            self.run_job(10.0)
+        self.refresh()
+        self.assertEqual(self.history.limit_seconds('pipeline', 'test'), MIN_LIMIT_SECONDS)
+
+    def test_too_few_runs(self):
+        for _ in range(MIN_RUNS - 1):
+            self.run_job(600.0)
+        self.run_job(600.0, state='CANCELLED')
+        self.refresh()
+        self.assertIsNone(self.history.limit_seconds('pipeline', 'test'))
+
+    def test_timeout_falls_back_to_the_default(self):
+        for _ in range(MIN_RUNS):
+            self.run_job(600.0)
+        self.refresh()
+        self.assertIsNotNone(self.history.limit_seconds('pipeline', 'test'))
+        self.run_job(3600.0, state='TIMEOUT')
+        self.refresh()
+        self.assertIsNone(self.history.limit_seconds('pipeline', 'test'))
+        # Until it is out of the most recent runs
+        for _ in range(runtimes.RUNS_KEPT):
+            self.run_job(600.0)
+        self.refresh()
+        self.assertIsNotNone(self.history.limit_seconds('pipeline', 'test'))
+
+    def test_only_unfinished_jobs_are_asked(self):
+        self.run_job(600.0)
+        self.refresh()
+        self.assertEqual(self.asked, ['1'])
+        self.asked = []
+        self.history.record_submit(2, 'pipeline', 'test')
+        self.refresh()
+        self.refresh()
+        self.assertEqual(self.asked, ['2', '2'])
+
+    def test_refresh_interval(self):
+        self.run_job(600.0)
+        self.history.refresh(self.logger, self.finished_runtimes)
+        self.history.refresh(self.logger, self.finished_runtimes)
+        self.assertEqual(self.asked, ['1'])
+
+    def test_forgotten(self):
+        self.run_job(600.0)
+        with self.history._transaction() as db:
+            db.execute('UPDATE runs SET submit_time = ?',
+                       (time.time() - runtimes.HISTORY_DAYS * 86400 - 60,))
+        self.refresh()
+        self.assertEqual(self.history.steps([1]), {})
+
+    def test_steps(self):
+        self.run_job(600.0, step='a')
+        self.run_job(600.0, step='b')
+        self.assertEqual(self.history.steps([1, '2', 3]),
+                         {'1': ('pipeline', 'a'), '2': ('pipeline', 'b')})
+
+class HelpersTest(unittest.TestCase):
+    def test_format_time_limit(self):
+        self.assertEqual(runtimes.format_time_limit(600), '0:10:00')
+        self.assertEqual(runtimes.format_time_limit(601), '0:11:00')
+        self.assertEqual(runtimes.format_time_limit(26 * 3600), '26:00:00')
+
+    def test_job_step(self):
+        url = 'https://buildkite.com/org/pipeline/builds/1#job'
+        self.assertEqual(runtimes.job_step(Job('j', 'script', web_url=url, step_key='key', name='label')),
+                         ('pipeline', 'key'))
+        self.assertEqual(runtimes.job_step(Job('j', 'script', web_url=url, name='label')),
+                         ('pipeline', 'label'))
+        self.assertIsNone(runtimes.job_step(Job('j', 'script', web_url=url)))
+        self.assertIsNone(runtimes.job_step(Job('j', 'script', name='label')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os.path import join as joinpath
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import spool
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def listdir(self, name):
+        return sorted(os.listdir(joinpath(self.dir, name)))
+
+    def test_flow(self):
+        self.assertFalse(spool.has_events(self.dir))
+        first = spool.write_event({'n': 1}, self.dir)
+        second = spool.write_event({'n': 2}, self.dir)
+        self.assertEqual(self.listdir('tmp'), [])
+        self.assertEqual(self.listdir('new'), sorted([first, second]))
+        self.assertTrue(spool.has_events(self.dir))
+
+        events = spool.claim_events(self.dir)
+        self.assertEqual([event for _, event in events], [{'n': 1}, {'n': 2}])
+        self.assertEqual(self.listdir('new'), [])
+        self.assertEqual(self.listdir('cur'), sorted([first, second]))
+        # Claimed but not done: still there for the next round
+        self.assertTrue(spool.has_events(self.dir))
+
+        for path, _ in events:
+            spool.done(path)
+        self.assertFalse(spool.has_events(self.dir))
+        self.assertEqual(spool.claim_events(self.dir), [])
+
+    def test_left_in_cur(self):
+        spool.write_event({'n': 1}, self.dir)
+        spool.claim_events(self.dir)
+        spool.write_event({'n': 2}, self.dir)
+        # A crashed round's events come first, in arrival order
+        self.assertEqual([event for _, event in spool.claim_events(self.dir)], [{'n': 1}, {'n': 2}])
+
+    def test_partial_writes_are_invisible(self):
+        os.makedirs(joinpath(self.dir, 'tmp'))
+        with open(joinpath(self.dir, 'tmp', 'partial.json'), 'w') as f:
+            f.write('{"n"')
+        self.assertFalse(spool.has_events(self.dir))
+        self.assertEqual(spool.claim_events(self.dir), [])
+
+    def test_unreadable(self):
+        os.makedirs(joinpath(self.dir, 'new'))
+        with open(joinpath(self.dir, 'new', 'bad.json'), 'w') as f:
+            f.write('{"n"')
+        self.assertEqual(spool.claim_events(self.dir), [])
+        self.assertFalse(spool.has_events(self.dir))
+
+    def test_reject(self):
+        spool.write_event({'n': 1}, self.dir)
+        [(path, _)] = spool.claim_events(self.dir)
+        spool.reject(path, self.dir)
+        self.assertEqual(self.listdir('failed'), [os.path.basename(path)])
+        self.assertFalse(spool.has_events(self.dir))
+        spool.done(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+# buildkite.py reads its settings from the environment on import
+os.environ.setdefault('BUILDKITE_PATH', tempfile.mkdtemp())
+os.environ.setdefault('BUILDKITE_QUEUE', 'test')
+os.environ.setdefault('BUILDKITE_API_TOKEN', 'test')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+import webhook
+from buildkite import BUILDKITE_QUEUE
+
+TOKEN = 'secret'
+
+def signature(body, timestamp=None, token=TOKEN):
+    timestamp = str(int(time.time() if timestamp is None else timestamp))
+    digest = hmac.new(token.encode(), timestamp.encode() + b'.' + body, hashlib.sha256).hexdigest()
+    return f'timestamp={timestamp},signature={digest}'
+
+class VerifyRequestTest(unittest.TestCase):
+    BODY = b'{"event": "job.scheduled"}'
+
+    def verify(self, headers, body=BODY):
+        return webhook.verify_request(headers, body, TOKEN)
+
+    def test_token(self):
+        self.assertTrue(self.verify({'X-Buildkite-Token': TOKEN}))
+        self.assertFalse(self.verify({'X-Buildkite-Token': 'wrong'}))
+        self.assertFalse(self.verify({}))
+
+    def test_signature(self):
+        self.assertTrue(self.verify({'X-Buildkite-Signature': signature(self.BODY)}))
+
+    def test_bad_signature(self):
+        for header in (
+            signature(self.BODY, token='wrong'),
+            signature(b'{"event": "build.canceled"}'),
+            signature(self.BODY).replace('timestamp=', 'timestamp=x'),
+            'timestamp=1',
+            'garbage',
+        ):
+            with self.subTest(header=header):
+                self.assertFalse(self.verify({'X-Buildkite-Signature': header}))
+
+    def test_replayed_signature(self):
+        old = time.time() - webhook.SIGNATURE_MAX_AGE - 60
+        self.assertFalse(self.verify({'X-Buildkite-Signature': signature(self.BODY, old)}))
+
+    def test_token_header_wins(self):
+        headers = {'X-Buildkite-Token': 'wrong', 'X-Buildkite-Signature': signature(self.BODY)}
+        self.assertFalse(self.verify(headers))
+
+class SpoolEventTest(unittest.TestCase):
+    PIPELINE = {'name': 'Pipeline', 'slug': 'pipeline'}
+    BUILD = {'id': 'b', 'number': 1, 'state': 'running',
+             'web_url': 'https://buildkite.com/org/pipeline/builds/1'}
+
+    def job(self, queue=BUILDKITE_QUEUE, type='script'):
+        return {'id': 'j', 'type': type, 'state': 'scheduled',
+                'web_url': 'https://buildkite.com/org/pipeline/builds/1#j',
+                'agent_query_rules': [f'queue={queue}'], 'env': {'SECRET': 'x'}}
+
+    def test_job_scheduled(self):
+        event = webhook.spool_event(
+            'job.scheduled', {'build': self.BUILD, 'pipeline': self.PIPELINE, 'job': self.job()}
+        )
+        self.assertEqual(event['event'], 'job.scheduled')
+        self.assertEqual(event['build']['pipeline'], self.PIPELINE)
+        self.assertEqual([job['id'] for job in event['build']['jobs']], ['j'])
+        # Trimmed to what the poller reads
+        self.assertNotIn('env', event['build']['jobs'][0])
+
+    def test_other_jobs(self):
+        for job in (self.job(queue='elsewhere'), self.job(type='waiter')):
+            payload = {'build': self.BUILD, 'pipeline': self.PIPELINE, 'job': job}
+            self.assertIsNone(webhook.spool_event('job.scheduled', payload))
+
+    def test_builds(self):
+        canceled = {**self.BUILD, 'state': 'canceled'}
+        event = webhook.spool_event('build.finished', {'build': canceled, 'pipeline': self.PIPELINE})
+        self.assertEqual(event['build']['state'], 'canceled')
+        self.assertIsNone(
+            webhook.spool_event('build.running', {'build': self.BUILD, 'pipeline': self.PIPELINE})
+        )
+        self.assertIsNone(webhook.spool_event('agent.connected', {}))
+
+if __name__ == '__main__':
+    unittest.main()